@@ -1,14 +1,195 @@
 from tkinter import *
-from encryption import Encryption
+from tkinter import ttk
+from encryption import Encryption, Encryptor, Decryptor
 import ft_conn
+from ft_conn.ft_error import BrokenSocketError
+from ft_conn.ft_notify import FTNotifier
+from ft_conn.ft_pack import pack_files, unpack_files
+from ft_conn.ft_pages import FTListPager
+from ft_conn.ft_rate import rate_limiters
+from ft_conn.ft_sched import FTScheduler, Priority
+import argparse
 import file_info
 import pathlib
 import os
+import queue
+import threading
+import time
+
+
+class NetworkWorker(threading.Thread):
+    """Owns the connection: connects, sends whatever is queued with send(),
+    and hands every received message to on_message. Only this thread ever
+    touches the socket, so sends and receives never interleave."""
+
+    def __init__(self, ft, address, on_message, on_status):
+        """:param ft is the FTConn to use
+            :param address is the (ip, port) to connect to
+            :param on_message is called (on this thread) with each message_type and data
+            :param on_status is called (on this thread) with status messages to show the user"""
+        super().__init__(daemon=True)
+        self.ft = ft
+        self.on_message = on_message
+        self.on_status = on_status
+        self.address = address
+        # calls waiting to be made, most urgent first
+        self.outbox = FTScheduler()
+
+    def send(self, func, *args, priority=Priority.USER, size=0):
+        """Queues a call (usually an FTConn send or request method) to be made on this thread
+            :param priority is how urgent the call is (see ft_conn.ft_sched.Priority)
+            :param size is how many bytes the call sends, so smaller ones can go first
+            :return the queued job, which can be cancelled"""
+        return self.outbox.submit(func, *args, priority=priority, size=size)
+
+    def run(self):
+        """Connects, then alternates between sending what is queued and receiving"""
+        ip, port = self.address
+        try:
+            message = self.ft.connect(ip, port)
+        except Exception as err:
+            self.on_status("error: {}".format(err))
+            return
+        self.on_status(message)
+        if message != "Success":
+            # e.g. "Handshake failed", so there is no connection to use (connecting again
+            # starts a new worker)
+            return
+
+        while True:
+            try:
+                # sends everything that is queued (the most urgent first), waiting a little if
+                # there is nothing to do
+                if self.outbox.run_next(timeout=0.01):
+                    while self.outbox.run_next():
+                        pass
+
+                message_type, data = self.ft.receive_data()
+            except (BrokenSocketError, ConnectionError):
+                self.on_status("connection lost, reconnecting")
+                message = self.ft.reconnect()
+                self.on_status(message)
+                continue
+            except Exception as err:
+                # e.g. a received file that could not be decrypted, or a file that could
+                # not be sent
+                self.on_status("error: {}".format(err))
+                continue
+            if message_type is not None:
+                self.on_message(message_type, data)
+
+
+class ReceivedFile:
+    """Decrypts a file as it is received and writes it straight to disk (used as the
+    FTConn file_sink), so the whole file is never held in memory"""
+
+    def __init__(self, file_name, length, password, expected_hash=None,
+                 durability=file_info.Durability.NONE, size=None, extents=None,
+                 algorithm=file_info.SHA256, expected_chunks=None):
+        """:param file_name is the name of the received file
+            :param length is the size of the encrypted contents
+            :param password is the password to decrypt with
+            :param expected_hash is the hash from the other user's file list (None to not check it)
+            :param durability is how hard to try to get the file on disk (see file_info.Durability)
+            :param size and extents are the size and data extents of a sparse file (the contents
+                fill the extents, and the rest is left as holes)
+            :param algorithm is the hash algorithm expected_hash was made with
+            :param expected_chunks is the hashes of the file's chunks (None to only check the
+                whole file)"""
+        self.decryptor = Decryptor(password)
+        if extents is None:
+            size = Decryptor.plaintext_size_bound(length)
+        self.incoming = file_info.IncomingFile(pathlib.Path(file_name.decode()), size,
+                                               expected_hash, durability, extents=extents,
+                                               algorithm=algorithm,
+                                               expected_chunks=expected_chunks)
+
+    def write(self, data):
+        """decrypts and writes the next piece of the file
+            :param data is the next piece of the encrypted contents"""
+        self.incoming.write(self.decryptor.update(data))
+
+    def close(self):
+        """checks and writes the end of the file, or removes the file if it is bad (or doesn't
+            match its hash)"""
+        try:
+            self.incoming.write(self.decryptor.finalize())
+        except Exception:
+            self.incoming.abort()
+            raise
+        return self.incoming.close()
+
+    def abort(self):
+        """removes the partly written file"""
+        self.incoming.abort()
+
+
+class DecryptedRange:
+    """Decrypts one range of a striped file as it is received and writes it into place"""
+
+    def __init__(self, incoming, offset, password):
+        """:param incoming is the IncomingFile the range belongs to
+            :param offset is where the range starts in the file
+            :param password is the password to decrypt with"""
+        self.decryptor = Decryptor(password)
+        self.incoming = incoming
+        self.offset = offset
+
+    def write(self, data):
+        """decrypts and writes the next piece of the range
+            :param data is the next piece of the encrypted range"""
+        plain_text = self.decryptor.update(data)
+        self.incoming.write_at(self.offset, plain_text)
+        self.offset += len(plain_text)
+
+    def close(self):
+        """checks and writes the end of the range"""
+        self.incoming.write_at(self.offset, self.decryptor.finalize())
+
+    def abort(self):
+        """nothing to do, since the whole file is removed when a range fails"""
+
+
+class ReceivedStripedFile:
+    """Puts a striped file back together as its ranges arrive (used as the FTConn
+    range_sink)"""
+
+    def __init__(self, file_name, size, password, expected_hash=None,
+                 durability=file_info.Durability.NONE, algorithm=file_info.SHA256,
+                 expected_chunks=None):
+        """:param file_name is the name of the received file
+            :param size is the size of the file
+            :param password is the password to decrypt with
+            :param expected_hash is the hash from the other user's file list (None to not check it)
+            :param durability is how hard to try to get the file on disk (see file_info.Durability)
+            :param algorithm is the hash algorithm expected_hash was made with
+            :param expected_chunks is the hashes of the file's chunks (None to only check the
+                whole file)"""
+        self.password = password
+        self.incoming = file_info.IncomingFile(pathlib.Path(file_name.decode()), size,
+                                               expected_hash, durability, algorithm=algorithm,
+                                               expected_chunks=expected_chunks)
+
+    def open_range(self, offset, length):
+        """:param offset is where the range starts in the file
+            :param length is the size of the encrypted range
+            :return the object to write the range's encrypted contents to"""
+        return DecryptedRange(self.incoming, offset, self.password)
+
+    def close(self):
+        """finishes the file, or removes it if it doesn't match its hash"""
+        return self.incoming.close()
+
+    def abort(self):
+        """removes the partly written file"""
+        self.incoming.abort()
 
 
 class Application(Frame):
-    def __init__(self, master=None):
-        """Initialize an instance of the Application and creates widgets"""
+    def __init__(self, master=None, limiters=None):
+        """Initialize an instance of the Application and creates widgets
+            :param master is the tk root window
+            :param limiters are the token buckets that sending file contents draws from"""
         super().__init__(master)
 
         os.makedirs("shared_files", exist_ok=True)
@@ -30,34 +211,137 @@ class Application(Frame):
         self.connect["command"] = self.connect_command
         self.pack()
 
+        # button to request every remote file in a single batch
+        self.sync = Button(self)
+        self.sync["text"] = "Sync All"
+        self.sync.pack(side="top")
+        self.sync["command"] = self.sync_command
+
         # Quit Program
         self.quit = Button(self, text="QUIT", fg="red", command=root.destroy)
         self.quit.pack(side="bottom")
 
-        # Label above the buttons of files to request
+        # Label above the list of files to request
         self.label = Label(self)
-        self.label["text"] = "File List"
+        self.label["text"] = "File List (double-click to request)"
         self.label.pack(side="top")
 
+        # one tree view holds the whole remote file list; tk only draws the rows that are
+        # visible, so even huge lists stay cheap
+        self.frame = Frame(self)
+        self.tree = ttk.Treeview(self.frame, columns=("type", "modified"), height=20)
+        self.tree.heading("#0", text="Name")
+        self.tree.heading("type", text="Type")
+        self.tree.heading("modified", text="Modified")
+        self.tree.column("type", width=60, stretch=False)
+        self.tree.column("modified", width=160, stretch=False)
+        self.scrollbar = Scrollbar(self.frame, orient="vertical", command=self.tree.yview)
+        self.tree["yscrollcommand"] = self.scrollbar.set
+        self.tree.bind("<Double-1>", self.tree_request_command)
+        self.tree.pack(side="left", fill="both", expand=True)
+        self.scrollbar.pack(side="right", fill="y")
+        self.frame.pack(side="top", fill="both", expand=True)
+
         # initializes the global variables used throughout the project
-        self.ft = ft_conn.FTConn()
-        self.local_files = file_info.LocalFileInfoBrowser()
+        # large files are split over 4 connections if the other user allows it, and sending
+        # file contents is slowed down to the rate the user asked for, if any
+        self.ft = ft_conn.FTConn(ft_conn.FTSock(rate_limiters=limiters), stripes=4)
+        # files are hashed with the fastest algorithm we have, unless the other user can't use it
+        self.local_files = file_info.LocalFileInfoBrowser(self.ft.hash_algorithms[0])
         self.remote_file_list = []
         self.path = pathlib.Path(".")
-        self.frame = None
+        # what each row of the tree currently shows, keyed by the row id (the file's path)
+        self.remote_rows = {}
+        # the rows and files of the list that is still arriving a page at a time
+        self.listing_rows = {}
+        self.listing_files = []
+        # our file lists that the other user is part way through, a page at a time
+        self.list_pager = FTListPager()
+        self.password = ""
+        # received files are flushed to disk, but a batch of files shares one directory flush
+        self.durability = file_info.Durability.BATCH
         self.pack()
 
+        # received files are decrypted and written as they arrive, and checked against the
+        # hashes in the other user's file list (a chunk at a time, if we have the chunks'
+        # hashes, so a bad transfer is caught as soon as it goes wrong)
+        self.ft.file_sink = lambda file_name, length: ReceivedFile(
+            file_name, length, self.password, self.ft.expected_hash(file_name), self.durability,
+            algorithm=self.ft.hash_algorithm, expected_chunks=self.ft.expected_chunks(file_name))
+        self.ft.range_sink = lambda file_name, size: ReceivedStripedFile(
+            file_name, size, self.password, self.ft.expected_hash(file_name), self.durability,
+            self.ft.hash_algorithm, self.ft.expected_chunks(file_name))
+        # sparse files only have their data sent, and get their holes back when written
+        self.ft.sparse_sink = lambda file_name, length, size, extents: ReceivedFile(
+            file_name, length, self.password, self.ft.expected_hash(file_name), self.durability,
+            size, extents, self.ft.hash_algorithm, self.ft.expected_chunks(file_name))
+
+        # network I/O happens on the network worker, and hashing, reading, writing and
+        # encryption happen on the file worker, so the window never waits on either of them
+        self.network = None
+        self.file_jobs = FTScheduler()
+        threading.Thread(target=self.run_file_jobs, daemon=True).start()
+        # the last "Sync All" that hasn't been sent yet, so pressing it again replaces it
+        self.sync_job = None
+
+        # once the other user subscribes, our files are checked for changes every quarter of
+        # a second, and the changes are sent together once they have settled down. most checks
+        # only look inside folders whose entries changed; every 30 seconds, every folder is
+        # looked through for files changed deeper down
+        self.watch_interval = 0.25
+        self.deep_watch_interval = 30
+        self.last_deep_watch = 0
+        self.watcher = None
+        self.watch_queued = False
+        self.notifier = FTNotifier()
+
+        # results from the workers, handed to tk by handle_events
+        self.events = queue.Queue()
+
     def encrypt_file(self, file_data):
         """File given to the method becomes encrypted before it is sent across the network
             :param file_data is the bytes that are being encrypted"""
         # create encryption instance then encrypts
-        return Encryption(file_data, self.password_entry.get()).encrypt()
+        return Encryption(file_data, self.password).encrypt()
 
     def decrypt_file(self, file_data):
         """File given to the method becomes encrypted before it is sent across the network
             :param file_data is the bytes that are being decrypted"""
         # create encryption instance then decrypts
-        return Encryption(file_data, self.password_entry.get()).decrypt()
+        return Encryption(file_data, self.password).decrypt()
+
+    def post(self, func, *args):
+        """Safely schedules a call on the tk thread from any thread
+            :param func is called with args the next time handle_events runs"""
+        if not callable(func):
+            # plain status messages are just shown to the user
+            func, args = print, (func,)
+        self.events.put((func, args))
+
+    def handle_events(self):
+        """Runs everything the workers posted, then checks again in 10 milliseconds"""
+        try:
+            while True:
+                func, args = self.events.get_nowait()
+                func(*args)
+        except queue.Empty:
+            pass
+        finally:
+            root.after(10, self.handle_events)
+
+    def run_file_job(self, func, *args, priority=Priority.USER, size=0):
+        """Runs func on the file worker, showing the user any error it raises
+            :param priority is how urgent the job is (see ft_conn.ft_sched.Priority)
+            :param size is how many bytes the job handles, so smaller ones can go first"""
+        self.file_jobs.submit(func, *args, priority=priority, size=size)
+
+    def run_file_jobs(self):
+        """Runs the file worker's jobs, the most urgent first (runs on the file worker)"""
+        while True:
+            try:
+                self.file_jobs.run_next(timeout=None)
+            except Exception as err:
+                self.post("error: {}".format(err))
 
     def connect_command(self):
         """File given to the method becomes encrypted before it is sent across the network"""
@@ -70,77 +354,323 @@ class Application(Frame):
         ip = str(x[0])
         port = int(x[1])
 
-        # attempts to connect
-        message = self.ft.connect(ip, port)
-        print(message)
-        root.after(100, app.requests)
+        # the password is read here since the workers can't touch the widgets
+        self.password = self.password_entry.get()
+
+        # attempts to connect (in the background, since it may wait for the other user)
+        if self.network is None or not self.network.is_alive():
+            if self.network is None:
+                root.after(100, app.requests)
+            self.network = NetworkWorker(self.ft, (ip, port), self.message_handler, self.post)
+            self.network.start()
         return
 
+    def sync_command(self):
+        """Requests all of the files in the other user's file list at once"""
+        file_names = [files.path.name.encode() for files in self.remote_file_list if not files.is_dir]
+        if file_names and self.network is not None:
+            if self.sync_job is not None:
+                self.sync_job.cancel()
+            # the hashes that are still pending are asked for first, so the files can be checked
+            pending = [files.path.name.encode() for files in self.remote_file_list
+                       if not files.is_dir and files.hash is None]
+            if pending:
+                self.network.send(self.ft.request_hashes, pending, priority=Priority.BACKGROUND)
+            self.sync_job = self.network.send(self.ft.request_files, file_names,
+                                              priority=Priority.BACKGROUND)
+
     def requests(self):
-        """File given to the method becomes encrypted before it is sent across the network"""
+        """Asks the other user for their file list every 10 seconds, unless they can tell us
+            whenever it changes instead (checked again every time, in case we reconnect to a
+            user who can't)"""
         try:
-            # asks other user for a their file list
-            self.ft.request_file_list()
+            if self.network.is_alive():
+                if self.ft.caps.get('push'):
+                    # the other user answers with a CHANGED, which asks for the list (see
+                    # message_handler), so there is nothing to poll for
+                    if not self.ft.subscribed:
+                        self.network.send(self.ft.subscribe, priority=Priority.CONTROL)
+                else:
+                    # asks other user for a their file list
+                    self.request_file_list()
         except Exception as err:
             raise err
         finally:
             root.after(10000, self.requests)
 
-    def update_remote_file_list(self, file_list):
-        """creates a new list of buttons that are on the other user's code
-            :param file_list is the list of files that are on the other user's computer"""
+    def request_file_list(self):
+        """Queues a request for the other user's file list (from any thread)"""
+        if not self.ft.caps.get('pages'):
+            self.network.send(self.ft.request_file_list, priority=Priority.CONTROL)
+        elif not self.ft.listing:
+            # large directories are listed a page at a time, so they show up sooner
+            self.network.send(self.ft.request_file_list_page, priority=Priority.CONTROL)
+
+    def tree_request_command(self, event):
+        """Requests the file that was double-clicked in the remote file list
+            :param event is the tk event for the double-click"""
+        row = self.tree.identify_row(event.y)
+        if row and self.network is not None:
+            # if the file's hash is still pending it is asked for first, so the file can be checked,
+            # and so are the hashes of its chunks if the other user can send them
+            if self.ft.caps.get('chunks') or any(
+                    str(files.path) == row and files.hash is None for files in self.remote_file_list):
+                self.network.send(self.ft.request_hashes, [row.encode()], priority=Priority.USER)
+            self.network.send(self.ft.request_file, row.encode(), priority=Priority.USER)
+
+    def update_remote_file_list(self, file_list, first=True, last=True):
+        """updates the tree of files that are on the other user's computer, only changing
+            the rows that are different from the last list
+            :param file_list is the list of files (or the next page of them) that are on the
+                other user's computer
+            :param first is whether file_list starts a new list
+            :param last is whether file_list ends the list"""
+        if first:
+            self.listing_rows = {}
+            self.listing_files = []
+        self.listing_files.extend(file_list)
+
+        # adds the new files and changes the ones that are different, as soon as each page
+        # arrives
+        for files in file_list:
+            modified = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(files.mtime / 1e9))
+            row = str(files.path)
+            name, values = files.path.name, ("dir" if files.is_dir else "file", modified)
+            old = self.remote_rows.get(row)
+            if old is None:
+                self.tree.insert("", "end", iid=row, text=name, values=values)
+            elif old != (name, values):
+                self.tree.item(row, text=name, values=values)
+            self.remote_rows[row] = self.listing_rows[row] = (name, values)
+
+        if not last:
+            return
+
+        # removes the files that are gone once the whole list is in
+        removed = [row for row in self.remote_rows if row not in self.listing_rows]
+        if removed:
+            self.tree.delete(*removed)
+        self.remote_rows = self.listing_rows
+
         # sets a global variable that keeps track of the other user's file list
-        self.remote_file_list = file_list
+        self.remote_file_list = self.listing_files
+
+    def update_remote_hashes(self, file_list):
+        """fills in hashes that were pending in the other user's file list
+            :param file_list is the list of files whose hashes were asked for"""
+        hashes = {files.path: files for files in file_list}
+        self.remote_file_list = [hashes.get(files.path, files) for files in self.remote_file_list]
+
+    def message_handler(self, message_type, data):
+        """Handles all the requests that are given to each computer. This is called on the
+            network worker, so anything slow is passed on to the file worker, and anything
+            that touches the window is posted back to tk
+            :param message_type is a code that determines what type of request is being asked
+            :param data is what is in the file or file list"""
+        # the types of message types and how to handle each one
+        # file lists go first, then single files (which the other user clicked on), then
+        # batches of files (from syncing), with the smallest first
+        if message_type == ft_conn.FTProto.REQ_LIST:
+            self.run_file_job(self.send_file_list, priority=Priority.CONTROL)
+        elif message_type == ft_conn.FTProto.REQ_LIST_PAGE:
+            self.run_file_job(self.send_file_list_page, *data, priority=Priority.CONTROL)
+        elif message_type == ft_conn.FTProto.REQ_HASH:
+            # hashes are asked for just before the files they are for
+            self.run_file_job(self.send_hashes, data, priority=Priority.USER,
+                              size=self.file_size(data))
+        elif message_type == ft_conn.FTProto.REQ_FILE:
+            self.run_file_job(self.send_file, data, priority=Priority.USER,
+                              size=self.file_size([data]))
+        elif message_type == ft_conn.FTProto.REQ_FILES:
+            self.run_file_job(self.send_files, data, priority=Priority.BACKGROUND,
+                              size=self.file_size(data))
+        elif message_type == ft_conn.FTProto.RES_LIST:
+            self.post(self.update_remote_file_list, data)
+            self.post("file list received")
+        elif message_type == ft_conn.FTProto.RES_LIST_PAGE:
+            # each page is shown as soon as it arrives, while the next one is asked for
+            cursor, next_cursor, file_list = data
+            if next_cursor:
+                self.network.send(self.ft.request_file_list_page, next_cursor,
+                                  priority=Priority.CONTROL)
+            self.post(self.update_remote_file_list, file_list, cursor == 0, next_cursor == 0)
+            if not next_cursor:
+                self.post("file list received")
+        elif message_type == ft_conn.FTProto.RES_HASH:
+            # ft keeps the hashes for checking the files when they come
+            self.post(self.update_remote_hashes, data)
+        elif message_type in (ft_conn.FTProto.RES_FILE, ft_conn.FTProto.RES_STRIPED,
+                              ft_conn.FTProto.RES_SPARSE):
+            # the file is already on disk by now (see ReceivedFile and ReceivedStripedFile)
+            self.post("file received")
+        elif message_type == ft_conn.FTProto.RES_FILES:
+            self.run_file_job(self.receive_files, data, priority=Priority.BACKGROUND,
+                              size=len(data))
+        elif message_type == ft_conn.FTProto.SUBSCRIBE:
+            # the other user wants to be told when our files change
+            if data:
+                self.start_watching()
+        elif message_type == ft_conn.FTProto.CHANGED:
+            # the other user's files changed, so their list is asked for again
+            self.request_file_list()
+        else:
+            self.post("unknown request")
+
+    def start_watching(self):
+        """Starts checking our files for changes, if that isn't happening already"""
+        if self.watcher is None:
+            # the first check only notes how the files are now
+            self.run_file_job(self.local_files.changes, self.path, priority=Priority.CONTROL)
+            self.watcher = threading.Thread(target=self.watch_files, daemon=True)
+            self.watcher.start()
+
+    def watch_files(self):
+        """Queues a check for changes every watch_interval while the other user is subscribed
+            (runs on its own thread, since the file browser belongs to the file worker)"""
+        while True:
+            time.sleep(self.watch_interval)
+            # a check is only queued once the last one has run, so they never pile up
+            if self.ft.subscriber and not self.watch_queued:
+                self.watch_queued = True
+                self.run_file_job(self.send_changes, priority=Priority.CONTROL)
+
+    def send_changes(self):
+        """Checks our files for changes and queues them to be sent once they have settled down
+            (runs on the file worker)"""
+        self.watch_queued = False
+        now = time.monotonic()
+        deep = now - self.last_deep_watch >= self.deep_watch_interval
+        if deep:
+            self.last_deep_watch = now
+        changed = self.local_files.changes(self.path, deep)
+        # the names are relative to our shared folder, like the ones in our file list
+        self.notifier.add(str(path.relative_to(self.path)).encode() for path in changed)
+        file_names = self.notifier.due()
+        if file_names:
+            self.network.send(self.ft.send_changes, file_names, priority=Priority.CONTROL)
+
+    def file_size(self, file_names):
+        """:param file_names is a list of names of requested files
+            :return the total size of the files (missing ones count as empty)"""
+        size = 0
+        for file_name in file_names:
+            try:
+                size += os.stat(file_name.decode()).st_size
+            except OSError:
+                pass
+        return size
+
+    def send_file_list(self):
+        """Hashes the local files and queues the list to be sent (runs on the file worker)"""
+        # hashes with whatever algorithm the other user agreed on
+        self.local_files.algorithm = self.ft.hash_algorithm
+        file_list = list(self.local_files.iter_info(self.path, self.lazy_listing()))
+        self.network.send(self.ft.send_file_list, file_list, priority=Priority.CONTROL)
+        self.hash_later(file_list)
+        self.post("file list sent")
 
-        # checks if the frame still exists, if it is, destroys it
-        if self.frame:
-            self.frame.pack_forget()
-            self.frame.destroy()
+    def send_file_list_page(self, cursor, limit):
+        """Hashes the next page of local files and queues it to be sent (runs on the file worker)
+            :param cursor is the page that was asked for (0 for the first)
+            :param limit is the most files to put in the page"""
+        # files are only hashed when their page is reached
+        self.local_files.algorithm = self.ft.hash_algorithm
+        lazy = self.lazy_listing()
+        page = self.list_pager.page(cursor, limit, lambda: (
+            info for info in self.local_files.iter_info(self.path, lazy) if info is not None))
+        self.network.send(self.ft.send_file_list_page, *page, priority=Priority.CONTROL)
+        self.hash_later(page[1])
 
-        # creates new frame after it was destroyed
-        self.frame = Frame(self, height=2000, width=2000)
+    def lazy_listing(self):
+        """:return whether file lists can be sent without waiting for hashing, because the
+            other user can ask for the hashes it needs"""
+        return bool(self.ft.caps.get('lazy'))
 
-        # sets up new buttons that are for file requests
+    def hash_later(self, file_list):
+        """Hashes the files whose hashes were left pending in a file list once there is
+            nothing more urgent to do, so the next list has them (runs on the file worker)
+            :param file_list is the list that was sent"""
         for files in file_list:
-            button = Button(self.frame)
-            button["text"] = files.path.name
-            # requests a file with the file name, file_name
-            button["command"] = lambda file_name = files.path.name.encode(): self.ft.request_file(file_name)
-            button.pack()
-        self.frame.pack()
-        self.pack()
+            if files.hash is None:
+                self.run_file_job(self.local_files.get_info, files.path,
+                                  priority=Priority.BACKGROUND)
+
+    def send_hashes(self, file_names):
+        """Hashes files the other user asked for and queues their hashes to be sent (runs on
+            the file worker)
+            :param file_names is the list of names of the files"""
+        self.local_files.algorithm = self.ft.hash_algorithm
+        file_list = [self.local_files.get_info(pathlib.Path(name.decode())) for name in file_names]
+        self.network.send(self.ft.send_hashes, [files for files in file_list if files is not None],
+                          priority=Priority.USER)
+
+    def send_file(self, file_name):
+        """Reads and encrypts a file and queues it to be sent (runs on the file worker)
+            :param file_name is the name of the requested file"""
+        path = pathlib.Path(file_name.decode())
+        size = path.stat().st_size
+        if self.ft.should_send_sparse(path):
+            # only the parts of sparse files that aren't holes are read and sent
+            self.network.send(self.ft.send_file_sparse, file_name, path,
+                              lambda: Encryptor(self.password), size=size)
+            self.post("file sent")
+            return
+        if self.ft.should_stripe(size):
+            # large files are read and encrypted a range at a time as they are sent
+            self.network.send(self.ft.send_file_striped, file_name, path,
+                              lambda: Encryptor(self.password), size=size)
+            self.post("file sent")
+            return
+        encrypted = self.encrypt_file(path.read_bytes())
+        self.network.send(self.ft.send_file, file_name, encrypted, size=len(encrypted))
+        self.post("file sent")
+
+    def send_files(self, file_names):
+        """Packs, encrypts and queues many files to be sent at once (runs on the file worker)
+            :param file_names is the list of names of the requested files"""
+        # packs all of the files together so they are encrypted and sent only once
+        packed = pack_files((name, pathlib.Path(name.decode()).read_bytes()) for name in file_names)
+        encrypted = self.encrypt_file(packed)
+        self.network.send(self.ft.send_files, encrypted, priority=Priority.BACKGROUND,
+                          size=len(encrypted))
+        self.post("files sent")
 
-    def request_handler(self):
-        """Handles all the requests that are given to each computer"""
+    def receive_files(self, data):
+        """Decrypts and unpacks many received files (runs on the file worker)
+            :param data is the encrypted packed files"""
+        # decrypts the batch once, then writes each file straight out of it, and moves them
+        # all into place together so they are flushed to disk together
+        batch = file_info.CommitBatch(self.durability)
         try:
-            # message_type is a code that determines what type of request is being asked
-            # data is what is in the file or file list
-            message_type, data = self.ft.receive_data()
-            # the types of message types and how to handle each one
-            if message_type == ft_conn.FTProto.REQ_LIST:
-                self.ft.send_file_list(self.local_files.list_info(self.path))
-                print("file list sent")
-            elif message_type == ft_conn.FTProto.REQ_FILE:
-                self.ft.send_file(data, self.encrypt_file(pathlib.Path(data.decode()).read_bytes()))
-                print("file sent")
-            elif message_type == ft_conn.FTProto.RES_LIST:
-                self.update_remote_file_list(data)
-                print("file list received")
-            elif message_type == ft_conn.FTProto.RES_FILE:
-                file_name, file_data = data
-                pathlib.Path(file_name.decode()).write_bytes(self.decrypt_file(file_data))
-                print("file received")
-            elif message_type is not None:
-                print("unknown request")
-        # if an error is given allows our loop to continue but shows the user still
-        except Exception as err:
-            raise err
-        # refreshes the requests ever 10 milliseconds
-        finally:
-            root.after(10, self.request_handler)
+            for file_name, file_data in unpack_files(self.decrypt_file(data)):
+                incoming = file_info.IncomingFile(pathlib.Path(file_name.decode()), len(file_data),
+                                                  self.ft.expected_hash(file_name), batch=batch,
+                                                  algorithm=self.ft.hash_algorithm)
+                incoming.write(file_data)
+                try:
+                    incoming.close()
+                except file_info.IntegrityError as err:
+                    self.post("error: {}".format(err))
+        except Exception:
+            batch.abort()
+            raise
+        batch.commit()
+        self.post("files received")
+
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Share files with another computer.")
+    parser.add_argument("--rate", type=float, metavar="BYTES",
+                        help="limit file contents sent to BYTES per second (default: no limit)")
+    parser.add_argument("--burst", type=int, metavar="BYTES",
+                        help="most bytes sent at once at full speed (default: one second's worth)")
+    args = parser.parse_args()
+    if args.rate is not None and args.rate <= 0:
+        parser.error("--rate must be positive")
+    if args.burst is not None and args.rate is None:
+        parser.error("--burst needs --rate")
 
-root = Tk()
-app = Application(master=root)
-root.after(10, app.request_handler)
-app.mainloop()
+    root = Tk()
+    app = Application(master=root, limiters=rate_limiters(args.rate, args.burst))
+    root.after(10, app.handle_events)
+    app.mainloop()
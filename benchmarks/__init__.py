@@ -0,0 +1,78 @@
+"""Benchmarks for the transfer, hashing and encryption hot paths. Run them
+with `python -m benchmarks` (see `python -m benchmarks --help`).
+
+Each benchmark is a function taking a `quick` flag and yielding results made
+by result(), which the runner writes out as JSON lines so that runs can be
+compared between releases.
+"""
+
+import statistics
+import time
+
+def measure(func, repeat=5, setup=None):
+    """Times a function several times.
+
+    :param func: The function to time. It is passed whatever setup returned.
+    :type func: callable
+
+    :param repeat: How many times to run it.
+    :type repeat: integer
+
+    :param setup: Called (untimed) before each run; its return value is
+        passed to func. If None, func is called without arguments.
+    :type setup: callable
+
+    :return: The time taken by each run, in seconds.
+    :rtype: list of float
+    """
+
+    times = []
+    for _ in range(repeat):
+        if setup is None:
+            start = time.perf_counter()
+            func()
+        else:
+            arg = setup()
+            start = time.perf_counter()
+            func(arg)
+        times.append(time.perf_counter() - start)
+    return times
+
+def result(name, params, times, nbytes=None, items=None):
+    """Summarizes the timings of a single benchmark case.
+
+    :param name: The benchmark's name.
+    :type name: string
+
+    :param params: The parameters of this case (e.g. message size).
+    :type params: dict
+
+    :param times: The time taken by each run, in seconds.
+    :type times: list of float
+
+    :param nbytes: Bytes processed per run, if throughput makes sense.
+    :type nbytes: integer
+
+    :param items: Items (messages, entries, files) processed per run.
+    :type items: integer
+
+    :return: The summary, ready to be serialized as JSON.
+    :rtype: dict
+    """
+
+    median = statistics.median(times)
+    summary = {
+        'name': name,
+        'params': params,
+        'runs': len(times),
+        'median_secs': median,
+        'min_secs': min(times),
+        'max_secs': max(times),
+    }
+    if nbytes is not None:
+        summary['bytes'] = nbytes
+        summary['bytes_per_sec'] = nbytes / median if median else None
+    if items is not None:
+        summary['items'] = items
+        summary['items_per_sec'] = items / median if median else None
+    return summary
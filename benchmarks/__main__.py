@@ -0,0 +1,57 @@
+"""Runs the benchmarks and writes one JSON line per result."""
+
+import argparse
+import json
+import platform
+import subprocess
+import sys
+
+from . import bench_encryption, bench_file_info, bench_sock
+
+MODULES = [bench_sock, bench_file_info, bench_encryption]
+
+def git_revision():
+    """:return: The current git commit, or None outside of a checkout.
+    :rtype: string
+    """
+
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, check=True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    """Parses the command line and runs the selected benchmarks."""
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description=__doc__)
+    parser.add_argument('--quick', action='store_true',
+                        help='run fewer iterations and skip the largest cases')
+    parser.add_argument('--only', metavar='NAME',
+                        help='only run benchmark functions whose name contains NAME')
+    parser.add_argument('--output', metavar='FILE',
+                        help='append results to FILE instead of printing them')
+    args = parser.parse_args()
+
+    environment = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'platform': platform.platform(),
+    }
+
+    out = open(args.output, 'a') if args.output else sys.stdout
+    try:
+        for module in MODULES:
+            for bench in module.BENCHMARKS:
+                if args.only and args.only not in bench.__name__:
+                    continue
+                for res in bench(args.quick):
+                    res['environment'] = environment
+                    out.write(json.dumps(res, sort_keys=True) + '\n')
+                    out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,27 @@
+"""Benchmarks for Encryption throughput."""
+
+import os
+
+from encryption import Encryption
+from . import measure, result
+
+SIZES = [1024, 1 << 20, 16 << 20]
+
+def bench_encryption(quick):
+    """Encrypting and decrypting buffers of several sizes.
+
+    :param quick: Whether to skip the largest buffer.
+    :type quick: boolean
+    """
+
+    for size in SIZES[:2] if quick else SIZES:
+        data = os.urandom(size)
+        encrypted = Encryption(data, 'benchmark').encrypt()
+
+        times = measure(lambda: Encryption(data, 'benchmark').encrypt(), repeat=3)
+        yield result('encrypt', {'size': size}, times, nbytes=size)
+
+        times = measure(lambda: Encryption(encrypted, 'benchmark').decrypt(), repeat=3)
+        yield result('decrypt', {'size': size}, times, nbytes=size)
+
+BENCHMARKS = [bench_encryption]
@@ -0,0 +1,59 @@
+"""Benchmarks for LocalFileInfoBrowser over generated directory trees."""
+
+import random
+import tempfile
+from pathlib import Path
+
+from file_info import LocalFileInfoBrowser
+from . import measure, result
+
+# (directories, files per directory, file size)
+TREES = [(10, 100, 1024), (10, 10, 1 << 20), (100, 100, 256)]
+
+def make_tree(root, dirs, files, size, seed=0):
+    """Fills root with a reproducible tree of files.
+
+    :param root: Directory to fill.
+    :type root: pathlib.Path
+    :param dirs: Number of subdirectories.
+    :type dirs: integer
+    :param files: Number of files in each subdirectory.
+    :type files: integer
+    :param size: Size of each file, in bytes.
+    :type size: integer
+    :param seed: Seed for the file contents.
+    :type seed: integer
+    """
+
+    rand = random.Random(seed)
+    for d in range(dirs):
+        sub = root / 'dir{}'.format(d)
+        sub.mkdir()
+        for f in range(files):
+            (sub / 'file{}'.format(f)).write_bytes(rand.getrandbits(8 * size).to_bytes(size, 'big'))
+
+def bench_refresh(quick):
+    """Cold (empty cache) and warm (nothing changed) refresh of a whole tree.
+
+    :param quick: Whether to skip the largest tree.
+    :type quick: boolean
+    """
+
+    for dirs, files, size in TREES[:2] if quick else TREES:
+        with tempfile.TemporaryDirectory() as tmp:
+            root = Path(tmp)
+            make_tree(root, dirs, files, size)
+            params = {'dirs': dirs, 'files_per_dir': files, 'file_size': size}
+            count = dirs * files
+
+            cold = measure(lambda browser: browser.get_info(root),
+                           setup=LocalFileInfoBrowser, repeat=3)
+            yield result('file_info_refresh_cold', params, cold,
+                         nbytes=count * size, items=count)
+
+            browser = LocalFileInfoBrowser()
+            browser.get_info(root)
+            warm = measure(lambda: browser.get_info(root), repeat=3)
+            yield result('file_info_refresh_warm', params, warm, items=count)
+
+BENCHMARKS = [bench_refresh]
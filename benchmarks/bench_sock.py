@@ -0,0 +1,128 @@
+"""Benchmarks for FTSock message throughput and for sending/receiving file
+lists with FTConn, over real sockets.
+"""
+
+import socket
+import threading
+from pathlib import Path
+
+from file_info import FileInfo
+from ft_conn import FTConn, FTProto
+from ft_conn.ft_sock import FTSock
+from . import measure, result
+
+MESSAGE_SIZES = [64, 4096, 65536, 1 << 20]
+LIST_SIZES = [1000, 10000, 100000, 1000000]
+
+def socketpair():
+    """:return: A connected pair of Unix domain sockets.
+    :rtype: (socket.socket, socket.socket)
+    """
+
+    return socket.socketpair()
+
+def tcp_pair():
+    """:return: A connected pair of loopback TCP sockets.
+    :rtype: (socket.socket, socket.socket)
+    """
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    client = socket.create_connection(listener.getsockname())
+    server, _ = listener.accept()
+    listener.close()
+    return client, server
+
+def transfer(sender, receiver, send, receive):
+    """Runs send() on a background thread while receive() runs here, so that
+    neither side blocks on a full socket buffer.
+
+    :param sender: Passed to send().
+    :param receiver: Passed to receive().
+    :param send: The sending half of the transfer.
+    :type send: callable
+    :param receive: The receiving half of the transfer.
+    :type receive: callable
+    """
+
+    thread = threading.Thread(target=send, args=(sender,))
+    thread.start()
+    receive(receiver)
+    thread.join()
+
+def bench_ftsock(quick):
+    """FTSock.send_rstring()/recv_rstring() throughput across message sizes,
+    over both a socketpair and loopback TCP.
+
+    :param quick: Whether to run a reduced number of iterations.
+    :type quick: boolean
+    """
+
+    total = (8 if quick else 64) << 20
+    for transport, make_pair in (('socketpair', socketpair), ('tcp', tcp_pair)):
+        for size in MESSAGE_SIZES:
+            count = max(1, total // size)
+            if quick:
+                count = min(count, 10000)
+            payload = b'x' * size
+            a, b = make_pair()
+            sender, receiver = FTSock(a), FTSock(b)
+
+            def send(fts, payload=payload, count=count):
+                for _ in range(count):
+                    fts.send_rstring(payload)
+
+            def receive(fts, count=count):
+                for _ in range(count):
+                    fts.recv_rstring()
+
+            times = measure(lambda: transfer(sender, receiver, send, receive),
+                            repeat=3)
+            a.close()
+            b.close()
+            yield result('ftsock_rstring', {'transport': transport, 'size': size},
+                         times, nbytes=count * size, items=count)
+
+def make_file_list(length):
+    """:param length: How many entries to make.
+    :type length: integer
+
+    :return: A synthetic file list.
+    :rtype: list of FileInfo
+    """
+
+    return [FileInfo(path=Path('dir{}/file{}.dat'.format(i % 100, i)),
+                     file_hash=i.to_bytes(32, 'big'),
+                     is_dir=False,
+                     mtime=1500000000000000000 + i)
+            for i in range(length)]
+
+def bench_file_list(quick):
+    """FTConn.send_file_list() and the RES_LIST receive path for lists of
+    1k up to 1M entries.
+
+    :param quick: Whether to skip the largest lists.
+    :type quick: boolean
+    """
+
+    for length in LIST_SIZES[:2] if quick else LIST_SIZES:
+        file_list = make_file_list(length)
+        a, b = socketpair()
+        sender, receiver = FTConn(FTSock(a)), FTConn(FTSock(b))
+
+        def receive(conn):
+            while True:
+                tok, _ = conn.receive_data()
+                if tok == FTProto.RES_LIST:
+                    return
+
+        times = measure(lambda: transfer(sender, receiver,
+                                         lambda conn: conn.send_file_list(file_list),
+                                         receive),
+                        repeat=1 if length >= 1000000 else 3)
+        a.close()
+        b.close()
+        yield result('file_list_send_receive', {'entries': length}, times, items=length)
+
+BENCHMARKS = [bench_ftsock, bench_file_list]
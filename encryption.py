@@ -7,7 +7,12 @@
 :Date: 2018-04-01
 :Version: 2.0
 """
-import rncryptor  # https://github.com/RNCryptor/RNCryptor-python
+import hashlib
+import hmac
+import os
+
+# rncryptor (https://github.com/RNCryptor/RNCryptor-python) is imported when
+# it is first needed, so that importing this module stays cheap.
 
 
 class PasswordError(Exception):
@@ -18,6 +23,13 @@ class DataError(Exception):
     """Raised when data is improper or invalid"""
 
 
+def _binary_post_decrypt_data(data):
+    """Remove the PKCS#7 padding, leaving the data as bytes instead of
+    decoding it as UTF-8, so that binary data (e.g. packed files) survives
+    a round trip."""
+    return data[:-data[-1]]
+
+
 class Encryption:
     """Class that implements cryptographic Password Based Key
     Derivation Function 2 as used in RNCryptor. Function utilizes
@@ -46,6 +58,7 @@ class Encryption:
         :return: The encrypted data
         :rtype: bytes
         """
+        import rncryptor
         cryptor = rncryptor.RNCryptor()
         encrypted_data = cryptor.encrypt(self.data, self.password)
         self.data = encrypted_data
@@ -57,8 +70,10 @@ class Encryption:
         :return: The decrypted data
         :rtype: bytes
         """
+        import rncryptor
         cryptor = rncryptor.RNCryptor()
-        decrypted_data = cryptor.decrypt(self.data, self.password).encode()
+        cryptor.post_decrypt_data = _binary_post_decrypt_data
+        decrypted_data = cryptor.decrypt(self.data, self.password)
         self.data = decrypted_data
 
         return self.data
@@ -84,3 +99,163 @@ class Encryption:
         self._password = new_pass
 
 
+class Decryptor:
+    """Decrypts data encrypted by Encryption.encrypt() a piece at a time, so
+    that large files can be decrypted as they arrive instead of after they
+    have been received in full. The output is not authenticated until
+    finalize() returns, so it should not be trusted before then.
+    """
+
+    # Version, options, encryption salt, HMAC salt and IV
+    HEADER_SIZE = 34
+    HMAC_SIZE = 32
+    BLOCK_SIZE = 16
+
+    def __init__(self, password):
+        """Initialize an instance of Decryptor
+        :param password: The password key to decrypt data
+        :type password: str
+        """
+        if not isinstance(password, str):
+            raise PasswordError("Error: Password must be string")
+
+        self._password = password.encode()
+        self._pending = bytearray()
+        self._cipher = None
+        self._hmac = None
+
+    @staticmethod
+    def plaintext_size_bound(encrypted_size):
+        """The largest the decrypted data could be.
+        :param encrypted_size: The size of the encrypted data
+        :type encrypted_size: int
+        :return: The upper bound on the decrypted size
+        :rtype: int
+        """
+        return max(0, encrypted_size - Decryptor.HEADER_SIZE - Decryptor.HMAC_SIZE - 1)
+
+    def _start(self, header):
+        """Derive the keys from the header, as RNCryptor does"""
+        from Crypto.Cipher import AES
+
+        encryption_key = hashlib.pbkdf2_hmac('sha1', self._password, header[2:10], 10000, 32)
+        hmac_key = hashlib.pbkdf2_hmac('sha1', self._password, header[10:18], 10000, 32)
+        self._cipher = AES.new(encryption_key, AES.MODE_CBC, header[18:34])
+        self._hmac = hmac.new(hmac_key, header, hashlib.sha256)
+
+    def update(self, data):
+        """Decrypt the next piece of the encrypted data.
+        :param data: The next piece of the encrypted data
+        :type data: bytes-like object
+        :return: As much decrypted data as is available so far
+        :rtype: bytes
+        """
+        self._pending += data
+
+        if self._cipher is None:
+            if len(self._pending) < self.HEADER_SIZE:
+                return b''
+            self._start(bytes(self._pending[:self.HEADER_SIZE]))
+            del self._pending[:self.HEADER_SIZE]
+
+        # The HMAC and the final (padded) block have to wait for finalize()
+        ready = len(self._pending) - self.HMAC_SIZE - self.BLOCK_SIZE
+        ready -= ready % self.BLOCK_SIZE
+        if ready <= 0:
+            return b''
+
+        with memoryview(self._pending) as view:
+            cipher_text = view[:ready]
+            self._hmac.update(cipher_text)
+            plain_text = self._cipher.decrypt(cipher_text)
+            cipher_text.release()
+        del self._pending[:ready]
+        return plain_text
+
+    def finalize(self):
+        """Check the HMAC and decrypt the last of the data.
+        :return: The rest of the decrypted data
+        :rtype: bytes
+        """
+        cipher_text = bytes(self._pending[:-self.HMAC_SIZE])
+        if (self._cipher is None or not cipher_text
+                or len(cipher_text) % self.BLOCK_SIZE != 0):
+            raise DataError("Error: Encrypted data is truncated")
+
+        self._hmac.update(cipher_text)
+        if not hmac.compare_digest(self._hmac.digest(), bytes(self._pending[-self.HMAC_SIZE:])):
+            raise DataError("Error: Bad data or wrong password")
+
+        self._pending = bytearray()
+        return _binary_post_decrypt_data(self._cipher.decrypt(cipher_text))
+
+
+class Encryptor:
+    """Encrypts data a piece at a time, producing the same format as
+    Encryption.encrypt(), so that large files can be encrypted as they are
+    read and sent instead of all at once.
+    """
+
+    def __init__(self, password):
+        """Initialize an instance of Encryptor
+        :param password: The password key to encrypt data
+        :type password: str
+        """
+        if not isinstance(password, str):
+            raise PasswordError("Error: Password must be string")
+
+        from Crypto.Cipher import AES
+
+        encryption_salt = os.urandom(8)
+        hmac_salt = os.urandom(8)
+        iv = os.urandom(Decryptor.BLOCK_SIZE)
+        encryption_key = hashlib.pbkdf2_hmac('sha1', password.encode(), encryption_salt, 10000, 32)
+        hmac_key = hashlib.pbkdf2_hmac('sha1', password.encode(), hmac_salt, 10000, 32)
+
+        self._cipher = AES.new(encryption_key, AES.MODE_CBC, iv)
+        self._header = b'\x03\x01' + encryption_salt + hmac_salt + iv
+        self._hmac = hmac.new(hmac_key, self._header, hashlib.sha256)
+        self._pending = bytearray()
+
+    @staticmethod
+    def encrypted_size(size):
+        """How large the encrypted data will be.
+        :param size: The size of the data to encrypt
+        :type size: int
+        :return: The size of the encrypted data
+        :rtype: int
+        """
+        padded = (size // Decryptor.BLOCK_SIZE + 1) * Decryptor.BLOCK_SIZE
+        return Decryptor.HEADER_SIZE + padded + Decryptor.HMAC_SIZE
+
+    def update(self, data):
+        """Encrypt the next piece of the data.
+        :param data: The next piece of the data
+        :type data: bytes-like object
+        :return: As much encrypted data as is available so far
+        :rtype: bytes
+        """
+        self._pending += data
+        ready = len(self._pending) - len(self._pending) % Decryptor.BLOCK_SIZE
+
+        with memoryview(self._pending) as view:
+            plain_text = view[:ready]
+            cipher_text = self._cipher.encrypt(plain_text)
+            plain_text.release()
+        del self._pending[:ready]
+        self._hmac.update(cipher_text)
+
+        header, self._header = self._header, b''
+        return header + cipher_text
+
+    def finalize(self):
+        """Pad and encrypt the last of the data, and add the HMAC.
+        :return: The rest of the encrypted data
+        :rtype: bytes
+        """
+        rem = Decryptor.BLOCK_SIZE - len(self._pending) % Decryptor.BLOCK_SIZE
+        cipher_text = self._cipher.encrypt(bytes(self._pending) + bytes([rem]) * rem)
+        self._hmac.update(cipher_text)
+
+        header, self._header = self._header, b''
+        return header + cipher_text + self._hmac.digest()
@@ -2,4 +2,7 @@
 
 from .data import * #pylint: disable=wildcard-import
 from .local import * #pylint: disable=wildcard-import
-
+from .cache import * #pylint: disable=wildcard-import
+from .incoming import * #pylint: disable=wildcard-import
+from .hashing import * #pylint: disable=wildcard-import
+from .sparse import * #pylint: disable=wildcard-import
@@ -0,0 +1,213 @@
+"""A bounded cache of FileInfo, for LocalFileInfoBrowser. The least recently
+used entries are evicted once the cache is over budget, and can be kept in
+an SQLite index on disk instead, so memory stays flat however many files
+there are.
+"""
+import sqlite3
+import threading
+from collections import OrderedDict
+
+from .data import FileInfo
+
+# Roughly what an entry costs besides its path and hashes, in bytes
+_ENTRY_OVERHEAD = 300
+
+
+
+def _entry_size(path, info):
+    """Estimate how much memory a cache entry takes up."""
+    chunks = len(info.chunks) if info.chunks else 0
+    return _ENTRY_OVERHEAD + len(str(path)) + len(info.hash) * (1 + chunks)
+
+
+class InfoCache:
+    """A dict of paths to FileInfo that evicts the least recently used
+    entries once it holds more than max_entries of them (or more than
+    max_bytes of them, roughly). Files are evicted before directories, so
+    the summaries of directories stay in memory.
+
+    If index is given, evicted entries are written to it, and looked up
+    there when they are missed, as a second tier behind memory. Entries in
+    memory are only written to it by flush().
+
+    It is safe to use from several threads at once: every operation holds
+    one lock over the entries, the budget and the index.
+    """
+
+    def __init__(self, max_entries=100000, max_bytes=None, index=None):
+        """:param max_entries: How many entries to keep in memory, or None
+            for no limit.
+        :type max_entries: integer
+
+        :param max_bytes: Roughly how much memory the entries may take up,
+            or None for no limit.
+        :type max_bytes: integer
+
+        :param index: The path of an SQLite database to keep evicted
+            entries in (created if need be), or None to just forget them.
+        :type index: pathlib.Path
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._files = OrderedDict()
+        self._dirs = OrderedDict()
+        self._bytes = 0
+        # Held by every operation (and re-entered, e.g. by get() storing
+        # what it loaded from the index)
+        self._lock = threading.RLock()
+
+        self._db = None
+        if index is not None:
+            self._db = sqlite3.connect(str(index), check_same_thread=False)
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS info (path TEXT PRIMARY KEY, hash BLOB,'
+                ' is_dir INTEGER, mtime INTEGER, algorithm INTEGER, chunks BLOB)')
+
+
+    def __len__(self):
+        with self._lock:
+            return len(self._files) + len(self._dirs)
+
+
+    def __iter__(self):
+        # Only what is in memory
+        with self._lock:
+            return iter(list(self._files) + list(self._dirs))
+
+
+    def __contains__(self, path):
+        return self.get(path) is not None
+
+
+    def __getitem__(self, path):
+        info = self.get(path)
+        if info is None:
+            raise KeyError(path)
+        return info
+
+
+    def __setitem__(self, path, info):
+        with self._lock:
+            self.pop(path, None, _from_index=False)
+            (self._dirs if info.is_dir else self._files)[path] = info
+            self._bytes += _entry_size(path, info)
+            self.__evict()
+
+
+    def __delitem__(self, path):
+        if self.pop(path, None) is None:
+            raise KeyError(path)
+
+
+    def get(self, path, default=None):
+        """Look up an entry, from memory or else from the index, marking it
+        as the most recently used.
+
+        :param path: The path of the file.
+        :type path: pathlib.Path
+
+        :param default: What to return if there is no entry.
+
+        :returns: The entry for path, or default.
+        :rtype: FileInfo
+        """
+        with self._lock:
+            for entries in (self._files, self._dirs):
+                if path in entries:
+                    entries.move_to_end(path)
+                    return entries[path]
+
+            info = self.__load(path)
+            if info is None:
+                return default
+            self[path] = info
+            return info
+
+
+    def pop(self, path, default=None, _from_index=True):
+        """Remove an entry, from memory and from the index.
+
+        :param path: The path of the file.
+        :type path: pathlib.Path
+
+        :param default: What to return if there is no entry.
+
+        :returns: The entry that was removed, or default.
+        :rtype: FileInfo
+        """
+        with self._lock:
+            info = None
+            for entries in (self._files, self._dirs):
+                if path in entries:
+                    info = entries.pop(path)
+                    self._bytes -= _entry_size(path, info)
+            if _from_index and self._db is not None:
+                if info is None:
+                    info = self.__load(path)
+                with self._db:
+                    self._db.execute('DELETE FROM info WHERE path = ?', (str(path),))
+            return default if info is None else info
+
+
+    def flush(self):
+        """Write every entry in memory to the index (if there is one), so
+        that it survives a restart.
+        """
+        with self._lock:
+            if self._db is None:
+                return
+            for entries in (self._files, self._dirs):
+                self.__store(list(entries.items()))
+
+
+    def close(self):
+        """Flush the entries to the index and close it.
+        """
+        with self._lock:
+            if self._db is not None:
+                self.flush()
+                self._db.close()
+                self._db = None
+
+
+    def __evict(self):
+        """Evict entries until the cache is within its budget, least
+        recently used files first (called with _lock held)."""
+        evicted = []
+        while self._files or self._dirs:
+            count = len(self._files) + len(self._dirs)
+            if (self.max_entries is None or count <= self.max_entries) \
+                    and (self.max_bytes is None or self._bytes <= self.max_bytes):
+                break
+            path, info = (self._files or self._dirs).popitem(last=False)
+            self._bytes -= _entry_size(path, info)
+            evicted.append((path, info))
+        if evicted and self._db is not None:
+            self.__store(evicted)
+
+
+    def __store(self, entries):
+        # (Called with _lock held, like __load())
+        with self._db:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO info VALUES (?, ?, ?, ?, ?, ?)',
+                [(str(path), info.hash, info.is_dir, info.mtime, info.algorithm,
+                  b''.join(info.chunks) if info.chunks is not None else None)
+                 for path, info in entries])
+
+
+    def __load(self, path):
+        if self._db is None:
+            return None
+        row = self._db.execute(
+            'SELECT hash, is_dir, mtime, algorithm, chunks FROM info WHERE path = ?',
+            (str(path),)).fetchone()
+        if row is None:
+            return None
+        file_hash, is_dir, mtime, algorithm, chunks = row
+        if chunks is not None:
+            # Chunk hashes are the same size as the root
+            size = len(file_hash)
+            chunks = [chunks[i:i + size] for i in range(0, len(chunks), size)]
+        return FileInfo(path=path, file_hash=file_hash, is_dir=bool(is_dir),
+                        mtime=mtime, algorithm=algorithm, chunks=chunks)
@@ -7,6 +7,8 @@
 
 from base64 import b64encode
 
+from .hashing import SHA256
+
 
 
 class FileInfo:
@@ -23,13 +25,16 @@ class FileInfo:
         application.
     """
 
-    def __init__(self, *, path, file_hash, is_dir, mtime):
+    def __init__(self, *, path, file_hash, is_dir, mtime, algorithm=SHA256.id, chunks=None,
+                 size=None):
         """Initialize a FileInfo
         :param path: The path of the file associated with this FileInfo,
             as a pathlib.Path instance.
         :type path: pathlib.Path
 
-        :param file_hash: A SHA256 digest of the file's contents.
+        :param file_hash: A digest of the file's contents, or None if it
+            has not been worked out yet (see
+            LocalFileInfoBrowser.peek_info()).
         :type file_hash: bytes
 
         :param is_dir: Whether the file is a directory.
@@ -38,11 +43,26 @@ class FileInfo:
         :param mtime: The last modification time of the file, using the
             same convention as st_mtime_ns.
         :type mtime: integer
+
+        :param algorithm: The ID of the hash algorithm file_hash was made
+            with (see hashing.ALGORITHMS).
+        :type algorithm: integer
+
+        :param chunks: For a tree hash, the hash of each chunk of the file
+            (see merkle.py); otherwise None.
+        :type chunks: list of bytes
+
+        :param size: The size of a local file when it was hashed, if known
+            (see LocalFileInfoBrowser); it isn't sent to the other host.
+        :type size: integer
         """
         self.path = path
         self.hash = file_hash
         self.is_dir = is_dir
         self.mtime = mtime
+        self.algorithm = algorithm
+        self.chunks = chunks
+        self.size = size
 
     def __repr__(self):
         """__repr__ for FileInfo
@@ -52,6 +72,6 @@ class FileInfo:
         return '<FileInfo: path=\'{}\' hash={} is_dir={} mtime={}>'\
             .format(
                 self.path,
-                b64encode(self.hash),
+                b64encode(self.hash) if self.hash is not None else None,
                 self.is_dir,
                 self.mtime)
\ No newline at end of file
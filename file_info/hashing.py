@@ -0,0 +1,68 @@
+"""The algorithms file contents can be hashed with, and the IDs they are
+known by in the index and on the wire.
+"""
+import hashlib
+
+from .merkle import CHUNK_SIZE, TreeHash
+
+
+
+class HashAlgorithm:
+    """A hash algorithm that files can be indexed with.
+    """
+    def __init__(self, name, algorithm_id, new, chunk_size=0):
+        """:param name: The name of the algorithm.
+        :type name: string
+
+        :param algorithm_id: The ID the algorithm is known by (in
+            FileInfo.algorithm and on the wire). Must be less than 63.
+        :type algorithm_id: integer
+
+        :param new: Makes a new hash object.
+        :type new: callable
+
+        :param chunk_size: For a tree hash (see merkle.py), the size of the
+            chunks files are split into; 0 if files are hashed as a whole.
+        :type chunk_size: integer
+        """
+        self.name = name
+        self.id = algorithm_id
+        self.chunk_size = chunk_size
+        # Hashes the chunks of a tree hash
+        self.leaf_new = new
+        if chunk_size:
+            self.new = lambda: TreeHash(new, chunk_size)
+        else:
+            self.new = new
+        self.digest_size = new().digest_size
+
+    def __repr__(self):
+        return '<HashAlgorithm: {}>'.format(self.name)
+
+
+SHA256 = HashAlgorithm('sha256', 1, hashlib.sha256)
+BLAKE2B = HashAlgorithm('blake2b', 2, hashlib.blake2b)
+BLAKE2S = HashAlgorithm('blake2s', 3, hashlib.blake2s)
+BLAKE2B_TREE = HashAlgorithm('blake2b-tree', 4, hashlib.blake2b, CHUNK_SIZE)
+
+# Every algorithm, most preferred first. The BLAKE2 hashes are much faster
+# than SHA256 on CPUs without SHA instructions, and a tree hash can use
+# every core on a single large file.
+ALGORITHMS = (BLAKE2B_TREE, BLAKE2B, BLAKE2S, SHA256)
+
+
+def hash_algorithm(algorithm_id):
+    """Look up a hash algorithm by its ID.
+
+    :param algorithm_id: The ID of the algorithm.
+    :type algorithm_id: integer
+
+    :raises KeyError: given an ID that is not in ALGORITHMS.
+
+    :returns: The algorithm.
+    :rtype: HashAlgorithm
+    """
+    for algorithm in ALGORITHMS:
+        if algorithm.id == algorithm_id:
+            return algorithm
+    raise KeyError(algorithm_id)
@@ -0,0 +1,380 @@
+"""Write files received from the other host to disk."""
+import os
+import tempfile
+import threading
+from collections import deque
+
+from .hashing import SHA256
+from .sparse import update_zeros
+
+
+
+class IntegrityError(Exception):
+    """Raised when a received file does not match the hash it was
+    advertised with."""
+
+
+class Durability:
+    """How hard to try to make sure received files survive a crash.
+    """
+
+    # Files are renamed into place, but not flushed to disk. A crash may
+    # lose them (or leave them empty), but never leaves a torn file.
+    NONE = 'none'
+
+    # Each file of a batch is flushed as soon as it is finished, then they
+    # are renamed into place together, then each directory they are in is
+    # flushed once.
+    BATCH = 'batch'
+
+    # Every file is flushed, renamed into place and its directory flushed
+    # on its own, so each one is on disk as soon as it is committed.
+    STRICT = 'strict'
+
+
+def _sync_data(fd):
+    # fdatasync() skips metadata we don't need, but isn't everywhere
+    getattr(os, 'fdatasync', os.fsync)(fd)
+
+
+def _sync_dir(path):
+    # Makes a rename in the directory durable (where the OS allows it)
+    try:
+        fd = os.open(str(path), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _commit(files, durability):
+    """Move finished (flushed and closed) files into place, as durably as
+    asked."""
+    if durability == Durability.STRICT:
+        for incoming in files:
+            os.replace(incoming.temp_path, str(incoming.path))
+            _sync_dir(incoming.path.parent)
+        return
+
+    dirs = []
+    for incoming in files:
+        os.replace(incoming.temp_path, str(incoming.path))
+        if incoming.path.parent not in dirs:
+            dirs.append(incoming.path.parent)
+    if durability == Durability.BATCH:
+        for path in dirs:
+            _sync_dir(path)
+
+
+class CommitBatch:
+    """Received files that are committed (moved into place) together, so
+    that flushing them to disk costs one directory flush for the batch
+    instead of one for every file. The files are closed before they are
+    added, so a batch can hold any number of them.
+    """
+
+    def __init__(self, durability=Durability.BATCH):
+        """:param durability: How to commit the files (see Durability).
+        :type durability: string
+        """
+        self.durability = durability
+        self.files = []
+        self._lock = threading.Lock()
+
+
+    def add(self, incoming):
+        """Add a finished file to the batch (IncomingFile.close() does this
+        for files made with this batch).
+
+        :param incoming: The finished file.
+        :type incoming: IncomingFile
+        """
+        with self._lock:
+            self.files.append(incoming)
+
+
+    def commit(self):
+        """Move every file in the batch into place.
+
+        :returns: The paths of the committed files.
+        :rtype: list of pathlib.Path
+        """
+        with self._lock:
+            files, self.files = self.files, []
+        _commit(files, self.durability)
+        return [incoming.path for incoming in files]
+
+
+    def abort(self):
+        """Remove every file in the batch instead of committing them.
+        """
+        with self._lock:
+            files, self.files = self.files, []
+        for incoming in files:
+            incoming.abort()
+
+
+class IncomingFile:
+    """A file being received, written piece by piece with os.pwrite(),
+    so that it never has to be held in memory.
+
+    The file is written to a temporary file next to its final path, and
+    only renamed into place when it is committed, so a file that is cut
+    short (or turns out to be corrupt) never replaces a good one. Its
+    contents are hashed as they are written, so checking them costs no
+    extra reading.
+    """
+
+    def __init__(self, path, size_hint=0, expected_hash=None,
+                 durability=Durability.NONE, batch=None, extents=None, algorithm=SHA256,
+                 expected_chunks=None):
+        """Create the temporary file and preallocate its space.
+
+        :param path: Where to write the file.
+        :type path: pathlib.Path
+
+        :param size_hint: How large the file is expected to be. This much
+            space is reserved up front (where the filesystem supports it),
+            so the file is not extended on every write; any space that
+            turns out to be unused is given back by close().
+        :type size_hint: integer
+
+        :param expected_hash: The digest the contents should have (as in
+            FileInfo.hash), or None to not check them.
+        :type expected_hash: bytes
+
+        :param durability: How to commit the file when it is closed (see
+            Durability). Ignored if batch is given.
+        :type durability: string
+
+        :param batch: If given, close() adds the file to this batch instead
+            of committing it, and it is moved into place by batch.commit().
+        :type batch: CommitBatch
+
+        :param extents: If given, the file is sparse: size_hint is its
+            exact size, write() fills these (offset, length) extents in
+            order, and the rest of the file is left as holes.
+        :type extents: list of (integer, integer)
+
+        :param algorithm: The hash algorithm expected_hash was made with.
+        :type algorithm: hashing.HashAlgorithm
+
+        :param expected_chunks: For a tree hash, the hashes the chunks of
+            the file should have (as in FileInfo.chunks), so that each one
+            is checked as soon as it (and everything before it) has been
+            written, or None to only check the whole file.
+        :type expected_chunks: list of bytes
+        """
+        self.path = path
+        self.size = 0
+        self.expected_hash = expected_hash
+        self.durability = durability
+        self.batch = batch
+        self._size_lock = threading.Lock()
+
+        fd, self.temp_path = tempfile.mkstemp(
+            dir=str(path.parent), prefix='.{}.'.format(path.name), suffix='.part')
+        self._fd = fd
+        os.fchmod(self._fd, 0o644)
+        if extents is not None:
+            # Extending the file leaves it one big hole, to be filled in
+            os.ftruncate(self._fd, size_hint)
+            self.size = size_hint
+        elif size_hint > 0 and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(self._fd, 0, size_hint)
+            except OSError:
+                # Not supported by this filesystem; just write without it
+                pass
+
+        # The contents are hashed in order. Pieces written further ahead
+        # (by write_at()) are remembered as offset: (end, is_hole), and
+        # hashed once everything before them has been.
+        self._hash = algorithm.new()
+        self._hashed = 0
+        self.expected_chunks = expected_chunks
+        self._checked = 0
+        self._ahead = {}
+        self._hash_lock = threading.Lock()
+
+        self._extents = None
+        if extents is not None:
+            self._extents = deque(extents)
+            offset = 0
+            for start, length in list(extents) + [(size_hint, 0)]:
+                if start > offset:
+                    self._ahead[offset] = (start, True)
+                offset = start + length
+            with self._hash_lock:
+                self.__catch_up()
+
+
+    def write(self, data):
+        """Append data to the file (or, if it is sparse, to its extents).
+
+        :param data: The next piece of the file.
+        :type data: bytes-like object
+        """
+        if self._extents is None:
+            self.write_at(self.size, data)
+            return
+
+        view = memoryview(data)
+        while len(view):
+            if not self._extents:
+                raise ValueError("More data than '{}' has room for".format(self.path))
+            offset, length = self._extents[0]
+            piece = view[:length]
+            self.write_at(offset, piece)
+            view = view[len(piece):]
+            if len(piece) == length:
+                self._extents.popleft()
+            else:
+                self._extents[0] = (offset + len(piece), length - len(piece))
+
+
+    def write_at(self, offset, data):
+        """Write data at a given position in the file. Different parts of
+        the file may be written from different threads at once.
+
+        :param offset: Where in the file to write the data.
+        :type offset: integer
+
+        :param data: The piece of the file that starts at offset.
+        :type data: bytes-like object
+
+        :raises IntegrityError: when a chunk doesn't match expected_chunks
+            (the caller should then abort()).
+        """
+        view = memoryview(data)
+        done = 0
+        while done < len(view):
+            done += os.pwrite(self._fd, view[done:], offset + done)
+        with self._size_lock:
+            self.size = max(self.size, offset + done)
+        if done:
+            self.__hash_piece(offset, view)
+
+
+    def __hash_piece(self, offset, view):
+        """Hash a piece that was just written, if everything before it has
+        been hashed, and then whatever it was holding up."""
+        with self._hash_lock:
+            if offset != self._hashed:
+                self._ahead[offset] = (offset + len(view), False)
+                return
+            self._hash.update(view)
+            self._hashed += len(view)
+            self.__catch_up()
+            self.__check_chunks()
+
+
+    def __check_chunks(self):
+        """Check the chunks that were finished by what was just hashed
+        (called with _hash_lock held)."""
+        if self.expected_chunks is None:
+            return
+        leaves = self._hash.leaves
+        while self._checked < len(leaves):
+            if self._checked >= len(self.expected_chunks) \
+                    or leaves[self._checked] != self.expected_chunks[self._checked]:
+                raise IntegrityError("Chunk {} of '{}' does not match its hash".format(
+                    self._checked, self.path))
+            self._checked += 1
+
+
+    def __catch_up(self):
+        """Hash the pieces that were waiting on what was just hashed (called
+        with _hash_lock held)."""
+        # Pieces written ahead are read back (from the page cache, since
+        # they were only just written) rather than kept in memory
+        while self._hashed in self._ahead:
+            end, is_hole = self._ahead.pop(self._hashed)
+            if is_hole:
+                update_zeros(self._hash, end - self._hashed)
+                self._hashed = end
+                continue
+            while self._hashed < end:
+                piece = os.pread(self._fd, min(end - self._hashed, 1 << 20), self._hashed)
+                if not piece:
+                    break
+                self._hash.update(piece)
+                self._hashed += len(piece)
+
+
+    def chunk_digests(self):
+        """
+        :returns: For a tree hash, the hash of each chunk of the contents
+            written so far, or None if there is a gap in them (or the hash
+            is not a tree hash).
+        :rtype: list of bytes
+        """
+        with self._hash_lock:
+            if self._hashed != self.size or not hasattr(self._hash, 'chunk_digests'):
+                return None
+            return self._hash.chunk_digests()
+
+
+    def digest(self):
+        """
+        :returns: The digest of the contents written so far, or None
+            if there is a gap in them.
+        :rtype: bytes
+        """
+        with self._hash_lock:
+            if self._hashed != self.size:
+                return None
+            return self._hash.digest()
+
+
+    def close(self):
+        """Finish writing the file, check it against the expected hash, and
+        commit it (or add it to its batch).
+
+        :returns: The path of the finished file (where it will be once its
+            batch is committed, if it has one).
+        :rtype: pathlib.Path
+
+        :raises IntegrityError: when the contents don't match the expected
+            hash (the file is removed, leaving whatever was at path before).
+        """
+        durability = self.durability if self.batch is None else self.batch.durability
+        try:
+            os.ftruncate(self._fd, self.size)
+        except OSError:
+            self.abort()
+            raise
+
+        if self.expected_hash is not None and self.digest() != self.expected_hash:
+            self.abort()
+            raise IntegrityError("'{}' does not match its hash".format(self.path))
+
+        # Flushed and closed now rather than when committed, so that a
+        # batch doesn't hold a descriptor open for every file in it
+        try:
+            if durability != Durability.NONE:
+                _sync_data(self._fd)
+        except OSError:
+            self.abort()
+            raise
+        os.close(self._fd)
+        self._fd = None
+
+        if self.batch is not None:
+            self.batch.add(self)
+        else:
+            _commit([self], self.durability)
+        return self.path
+
+
+    def abort(self):
+        """Give up on the file, removing whatever was written so far.
+        """
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        os.unlink(self.temp_path)
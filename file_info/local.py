@@ -3,10 +3,13 @@ Authors: Chris van Zomeren
 
 :Date: 2018-03-07
 """
-from hashlib import sha256
-from os import fsencode
+from hashlib import blake2b
+from os import fsencode, scandir
 
 from file_info import FileInfo
+from .cache import InfoCache
+from .hashing import SHA256
+from .sparse import hash_file, hash_file_chunks
 
 
 
@@ -37,15 +40,29 @@ class LocalFileInfoBrowser:
 
     # Files which are deleted on disk may have their information
     # still left in the cache until one of the refresh methods
-    # is called with that specific path, or until refreshAll() is called.
+    # is called with that specific path, or until it is evicted
+    # (the cache only keeps the most recently used entries).
     # This should not be a problem, since
     # a) is_possibly_changed() will be true for a deleted file,
     #     so deleted files _will_ be refreshed when needed.
     # b) listings of directory contents are not cached,
     #     so deleted files will _not_ be included by mistake.
 
-    def __init__(self):
-        self._cache = dict()
+    def __init__(self, algorithm=SHA256, cache=None):
+        """:param algorithm: The hash algorithm to index files with. It can
+            be changed later; entries hashed with another one are then
+            treated as changed.
+        :type algorithm: hashing.HashAlgorithm
+
+        :param cache: Where to keep the information about files, e.g. an
+            InfoCache with an index on disk. A new InfoCache with the
+            default budget if None or missing.
+        :type cache: cache.InfoCache
+        """
+        self._cache = InfoCache() if cache is None else cache
+        self.algorithm = algorithm
+        # The last snapshot taken by changes(), for each directory watched
+        self._snapshots = {}
 
 
     def get_fresh_hash(self, path):
@@ -59,12 +76,13 @@ class LocalFileInfoBrowser:
 
         :raises UnrecognizedSpecialFile: given a path that is not a regular file or directory.
 
-        :returns: A SHA256 digest of the file contents.
+        :returns: A digest of the file contents (made with self.algorithm).
         :rtype: bytes
         """
-        file_hash = sha256()
+        file_hash = self.algorithm.new()
         if path.is_file():
-            file_hash.update(path.read_bytes())
+            # Read a piece at a time, skipping holes in sparse files
+            return hash_file(path, self.algorithm)
         elif path.is_dir():
             for info in sorted(self.list_info(path), key=lambda _: _.path.name):
                 file_hash.update(fsencode(info.path.name))
@@ -89,6 +107,7 @@ class LocalFileInfoBrowser:
         """
         return (
             path not in self._cache
+            or self._cache[path].algorithm != self.algorithm.id
             or not path.exists()
             or path.is_dir() and any(
                 (self.is_possibly_changed(f_path) for f_path in path.iterdir()))
@@ -106,13 +125,30 @@ class LocalFileInfoBrowser:
         :type path: pathlib.Path
         """
         if path.exists():
+            chunks = size = None
+            if self.algorithm.chunk_size and path.is_file():
+                # The chunks are hashed in parallel, and their hashes kept,
+                # so that if the file is only appended to, the chunks before
+                # the end aren't read again
+                old = self._cache.get(path)
+                previous = None
+                if old is not None and old.algorithm == self.algorithm.id \
+                        and old.chunks and old.size is not None:
+                    previous = (old.chunks, old.size)
+                size = path.stat().st_size
+                file_hash, chunks = hash_file_chunks(path, self.algorithm, previous=previous)
+            else:
+                file_hash = self.get_fresh_hash(path)
             self._cache[path] = FileInfo(
                 path = path,
                 is_dir = path.is_dir(),
                 mtime = path.stat().st_mtime_ns,
-                file_hash = self.get_fresh_hash(path))
+                file_hash = file_hash,
+                algorithm = self.algorithm.id,
+                chunks = chunks,
+                size = size)
         else:
-            del self._cache[path]
+            self._cache.pop(path, None)
 
 
     def force_refresh(self, path):
@@ -144,6 +180,38 @@ class LocalFileInfoBrowser:
         return self._cache.get(path)
 
 
+    def peek_info(self, path):
+        """Get a FileInfo instance representing the file at path without
+        hashing it. If the cached hash may be out of date (or there is
+        none), the hash is left as None, to be worked out later by
+        get_info().
+
+        :param path: The path of the file.
+        :type path: pathlib.Path
+
+        :returns: A summary of the file at path, or None if it is gone.
+        :rtype: FileInfo
+        """
+        info = self._cache.get(path)
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            return None
+        if info is not None and info.algorithm == self.algorithm.id \
+                and stat.st_mtime_ns <= info.mtime \
+                and not (info.is_dir and self.is_possibly_changed(path)):
+            return info
+        return FileInfo(path=path, file_hash=None, is_dir=path.is_dir(),
+                        mtime=stat.st_mtime_ns, algorithm=self.algorithm.id)
+
+
+    def flush(self):
+        """Write the cached information to the cache's index on disk (if
+        it has one), so that it need not be hashed again after a restart.
+        """
+        self._cache.flush()
+
+
     def list_info(self, path):
         """Get a list of FileInfo instances representing all the files
         in the directory at path.
@@ -154,5 +222,113 @@ class LocalFileInfoBrowser:
         :returns: A summary of all files in the directory at path.
         :rtype: list of FileInfo
         """
-        return [self.get_info(f_path) for f_path in path.iterdir()]
+        return list(self.iter_info(path))
+
 
+    def iter_info(self, path, lazy=False):
+        """Get FileInfo instances representing the files in the directory
+        at path one at a time, each hashed (if need be) only when it is
+        reached, so the first ones are ready without waiting on the rest.
+
+        :param path: The path of the directory to list files of.
+        :type path: pathlib.Path
+
+        :param lazy: If true, nothing is hashed: files whose hash isn't
+            cached have None for it (see peek_info()), and files that are
+            gone are left out.
+        :type lazy: boolean
+
+        :returns: A summary of each file in the directory at path.
+        :rtype: generator of FileInfo
+        """
+        for f_path in path.iterdir():
+            if not lazy:
+                yield self.get_info(f_path)
+                continue
+            info = self.peek_info(f_path)
+            if info is not None:
+                yield info
+
+
+    def changes(self, path, deep=True):
+        """Find the files in the directory at path which were added,
+        modified or removed since the last call with the same path.
+        Nothing is hashed: a file counts as modified when its size or
+        mtime is different, and a directory when anything inside it is.
+        The first call only takes a snapshot to compare later calls with.
+
+        Only the directory's own entries are kept (a directory's contents
+        are summed up in one digest), and this only touches the snapshots,
+        so it can run alongside the other methods (but not alongside
+        another call to itself).
+
+        :param path: The path of the directory to watch.
+        :type path: pathlib.Path
+
+        :param deep: Whether to look inside every directory. If false, only
+            directories whose own mtime changed (i.e. entries were added to
+            or removed from them) are looked inside, which is much cheaper
+            for a large tree, but misses files modified deeper down until
+            the next deep call.
+        :type deep: boolean
+
+        :returns: The paths of the changed files in the directory (not
+            of the files inside changed directories), as in list_info().
+        :rtype: set of pathlib.Path
+        """
+        last = self._snapshots.get(path)
+        snapshot = {}
+        for f_path in path.iterdir():
+            old = last.get(f_path) if last is not None else None
+            snapshot[f_path] = self._snapshot(f_path, old, deep or last is None)
+        self._snapshots[path] = snapshot
+        if last is None:
+            return set()
+        return {f_path for f_path in snapshot.keys() | last.keys()
+                if snapshot.get(f_path) != last.get(f_path)}
+
+
+    @staticmethod
+    def _snapshot(path, old=None, deep=True):
+        """Get what changes() compares for the file located at path: its
+        size and mtime, and for a directory, its mtime and a digest of the
+        sizes and mtimes of everything inside it.
+
+        :param path: The path of the file.
+        :type path: pathlib.Path
+
+        :param old: What this returned for the file last time, if anything.
+        :type old: tuple
+
+        :param deep: Whether to look inside a directory even if its mtime
+            is the same as in old (in which case old's digest is kept).
+        :type deep: boolean
+
+        :returns: A value which differs if the file has changed, or None if
+            it is gone.
+        :rtype: tuple
+        """
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            return None
+        if not path.is_dir():
+            return stat.st_size, stat.st_mtime_ns
+        if not deep and old is not None and old[0] == stat.st_mtime_ns and len(old) == 3:
+            return old
+
+        digest = blake2b(digest_size=16)
+        pending = [path]
+        while pending:
+            with scandir(pending.pop()) as entries:
+                # Sorted, since the order entries are listed in may change
+                for entry in sorted(entries, key=lambda entry: entry.name):
+                    try:
+                        entry_stat = entry.stat(follow_symlinks=False)
+                    except FileNotFoundError:
+                        continue
+                    digest.update(fsencode(entry.path) + b'\0' + str(
+                        (entry_stat.st_size, entry_stat.st_mtime_ns)).encode())
+                    if entry.is_dir(follow_symlinks=False):
+                        pending.append(entry.path)
+        return stat.st_mtime_ns, stat.st_size, digest.digest()
@@ -0,0 +1,107 @@
+"""Tree hashes of files split into fixed-size chunks. Each chunk is hashed
+on its own (so the chunks of a large file can be hashed in parallel, and
+checked one at a time as they arrive), and the file's digest is the root
+of a binary Merkle tree over the chunk hashes.
+"""
+
+# Hashed before the contents of a chunk and the children of a node, so that
+# the two can never be mistaken for each other
+_LEAF = b'\x00'
+_NODE = b'\x01'
+
+# The size of the chunks files are split into
+CHUNK_SIZE = 4 << 20
+
+
+
+def new_leaf(new):
+    """Start hashing a chunk.
+
+    :param new: Makes a new hash object of the underlying algorithm.
+    :type new: callable
+
+    :returns: A hash object, to be fed the chunk's contents.
+    :rtype: hashlib hash object
+    """
+    leaf = new()
+    leaf.update(_LEAF)
+    return leaf
+
+
+def merkle_root(new, leaves):
+    """Get the root of the tree over some chunk hashes. Pairs of hashes are
+    hashed together, level by level, and an odd one out at the end of a
+    level is moved up as it is.
+
+    :param new: Makes a new hash object of the underlying algorithm.
+    :type new: callable
+
+    :param leaves: The hashes of the chunks, in order (at least one).
+    :type leaves: list of bytes
+
+    :returns: The root digest.
+    :rtype: bytes
+    """
+    level = list(leaves)
+    while len(level) > 1:
+        level = [new(_NODE + level[i] + level[i + 1]).digest() if i + 1 < len(level)
+                 else level[i]
+                 for i in range(0, len(level), 2)]
+    return level[0]
+
+
+class TreeHash:
+    """Works out a tree hash from the file's contents fed in order, like a
+    hashlib hash object.
+    """
+    def __init__(self, new, chunk_size=CHUNK_SIZE):
+        """:param new: Makes a new hash object of the underlying algorithm
+            (e.g. hashlib.blake2b).
+        :type new: callable
+
+        :param chunk_size: The size of the chunks.
+        :type chunk_size: integer
+        """
+        self._new = new
+        self.chunk_size = chunk_size
+        self.digest_size = new().digest_size
+        self.leaves = []
+        self._chunk = new_leaf(new)
+        self._filled = 0
+
+
+    def update(self, data):
+        """Feed the next piece of the contents.
+
+        :param data: The next piece.
+        :type data: bytes-like object
+        """
+        view = memoryview(data)
+        while len(view):
+            piece = view[:self.chunk_size - self._filled]
+            self._chunk.update(piece)
+            self._filled += len(piece)
+            view = view[len(piece):]
+            if self._filled == self.chunk_size:
+                self.leaves.append(self._chunk.digest())
+                self._chunk = new_leaf(self._new)
+                self._filled = 0
+
+
+    def chunk_digests(self):
+        """
+        :returns: The hash of every chunk so far, including the last one
+            even if it is short (an empty file has a single empty chunk).
+        :rtype: list of bytes
+        """
+        if self._filled or not self.leaves:
+            return self.leaves + [self._chunk.digest()]
+        return list(self.leaves)
+
+
+    def digest(self):
+        """
+        :returns: The root digest of the contents so far.
+        :rtype: bytes
+        """
+        return merkle_root(self._new, self.chunk_digests())
@@ -0,0 +1,182 @@
+"""Find the holes in sparse files, so that they don't have to be read (or
+sent, or written) as if they were full of zeros.
+"""
+import errno
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from .hashing import SHA256
+from .merkle import merkle_root, new_leaf
+
+# Fed to hashes in place of holes
+_ZEROS = bytes(1 << 20)
+
+
+
+def is_sparse(path):
+    """Determine whether a file has holes (i.e. takes up less space on
+    disk than its size).
+
+    :param path: The path of the file.
+    :type path: pathlib.Path
+
+    :returns: Whether the file is sparse.
+    :rtype: boolean
+    """
+    stat = path.stat()
+    return getattr(stat, 'st_blocks', None) is not None \
+        and stat.st_blocks * 512 < stat.st_size
+
+
+def data_extents(fd, size):
+    """Find the parts of a file that hold data, using SEEK_DATA and
+    SEEK_HOLE. Everything between them is a hole (reading as zeros).
+    Where the OS or filesystem can't tell, the whole file is data.
+
+    :param fd: An open file descriptor for the file.
+    :type fd: integer
+
+    :param size: The size of the file.
+    :type size: integer
+
+    :returns: The (offset, length) of each extent of data, in order.
+    :rtype: generator of (integer, integer)
+    """
+    if not hasattr(os, 'SEEK_DATA'):
+        if size:
+            yield 0, size
+        return
+
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as ex:
+            if ex.errno == errno.ENXIO:
+                # Nothing but a hole from here to the end
+                return
+            # Not supported here
+            yield offset, size - offset
+            return
+        if start >= size:
+            return
+        end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+        yield start, end - start
+        offset = end
+
+
+def update_zeros(file_hash, length):
+    """Feed a run of zeros (i.e. a hole) to a hash.
+
+    :param file_hash: The hash to update.
+    :type file_hash: hashlib hash object
+
+    :param length: How many zeros.
+    :type length: integer
+    """
+    zeros = memoryview(_ZEROS)
+    while length > 0:
+        file_hash.update(zeros[:min(length, len(zeros))])
+        length -= len(zeros)
+
+
+def hash_file(path, algorithm=SHA256):
+    """Get the digest of a file's contents, reading only its data extents.
+    Holes are hashed as the zeros they stand for, so the digest is the same
+    as for the dense file.
+
+    :param path: The path of the file.
+    :type path: pathlib.Path
+
+    :param algorithm: The hash algorithm to use.
+    :type algorithm: hashing.HashAlgorithm
+
+    :returns: A digest of the file contents.
+    :rtype: bytes
+    """
+    if algorithm.chunk_size:
+        return hash_file_chunks(path, algorithm)[0]
+
+    file_hash = algorithm.new()
+    fd = os.open(os.fspath(path), os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        _hash_range(fd, list(data_extents(fd, size)), 0, size, file_hash)
+    finally:
+        os.close(fd)
+    return file_hash.digest()
+
+
+def hash_file_chunks(path, algorithm, workers=None, previous=None):
+    """Get the tree hash of a file's contents (see merkle.py), hashing its
+    chunks in parallel. Holes are skipped as in hash_file().
+
+    :param path: The path of the file.
+    :type path: pathlib.Path
+
+    :param algorithm: A tree hash algorithm (with a chunk_size).
+    :type algorithm: hashing.HashAlgorithm
+
+    :param workers: How many chunks to hash at once (the number of CPUs if
+        None or missing).
+    :type workers: integer
+
+    :param previous: The hashes of the file's chunks and its size when it
+        was last hashed, if known. If it has only been appended to since
+        (it has grown, and what was its last chunk is still there as it
+        was), the whole chunks before that are not read again.
+    :type previous: (list of bytes, integer)
+
+    :returns: The root digest, and the hash of each chunk.
+    :rtype: (bytes, list of bytes)
+    """
+    chunk_size = algorithm.chunk_size
+    fd = os.open(os.fspath(path), os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        extents = list(data_extents(fd, size))
+
+        def hash_chunk(start, end=None):
+            leaf = new_leaf(algorithm.leaf_new)
+            if end is None:
+                end = min(start + chunk_size, size)
+            _hash_range(fd, extents, start, end, leaf)
+            return leaf.digest()
+
+        known = []
+        if previous is not None:
+            old_chunks, old_size = previous
+            last = (len(old_chunks) - 1) * chunk_size
+            if old_size < size and old_chunks and last < old_size <= last + chunk_size \
+                    and hash_chunk(last, old_size) == old_chunks[-1]:
+                known = old_chunks[:old_size // chunk_size]
+
+        starts = range(len(known) * chunk_size, max(size, 1), chunk_size)
+        if len(starts) == 1:
+            leaves = known + [hash_chunk(starts[0])]
+        else:
+            # hashlib lets go of the GIL while hashing, so threads are enough
+            with ThreadPoolExecutor(workers or os.cpu_count()) as pool:
+                leaves = known + list(pool.map(hash_chunk, starts))
+    finally:
+        os.close(fd)
+    return merkle_root(algorithm.leaf_new, leaves), leaves
+
+
+def _hash_range(fd, extents, start, end, file_hash):
+    """Feed the part of a file from start to end to a hash, reading only
+    its data extents."""
+    done = start
+    for offset, length in extents:
+        offset, extent_end = max(offset, done), min(offset + length, end)
+        if offset >= extent_end:
+            continue
+        update_zeros(file_hash, offset - done)
+        while offset < extent_end:
+            piece = os.pread(fd, min(extent_end - offset, 1 << 20), offset)
+            if not piece:
+                break
+            file_hash.update(piece)
+            offset += len(piece)
+        done = offset
+    update_zeros(file_hash, end - done)
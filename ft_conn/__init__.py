@@ -3,52 +3,242 @@ ft_sock to provide network functionality.
 """
 
 import enum
-from pathlib import Path
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
 from socket import timeout
-from file_info import FileInfo
+from time import perf_counter
+from file_info import ALGORITHMS, SHA256, data_extents, is_sparse
+from .ft_proto import FTProto, FRAMED_VERSION
+from .ft_codec import Encoder, encode_entries, BOOL, INT, LONG, ULONG, DOUBLE, SIZE_COUNT, EXTENT, \
+    CURSORS, CURSOR_LIMIT
+from .ft_parser import FTParser, Start, Body
 from .ft_sock import FTSock
-from .ft_error import UnexpectedValueError
-
-class FTProto:
-    """Internally used to define control tokens for data transmission.
-    """
-
-    # Used to request the remote filelist.
-    REQ_LIST = b'l'
-
-    # Used to request a file. Following is a string of the file name/path
-    REQ_FILE = b'f'
-
-    # Used to send the filelist. Following is a '!i' representing the
-    # number of entries, and then each entry is sent as a string (path),
-    # '!32s?i' (hash digest, is_dir, and mtime int).
-    RES_LIST = b'L'
-
-    # Used to send the file. Following is a raw string of the contents of the file
-    RES_FILE = b'F'
+from .ft_stats import StatsDumper
+from .ft_error import UnexpectedValueError, BrokenSocketError
 
 class FTConn:
     """Provides useful network functionality to be called by the UI.
     """
 
     # Keeps track of network versions. This is sent during the handshake,
-    # to ensure compatibility
-    _network_version = 1
+    # to ensure compatibility: the version used is the lower of ours and
+    # the other host's, as long as it is at least _min_network_version.
+    # Messages are framed from version 3 on (see ft_proto.FRAME_HEADER).
+    _network_version = 3
+    _min_network_version = 2
 
     # Sent as handshake to make sure the other host is actually running
     # the program (response is it reversed). Must be 8 chars.
     _handshake_string = b'FTProtoW'
 
-    def __init__(self, fts=None):
+    # Files at least this large are striped over the data connections
+    stripe_threshold = 64 << 20
+
+    # Size of each range of a striped file
+    stripe_size = 8 << 20
+
+    # Range of delays between reconnection attempts, in seconds (the delay
+    # doubles after each failed attempt)
+    reconnect_min_delay = 0.1
+    reconnect_max_delay = 10
+
+    # Time between PINGs measuring the round trip time, in seconds (only
+    # sent if the other host supports them)
+    heartbeat_interval = 5
+
+    # Bounds on the size of the pieces bulk data is handled in, and on the
+    # socket buffers, as chosen from the bandwidth-delay product by tune()
+    min_chunk_size = 64 << 10
+    max_chunk_size = 4 << 20
+    max_buffer_size = 32 << 20
+
+    # How many entries to ask for in each page of a paged file list
+    list_page_size = 256
+
+    # The most unanswered requests to remember for sending again after
+    # resuming (the oldest are forgotten first)
+    max_outstanding = 1024
+
+    # The hash algorithms we can index files with (see
+    # file_info.hashing). The one used is the first in ALGORITHMS that both
+    # hosts support.
+    hash_algorithms = ALGORITHMS
+
+    def __init__(self, fts=None, stripes=1):
         """:param fts: FTSock object to use for connections. Constructs
             a new one if None or missing.
             :type fts: FTSock
+
+            :param stripes: How many data connections to open for striping
+                large files (1 means large files are not striped). The
+                number actually used is the smaller of ours and the other
+                host's.
+            :type stripes: integer
         """
         if fts is None:
             self.fts = FTSock()
         else:
             self.fts = fts
 
+        self.stripes = stripes
+        # The capabilities agreed on with the other host during the handshake
+        self.caps = {}
+        # The network version agreed on with the other host during the
+        # handshake (the oldest we speak until then)
+        self.version = self._min_network_version
+        # The extra connections used for striping large files
+        self.data_socks = []
+
+        # Where we last connected to, so that reconnect() can return there
+        self.address = None
+        # Whether receive_data() should call reconnect() by itself when the
+        # connection breaks
+        self.auto_reconnect = False
+
+        # Session state, kept across reconnections when the other host
+        # accepts our session ticket (see reconnect()). The ticket is 0
+        # until a session has been established.
+        self.session_ticket = 0
+        self.resumed = False
+        # The last file list received, and how many have been received
+        self.remote_file_list = None
+        self.list_generation = 0
+        # The entries of a paged file list received so far (see
+        # request_file_list_page())
+        self.pending_list = []
+        # Requests that haven't been answered yet, as ('file', name),
+        # ('files', names), ('hashes', names) or ('list_page', (cursor,
+        # limit)), so that they can be sent again after resuming
+        self.outstanding = []
+        # Whether we asked the other host to tell us when its file list
+        # changes, and whether it asked us to (see subscribe())
+        self.subscribed = False
+        self.subscriber = False
+
+        # What we know about the link: the smoothed and smallest round trip
+        # times in seconds, and the bandwidth in bytes per second (None
+        # until measured)
+        self.rtt = None
+        self.min_rtt = None
+        self.bandwidth = None
+        # When we last sent a PING (by perf_counter())
+        self.last_ping = None
+
+        # Shared with the socket, so that all statistics end up in one place
+        self.metrics = self.fts.metrics
+
+        # If set, called as file_sink(file_name, length) when a RES_FILE
+        # arrives. It must return an object with write(data), close() and
+        # abort() methods, which is fed the contents as they are received
+        # instead of them being collected in memory (each piece is only
+        # valid until write() returns, as the buffer it is in is reused).
+        # receive_data() then returns whatever close() returns in place of
+        # the contents.
+        self.file_sink = None
+
+        # Like file_sink, but for striped files. If set, called as
+        # range_sink(file_name, size) when a RES_STRIPED arrives. It must
+        # return an object with open_range(offset, length), close() and
+        # abort() methods, where open_range() returns an object like the
+        # ones file_sink returns, to be fed the contents of that range
+        # (possibly from several threads at once). Without it, the
+        # (offset, contents) pairs of the ranges are returned instead.
+        self.range_sink = None
+
+        # Like file_sink, but for sparse files. If set, called as
+        # sparse_sink(file_name, length, size, extents) when a RES_SPARSE
+        # arrives, where extents are the (offset, length) pairs of the data
+        # in the file (the rest is holes), and the contents are those of the
+        # extents one after another. Without it, (size, extents, contents)
+        # is returned in place of the contents.
+        self.sparse_sink = None
+
+        # Parses what is received on the main connection, and the state of
+        # the message being received: what its streamed body is written to,
+        # the first error writing it, and when its first bytes arrived
+        self.parser = FTParser(self.caps, self.framed)
+        self.__body = None
+        self.__body_error = None
+        self.__message_start = None
+        # What the main connection receives into, and how much of it has
+        # been fed to the parser
+        self.__recv_buf = None
+        self.__recv_used = 0
+
+    def stats(self):
+        """:return: A snapshot of the transfer statistics: bytes, syscalls
+            and time blocked in the socket, messages sent and received per
+            token, per-message latency and throughput, and handshake time.
+        :rtype: dict
+        """
+
+        return self.metrics.snapshot()
+
+    def start_stats_dump(self, stream, interval=10):
+        """Starts writing a statistics snapshot to a stream as a JSON line
+        every interval seconds.
+
+        :param stream: Where to write the snapshots.
+        :type stream: text file-like object
+
+        :param interval: Time between snapshots, in seconds.
+        :type interval: number
+
+        :return: The dumping thread (call its stop() method to stop it).
+        :rtype: ft_stats.StatsDumper
+        """
+
+        dumper = StatsDumper(self.metrics, stream, interval)
+        dumper.start()
+        return dumper
+
+    @contextmanager
+    def __track(self, direction, token):
+        """Records the message count, latency and throughput of the message
+        sent or received inside the with block.
+
+        :param direction: Either "sent" or "received".
+        :type direction: string
+
+        :param token: The message's token.
+        :type token: raw string
+        """
+
+        start_bytes = self.metrics.counter('bytes_' + direction)
+        start = perf_counter()
+        yield
+        self.__record(direction, token, self.metrics.counter('bytes_' + direction) - start_bytes,
+                      perf_counter() - start)
+
+    def __record(self, direction, token, size, elapsed):
+        """Records the message count, latency and throughput of a message.
+
+        :param direction: Either "sent" or "received".
+        :type direction: string
+
+        :param token: The message's token.
+        :type token: raw string
+
+        :param size: The size of the message, in bytes.
+        :type size: integer
+
+        :param elapsed: How long the message took to send or receive, in
+            seconds.
+        :type elapsed: float
+        """
+
+        name = FTProto.name_of(token)
+        self.metrics.add('messages_{}.{}'.format(direction, name))
+        self.metrics.observe('latency_{}.{}'.format(direction, name), elapsed)
+        if elapsed > 0:
+            self.metrics.observe('throughput_{}.{}'.format(direction, name), size / elapsed)
+            # Only what arrives measures the link: a send returns once the
+            # message has been copied into the socket buffer
+            if direction == 'received' and size >= self.min_chunk_size:
+                self.__observe_bandwidth(size / elapsed)
 
     def __handshake(self, mode):
         """Conducts a handshake to ensure that the other host is running
@@ -67,13 +257,17 @@ class FTConn:
         if mode == "Client":
             self.fts.send_bytes(self._handshake_string)
             self.fts.send_int(self._network_version)
+            self.__send_caps()
 
             alt_hs = self.fts.recv_bytes(8)
             alt_version = self.fts.recv_int()
 
-            if alt_hs != self._handshake_string[::-1] or alt_version != self._network_version:
+            if alt_hs != self._handshake_string[::-1] \
+                    or alt_version < self._min_network_version:
                 return False
 
+            self.__use_version(alt_version)
+            self.__negotiate(self.__recv_caps(), mode)
             return True
 
 
@@ -81,15 +275,100 @@ class FTConn:
             alt_hs = self.fts.recv_bytes(8)
             alt_version = self.fts.recv_int()
 
+            if alt_hs != self._handshake_string or alt_version < self._min_network_version:
+                self.fts.send_bytes(alt_hs[::-1])
+                self.fts.send_int(self._network_version)
+                return False
+
+            self.__use_version(alt_version)
+            # Negotiating first, so that the session ticket we send back
+            # tells the client whether its session was resumed
+            self.__negotiate(self.__recv_caps(), mode)
+
             self.fts.send_bytes(alt_hs[::-1])
             self.fts.send_int(self._network_version)
+            self.__send_caps()
+            return True
 
-            if alt_hs != self._handshake_string or alt_version != self._network_version:
-                return False
+    def __use_version(self, alt_version):
+        self.version = min(self._network_version, alt_version)
+        self.fts.framed = self.framed
 
-            return True
+    @property
+    def framed(self):
+        """:return: Whether messages are sent and received in frames (see
+            ft_proto.FRAME_HEADER), which is the case from network version 3.
+        :rtype: boolean
+        """
+
+        return self.version >= FRAMED_VERSION
+
+    def capabilities(self):
+        """:return: What we support, as sent during the handshake.
+        :rtype: dict of string to integer
+        """
+
+        return {'stripes': self.stripes, 'ticket': self.session_ticket, 'heartbeat': 1,
+                'sparse': 1, 'pages': 1, 'lazy': 1, 'push': 1, 'chunks': 1,
+                'hashes': sum(1 << algorithm.id for algorithm in self.hash_algorithms)}
+
+    def __send_caps(self):
+        caps = self.capabilities()
+        enc = Encoder()
+        enc.pack(INT, len(caps))
+        for name, value in sorted(caps.items()):
+            enc.rstring(name.encode())
+            enc.pack(LONG, value)
+        self.fts.send_bytes(enc.view())
+
+    def __recv_caps(self):
+        caps = {}
+        for _ in range(self.fts.recv_int()):
+            name = self.fts.recv_rstring().decode()
+            caps[name] = self.fts.recv_struct('!q')[0]
+        return caps
+
+    def __negotiate(self, alt_caps, mode):
+        ours = self.capabilities()
+        self.caps = {'stripes': max(1, min(ours['stripes'], alt_caps.get('stripes', 1))),
+                     'heartbeat': min(ours['heartbeat'], alt_caps.get('heartbeat', 0)),
+                     'sparse': min(ours['sparse'], alt_caps.get('sparse', 0)),
+                     'pages': min(ours['pages'], alt_caps.get('pages', 0)),
+                     'lazy': min(ours['lazy'], alt_caps.get('lazy', 0)),
+                     'push': min(ours['push'], alt_caps.get('push', 0)),
+                     'chunks': min(ours['chunks'], alt_caps.get('chunks', 0)),
+                     'hashes': ours['hashes'] & alt_caps.get('hashes', 0)}
+
+        # The server hands out session tickets, and a client resumes its
+        # session by presenting the ticket it was given last time
+        alt_ticket = alt_caps.get('ticket', 0)
+        if mode == "Client":
+            self.resumed = alt_ticket != 0 and alt_ticket == self.session_ticket
+            self.session_ticket = alt_ticket
+        else:
+            self.resumed = alt_ticket != 0 and alt_ticket == self.session_ticket
+            if not self.resumed:
+                self.session_ticket = self._new_ticket()
+
+        if not self.resumed:
+            self.remote_file_list = None
+            self.list_generation = 0
+            self.pending_list = []
+            self.outstanding = []
+            self.subscriber = False
+
+        # Nothing received on an earlier connection carries over
+        self.__abort_body()
 
-    def connect(self, host, port):
+    @staticmethod
+    def _new_ticket():
+        """:return: A new random session ticket.
+        :rtype: integer
+        """
+
+        return random.SystemRandom().getrandbits(63) or 1
+
+    def connect(self, host, port, listen_timeout=300):
         """Initializes the connection to a remote host.
 
         :param host: Host to connect to (usually an IP).
@@ -98,20 +377,235 @@ class FTConn:
         :param port: Port to use for the connection (only applies for server).
         :type port: number
 
+        :param listen_timeout: How long to wait for the other host to connect
+            to us, if it wasn't listening itself, in seconds.
+        :type listen_timeout: number
+
         :return: The status of the connection process (either "Success" or an
             error message).
         :rtype: string
         """
 
-        connected, mode, message = self.fts.connect(host, port)
+        self.address = (host, port)
+        connected, mode, message = self.fts.connect(host, port, listen_timeout)
 
         if connected:
             self.fts.timeout_push(10)
-            if not self.__handshake(mode):
-                message = "Handshake failed"
+            try:
+                start = perf_counter()
+                if not self.__handshake(mode):
+                    message = "Handshake failed"
+                self.metrics.observe('handshake_secs', perf_counter() - start)
+
+                if message == "Success" and self.caps['stripes'] > 1:
+                    self.data_socks = self.fts.connect_data(mode, host, port,
+                                                            self.caps['stripes'])
+            finally:
+                self.fts.timeout_pop()
+            self.fts.close_listener()
 
         return message
 
+    def close(self):
+        """Closes the connection to the other host (including any data
+        connections). The session is kept, so it can be resumed.
+        """
+
+        for fts in self.data_socks:
+            fts.set_socket(None)
+        self.data_socks = []
+        self.fts.close_listener()
+        self.fts.set_socket(None)
+
+    def reconnect(self, attempts=None):
+        """Reconnects to the host we last connected to, retrying with
+        exponential backoff. If the other host resumes our session, any
+        requests that were not answered yet are sent again. If we had
+        subscribed, we subscribe again (whether or not the session was
+        resumed), so that we hear of whatever changed while disconnected.
+
+        Both hosts may be reconnecting at once, so each attempt only listens
+        for the other host for a short, random time before trying to connect
+        to it again.
+
+        :param attempts: How many times to try (None means forever).
+        :type attempts: integer
+
+        :return: The status of the last connection attempt (either "Success"
+            or an error message).
+        :rtype: string
+        """
+
+        host, port = self.address
+        delay = self.reconnect_min_delay
+        message = "Not connected"
+        tries = 0
+        while attempts is None or tries < attempts:
+            tries += 1
+            self.close()
+            start = perf_counter()
+            try:
+                message = self.connect(host, port, listen_timeout=delay * random.uniform(1, 2))
+            except (OSError, BrokenSocketError) as ex:
+                message = str(ex) or type(ex).__name__
+
+            if message == "Success":
+                self.metrics.add('reconnects')
+                self.metrics.observe('reconnect_secs', perf_counter() - start)
+                if self.resumed:
+                    self.metrics.add('sessions_resumed')
+                    self.__replay_outstanding()
+                if self.subscribed and self.caps.get('push'):
+                    self.subscribe()
+                return message
+
+            time.sleep(delay * random.uniform(0.5, 1.5))
+            delay = min(delay * 2, self.reconnect_max_delay)
+
+        return message
+
+    def __note_request(self, kind, names):
+        """Remembers a request until it is answered (see outstanding). The
+        same request made again replaces the earlier one, and so does a new
+        paged listing, so requests that are never answered (e.g. for a file
+        deleted since it was listed) don't pile up.
+        """
+
+        request = (kind, names)
+        if request in self.outstanding:
+            self.outstanding.remove(request)
+        if kind == 'list_page' and names[0] == 0:
+            self.outstanding = [old for old in self.outstanding if old[0] != 'list_page']
+        self.outstanding.append(request)
+        del self.outstanding[:-self.max_outstanding]
+
+    def __replay_outstanding(self):
+        outstanding, self.outstanding = self.outstanding, []
+        for kind, names in outstanding:
+            if kind == 'file':
+                self.request_file(names)
+            elif kind == 'list_page':
+                self.request_file_list_page(*names)
+            elif kind == 'hashes':
+                self.request_hashes(names)
+            else:
+                self.request_files(names)
+
+    def expected_hash(self, file_name):
+        """:param file_name: The name of a file requested from the other
+            host.
+        :type file_name: raw string
+
+        :return: The hash the file was advertised with in the last file
+            list received (or since, by RES_HASH), or None if it wasn't in
+            it or its hash was pending.
+        :rtype: bytes
+        """
+
+        file_info = self.__remote_files.get(file_name)
+        if file_info is None or file_info.algorithm != self.hash_algorithm.id:
+            # Not listed, or made with another algorithm, so we can't check it
+            return None
+        return file_info.hash
+
+    def expected_chunks(self, file_name):
+        """:param file_name: The name of a file requested from the other
+            host.
+        :type file_name: raw string
+
+        :return: The hashes of the file's chunks, as sent by RES_HASH (only
+            if caps['chunks'] was agreed on), or None if we don't have them
+            or can't check them.
+        :rtype: list of bytes
+        """
+
+        file_info = self.__remote_files.get(file_name)
+        if file_info is None or file_info.algorithm != self.hash_algorithm.id:
+            return None
+        return file_info.chunks
+
+    @property
+    def remote_file_list(self):
+        """:return: The last file list received (None until one has
+            been).
+        :rtype: list of FileInfo
+        """
+
+        return self.__remote_file_list
+
+    @remote_file_list.setter
+    def remote_file_list(self, file_list):
+        self.__remote_file_list = file_list
+        # The files in it by name, for expected_hash()
+        self.__remote_files = {str(file_info.path).encode(): file_info
+                               for file_info in file_list or [] if not file_info.is_dir}
+
+    @property
+    def hash_algorithm(self):
+        """:return: The hash algorithm agreed on with the other host (SHA256
+            until connected, or if the other host predates caps['hashes']).
+            File lists are sent with hashes made with it, and received
+            files are checked with it.
+        :rtype: file_info.HashAlgorithm
+        """
+
+        for algorithm in ALGORITHMS:
+            if self.caps.get('hashes', 0) & (1 << algorithm.id):
+                return algorithm
+        return SHA256
+
+    def ping(self):
+        """Sends a PING, to measure the round trip time when the other host
+        answers it. receive_data() sends these by itself every
+        heartbeat_interval seconds.
+        """
+
+        self.last_ping = perf_counter()
+        with self.__track('sent', FTProto.PING), self.fts.frame(FTProto.PING) as enc:
+            enc.pack(DOUBLE, self.last_ping)
+
+    def __observe_rtt(self, rtt):
+        # Smoothed like TCP's, while the smallest one seen is used for
+        # sizing (the others include time the other host was busy)
+        self.rtt = rtt if self.rtt is None else self.rtt + (rtt - self.rtt) / 8
+        self.min_rtt = rtt if self.min_rtt is None else min(self.min_rtt, rtt)
+        self.metrics.observe('rtt_secs', rtt)
+        self.tune()
+
+    def __observe_bandwidth(self, bandwidth):
+        # A message can only be slower than the link, so the fastest recent
+        # one is taken, slowly forgetting old ones in case the link changes
+        if self.bandwidth is None:
+            self.bandwidth = bandwidth
+        else:
+            self.bandwidth = max(bandwidth, self.bandwidth * 0.9)
+        self.tune()
+
+    def tune(self):
+        """Sizes the socket buffers, and the pieces bulk data is handled in,
+        from the bandwidth-delay product: how many bytes are in flight when
+        the connection is kept busy. This is called whenever the round trip
+        time or the bandwidth is measured.
+
+        :return: The bandwidth-delay product in bytes, or None if it isn't
+            known yet.
+        :rtype: integer
+        """
+
+        if self.min_rtt is None or self.bandwidth is None:
+            return None
+
+        bdp = int(self.bandwidth * self.min_rtt)
+        chunk_size = max(self.min_chunk_size, min(self.max_chunk_size, bdp))
+        # Twice the product, so the window isn't what limits us
+        buffer_size = min(self.max_buffer_size, 2 * bdp)
+        for fts in [self.fts] + self.data_socks:
+            fts.chunk_size = chunk_size
+            if buffer_size > (fts.buffer_size or 0):
+                fts.set_buffer_size(buffer_size)
+        self.metrics.observe('bdp_bytes', bdp)
+        return bdp
+
     def send_file(self, file_name, file_data):
         """Sends file contents to other host.
         :param file_name: The file's name
@@ -119,9 +613,172 @@ class FTConn:
         :type file_data: raw string
         """
 
-        self.fts.send_tok(FTProto.RES_FILE)
-        self.fts.send_rstring(file_name)
-        self.fts.send_rstring(file_data)
+        length = 8 + len(file_name) + len(file_data)
+        with self.__track('sent', FTProto.RES_FILE), self.fts.frame(FTProto.RES_FILE, length):
+            self.fts.send_rstring(file_name)
+            self.fts.send_rstring(file_data, bulk=True)
+
+    def send_files(self, packed_data):
+        """Sends the contents of many files to the other host in one message.
+
+        :param packed_data: The files, as packed by ft_pack.pack_files()
+            (and possibly encrypted afterwards).
+        :type packed_data: raw string
+        """
+
+        with self.__track('sent', FTProto.RES_FILES), \
+                self.fts.frame(FTProto.RES_FILES, 4 + len(packed_data)):
+            self.fts.send_rstring(packed_data, bulk=True)
+
+    def should_stripe(self, size):
+        """:param size: The size of a file to send.
+        :type size: integer
+
+        :return: Whether the file should be sent with send_file_striped().
+        :rtype: boolean
+        """
+
+        return bool(self.data_socks) and size >= self.stripe_threshold
+
+    def should_send_sparse(self, path):
+        """:param path: Where a file to send is.
+        :type path: pathlib.Path
+
+        :return: Whether the file should be sent with send_file_sparse().
+        :rtype: boolean
+        """
+
+        return bool(self.caps.get('sparse')) and is_sparse(path)
+
+    def send_file_sparse(self, file_name, path, encryptor=None):
+        """Sends a file to the other host without its holes (found with
+        SEEK_DATA and SEEK_HOLE), so they are neither read, sent nor
+        written, and are recreated as holes by the other host.
+
+        :param file_name: The file's name.
+        :type file_name: raw string
+
+        :param path: Where to read the file from.
+        :type path: pathlib.Path
+
+        :param encryptor: Called with no arguments to get a new object with
+            update(data), finalize() and encrypted_size(size) methods (such
+            as encryption.Encryptor) for the contents. If None, they are
+            sent as they are.
+        :type encryptor: callable
+        """
+
+        fd = os.open(str(path), os.O_RDONLY)
+        try:
+            size = os.fstat(fd).st_size
+            extents = list(data_extents(fd, size))
+            length = sum(extent_length for _, extent_length in extents)
+            enc = encryptor() if encryptor else None
+            if enc:
+                length = enc.encrypted_size(length)
+            header = Encoder()
+            header.rstring(file_name)
+            header.pack(SIZE_COUNT, size, len(extents))
+            for extent in extents:
+                header.pack(EXTENT, *extent)
+            header.pack(ULONG, length)
+
+            with self.__track('sent', FTProto.RES_SPARSE), \
+                    self.fts.frame(FTProto.RES_SPARSE, len(header) + length):
+                self.fts.send_bytes(header.view())
+
+                for offset, extent_length in extents:
+                    self.__send_extent(self.fts, fd, offset, extent_length, enc)
+                if enc:
+                    self.fts.send_bytes(enc.finalize(), bulk=True)
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def __send_extent(fts, fd, offset, length, enc):
+        """Sends part of a file, read a piece at a time (and encrypted with
+        enc, unless it is None).
+        """
+
+        done = 0
+        while done < length:
+            piece = os.pread(fd, min(length - done, fts.chunk_size), offset + done)
+            if not piece:
+                raise UnexpectedValueError("file contents", "end of file")
+            done += len(piece)
+            fts.send_bytes(enc.update(piece) if enc else piece, bulk=True)
+
+    def send_file_striped(self, file_name, path, encryptor=None):
+        """Sends a file to the other host split into ranges, which are sent
+        in parallel over the data connections.
+
+        :param file_name: The file's name.
+        :type file_name: raw string
+
+        :param path: Where to read the file from.
+        :type path: pathlib.Path
+
+        :param encryptor: Called with no arguments to get a new object with
+            update(data), finalize() and encrypted_size(size) methods (such
+            as encryption.Encryptor) for each range. If None, ranges are
+            sent as they are.
+        :type encryptor: callable
+        """
+
+        size = os.stat(str(path)).st_size
+        ranges = [(offset, min(self.stripe_size, size - offset))
+                  for offset in range(0, size, self.stripe_size)]
+
+        with self.__track('sent', FTProto.RES_STRIPED), \
+                self.fts.frame(FTProto.RES_STRIPED) as enc:
+            enc.rstring(file_name)
+            enc.pack(SIZE_COUNT, size, len(ranges))
+
+        count = len(self.data_socks)
+        fd = os.open(str(path), os.O_RDONLY)
+        try:
+            self.__run_striped([
+                (self.__send_ranges, (fts, file_name, fd, ranges[i::count], encryptor))
+                for i, fts in enumerate(self.data_socks)])
+        finally:
+            os.close(fd)
+
+    def __send_ranges(self, fts, file_name, fd, ranges, encryptor):
+        fts.send_tok(FTProto.RES_RANGES)
+        fts.send_rstring(file_name)
+        fts.send_struct('!I', len(ranges))
+
+        for offset, length in ranges:
+            enc = encryptor() if encryptor else None
+            fts.send_struct('!Qi', offset, enc.encrypted_size(length) if enc else length)
+
+            self.__send_extent(fts, fd, offset, length, enc)
+            if enc:
+                fts.send_bytes(enc.finalize(), bulk=True)
+
+    @staticmethod
+    def __run_striped(jobs):
+        """Runs each (function, args) pair on its own thread, and raises the
+        first error any of them raised.
+
+        :param jobs: The functions to run.
+        :type jobs: list of (callable, tuple)
+        """
+
+        errors = []
+        def run(func, args):
+            try:
+                func(*args)
+            except Exception as ex:     # pylint: disable = broad-except
+                errors.append(ex)
+
+        threads = [threading.Thread(target=run, args=job) for job in jobs]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
 
     def send_file_list(self, file_list):
         """Sends the file list after a request.
@@ -131,16 +788,28 @@ class FTConn:
         :type file_list: list of FileInfo
         """
 
-        self.fts.send_tok(FTProto.RES_LIST)
+        with self.__track('sent', FTProto.RES_LIST), self.fts.frame(FTProto.RES_LIST) as enc:
+            encode_entries(enc, file_list, bool(self.caps.get('hashes')))
 
-        list_length = len(file_list)
-        self.fts.send_int(list_length)
+    def send_file_list_page(self, cursor, file_list, next_cursor):
+        """Sends a page of the file list after a request for it (see
+        request_file_list_page() and ft_pages.FTListPager).
 
-        for file_info in file_list:
-            self.fts.send_rstring(str(file_info.path).encode())
-            self.fts.send_struct('!32s?Q', file_info.hash,
-                                 file_info.is_dir,
-                                 file_info.mtime)
+        :param cursor: The cursor of this page (0 if it starts a new listing).
+        :type cursor: integer
+
+        :param file_list: The entries in this page.
+        :type file_list: list of FileInfo
+
+        :param next_cursor: The cursor of the next page, or 0 if this is the
+            last one.
+        :type next_cursor: integer
+        """
+
+        with self.__track('sent', FTProto.RES_LIST_PAGE), \
+                self.fts.frame(FTProto.RES_LIST_PAGE) as enc:
+            enc.pack(CURSORS, cursor, next_cursor)
+            encode_entries(enc, file_list, bool(self.caps.get('hashes')))
 
     def request_file(self, filename):
         """Requests and receives a file from the other host.
@@ -152,8 +821,22 @@ class FTConn:
             not respond to our request properly.
         """
 
-        self.fts.send_tok(FTProto.REQ_FILE)
-        self.fts.send_rstring(filename)
+        self.__note_request('file', filename)
+        with self.__track('sent', FTProto.REQ_FILE), self.fts.frame(FTProto.REQ_FILE) as enc:
+            enc.rstring(filename)
+
+    def request_files(self, filenames):
+        """Requests many files from the other host in a single message.
+
+        :param filenames: The names of the files to request.
+        :type filenames: list of raw string
+        """
+
+        self.__note_request('files', list(filenames))
+        with self.__track('sent', FTProto.REQ_FILES), self.fts.frame(FTProto.REQ_FILES) as enc:
+            enc.pack(INT, len(filenames))
+            for filename in filenames:
+                enc.rstring(filename)
 
     def request_file_list(self):
         """Requests and receives a file list from the other host.
@@ -161,49 +844,420 @@ class FTConn:
         :raises UnexpectedValueError: when the other host does
             not respond to our request properly.
         """
-        self.fts.send_tok(FTProto.REQ_LIST)
+        with self.__track('sent', FTProto.REQ_LIST), self.fts.frame(FTProto.REQ_LIST):
+            pass
+
+    def request_file_list_page(self, cursor=0, limit=None):
+        """Requests a page of the file list from the other host (only if
+        caps['pages'] was agreed on). Unlike a whole file list, the other
+        host sends each page as soon as it has listed it, so the first
+        entries arrive without waiting for the rest of a huge directory.
+        Each RES_LIST_PAGE carries the cursor to ask for next; once the last
+        page arrives, remote_file_list holds the whole list.
+
+        :param cursor: The cursor of the page, or 0 to start a new listing.
+        :type cursor: integer
+
+        :param limit: The most entries to send in the page (list_page_size
+            if None or missing).
+        :type limit: integer
+        """
 
+        if limit is None:
+            limit = self.list_page_size
+        if cursor == 0:
+            self.pending_list = []
+        self.__note_request('list_page', (cursor, limit))
+        with self.__track('sent', FTProto.REQ_LIST_PAGE), \
+                self.fts.frame(FTProto.REQ_LIST_PAGE) as enc:
+            enc.pack(CURSOR_LIMIT, cursor, limit)
 
+    def request_hashes(self, filenames):
+        """Asks the other host for the hashes of files whose hashes were
+        pending in its file list (only if caps['lazy'] was agreed on), or
+        for the hashes of their chunks (only if caps['chunks'] was). The
+        answer updates remote_file_list, so that expected_hash() and
+        expected_chunks() can check the files.
 
-    def __receive_req_list(self):       # pylint: disable = no-self-use
-        print("Received REQ_LIST")
-        return None
+        :param filenames: The names of the files.
+        :type filenames: list of raw string
+        """
 
-    def __receive_req_file(self):
-        fname = self.fts.recv_rstring()
-        print("Received REQ_FILE", fname)
-        return fname
+        self.__note_request('hashes', list(filenames))
+        with self.__track('sent', FTProto.REQ_HASH), self.fts.frame(FTProto.REQ_HASH) as enc:
+            enc.pack(INT, len(filenames))
+            for filename in filenames:
+                enc.rstring(filename)
 
-    def __receive_res_list(self):
-        file_list = []
-        for _ in range(self.fts.recv_int()):
-            path = self.fts.recv_rstring().decode()
-            (hashd, is_dir, mtime) = self.fts.recv_struct('!32s?Q')
+    def send_hashes(self, file_list):
+        """Sends the hashes of files after a request for them (with the
+        hashes of their chunks, if caps['chunks'] was agreed on).
 
-            file_list.append(FileInfo(path=Path(path), file_hash=hashd, is_dir=is_dir, mtime=mtime))
+        :param file_list: The (freshly hashed) entries of the files.
+        :type file_list: list of FileInfo
+        """
 
-        return file_list
+        with self.__track('sent', FTProto.RES_HASH), self.fts.frame(FTProto.RES_HASH) as enc:
+            encode_entries(enc, file_list, bool(self.caps.get('hashes')),
+                           bool(self.caps.get('chunks')))
 
-    def __receive_res_file(self):
-        return self.fts.recv_rstring(), self.fts.recv_rstring()
+    def subscribe(self, subscribed=True):
+        """Asks the other host to tell us (by CHANGED) whenever its file
+        list changes, instead of us requesting it over and over (only if
+        caps['push'] was agreed on). It answers right away with a CHANGED
+        naming no files, so the file list should be requested then.
 
+        :param subscribed: Whether to be told from now on, or to stop being
+            told.
+        :type subscribed: boolean
+        """
+
+        self.subscribed = subscribed
+        with self.__track('sent', FTProto.SUBSCRIBE), self.fts.frame(FTProto.SUBSCRIBE) as enc:
+            enc.pack(BOOL, subscribed)
+
+    def send_changes(self, filenames):
+        """Tells the other host that files in our file list have changed,
+        after it subscribed.
+
+        :param filenames: The names of the files added, modified or removed
+            (none means anything may have changed).
+        :type filenames: list of raw string
+        """
+
+        with self.__track('sent', FTProto.CHANGED), self.fts.frame(FTProto.CHANGED) as enc:
+            enc.pack(INT, len(filenames))
+            for filename in filenames:
+                enc.rstring(filename)
+
+    @property
+    def listing(self):
+        """:return: Whether a paged file list is still being received.
+        :rtype: boolean
+        """
+
+        return any(kind == 'list_page' for kind, _ in self.outstanding)
+
+
+    def __start_body(self, token, header):
+        """Opens what the streamed body of a message is written to: the sink
+        for it if there is one, or else something that collects it in memory.
+
+        :param token: The message's token.
+        :type token: raw string
+
+        :param header: The message's header (see ft_parser.Start).
+        """
+
+        if token == FTProto.RES_FILE and self.file_sink is not None:
+            fname, length = header
+            self.__body = self.file_sink(fname, length)
+        elif token == FTProto.RES_SPARSE and self.sparse_sink is not None:
+            fname, size, extents, length = header
+            self.__body = self.sparse_sink(fname, length, size, extents)
+        else:
+            self.__body = _Collector()
+        self.__body_error = None
+
+    def __write_body(self, data):
+        if self.__body_error is not None:
+            # Keep reading, so we stay in step with the other host
+            return
+        try:
+            self.__body.write(data)
+        except Exception as ex:     # pylint: disable = broad-except
+            self.__body_error = ex
+            self.__body.abort()
+
+    def __finish_body(self):
+        """:return: What the close() of the body's sink returns.
+        """
+
+        body, error = self.__body, self.__body_error
+        self.__body = self.__body_error = None
+        if error is not None:
+            raise error
+        return body.close()
+
+    def __abort_body(self, keep_parser=False):
+        """Abandons the message being received (when the connection is
+        lost, so the rest of it will never arrive, or when it turns out to
+        be malformed).
+
+        :param keep_parser: Whether the parser can carry on with the next
+            message (it skips the rest of a malformed frame).
+        :type keep_parser: boolean
+        """
+
+        if self.__body is not None and self.__body_error is None:
+            self.__body.abort()
+        self.__body = self.__body_error = None
+        self.__message_start = None
+        if not keep_parser:
+            self.parser = FTParser(self.caps, self.framed)
+
+    def __finish_message(self, token, data):
+        """Does whatever a message needs once it has been received.
+
+        :param token: The message's token.
+        :type token: raw string
+
+        :param data: What the parser made of the message.
+
+        :return: The message's contents, as returned by receive_data().
+        """
+
+        if token in (FTProto.REQ_LIST, FTProto.REQ_FILE, FTProto.REQ_FILES,
+                     FTProto.REQ_LIST_PAGE, FTProto.REQ_HASH):
+            print("Received", FTProto.name_of(token))
+
+        if token == FTProto.RES_FILE:
+            return data[0], self.__finish_body()
+        elif token == FTProto.RES_FILES:
+            return self.__finish_body()
+        elif token == FTProto.RES_SPARSE:
+            fname, size, extents, _ = data
+            if isinstance(self.__body, _Collector):
+                return fname, (size, extents, self.__finish_body())
+            return fname, self.__finish_body()
+        elif token == FTProto.RES_STRIPED:
+            return self.__receive_striped(*data)
+        elif token == FTProto.SUBSCRIBE:
+            self.subscriber = data
+            if data:
+                # Whatever the other host has of our file list may be stale
+                self.send_changes([])
+            return data
+        elif token == FTProto.PING:
+            with self.__track('sent', FTProto.PONG), self.fts.frame(FTProto.PONG) as enc:
+                enc.pack(DOUBLE, data)
+            return None
+        elif token == FTProto.PONG:
+            rtt = perf_counter() - data
+            self.__observe_rtt(rtt)
+            return rtt
+        return data
+
+    def __receive_striped(self, fname, size, _):
+        sink = self.range_sink(fname, size) if self.range_sink else None
+        ranges = []
+        try:
+            self.__run_striped([(self.__receive_ranges, (fts, sink, ranges))
+                                for fts in self.data_socks])
+        except Exception as ex:
+            if sink:
+                sink.abort()
+            raise ex
+
+        if sink:
+            return fname, sink.close()
+        return fname, sorted(ranges)
+
+    @staticmethod
+    def __receive_ranges(fts, sink, ranges):
+        tok = fts.recv_bytes(1)
+        if tok != FTProto.RES_RANGES:
+            raise UnexpectedValueError(str(FTProto.RES_RANGES), str(tok))
+        fts.recv_rstring()
+
+        error = None
+        for _ in range(fts.recv_struct('!I')[0]):
+            offset, length = fts.recv_struct('!Qi')
+            if sink is None:
+                ranges.append((offset, fts.recv_bytes(length)))
+                continue
+
+            range_sink = None
+            if error is None:
+                try:
+                    range_sink = sink.open_range(offset, length)
+                except Exception as ex:     # pylint: disable = broad-except
+                    error = ex
+            for chunk in fts.recv_stream(length):
+                if range_sink is None:
+                    # Keep reading, so we stay in step with the other host
+                    continue
+                try:
+                    range_sink.write(chunk)
+                except Exception as ex:     # pylint: disable = broad-except
+                    error = ex
+                    range_sink.abort()
+                    range_sink = None
+            if range_sink is not None:
+                try:
+                    range_sink.close()
+                except Exception as ex:     # pylint: disable = broad-except
+                    error = ex
+                    range_sink.abort()
+        if error is not None:
+            raise error
 
     def receive_data(self):
+        """Receives what has arrived from the other host, without waiting for
+        the rest of a message that has only partly arrived (it is kept, and
+        finished by a later call).
+
+        :return: The token and contents of the next message, or (None, None)
+            if none has been received in full.
+        :rtype: (raw string, object)
+        """
+
+        try:
+            return self.__receive_data()
+        except (BrokenSocketError, ConnectionError):
+            self.__abort_body()
+            if not self.auto_reconnect:
+                raise
+            self.reconnect()
+            return None, None
+
+    def __receive_data(self):
+        if self.caps.get('heartbeat') and self.fts.sock and (
+                self.last_ping is None
+                or perf_counter() - self.last_ping >= self.heartbeat_interval):
+            self.ping()
+
+        self.parser.caps = self.caps
+        while True:
+            try:
+                event = self.parser.next_event()
+            except UnexpectedValueError as ex:
+                # A malformed message (see FTParser)
+                self.__abort_body(keep_parser=self.framed)
+                if self.framed:
+                    # The rest of its frame was skipped, so carry on with
+                    # the next message
+                    print("Skipped a malformed message:", ex)
+                    continue
+                # Without frames there is no finding the start of the next
+                # one, so the connection is no use any more
+                if not self.auto_reconnect:
+                    raise
+                self.reconnect()
+                return None, None
+            if event is None:
+                if not self.__pump():
+                    return None, None
+                continue
+            if self.__message_start is None:
+                self.__message_start = perf_counter()
+
+            if isinstance(event, Start):
+                self.__start_body(event.token, event.header)
+            elif isinstance(event, Body):
+                self.__write_body(event.data)
+            else:
+                break
+
+        recv = event.token
+        try:
+            data = self.__finish_message(recv, event.data)
+        finally:
+            start, self.__message_start = self.__message_start, None
+        size = event.size
+        if recv == FTProto.RES_STRIPED:
+            # The contents came over the data connections
+            size += event.data[1]
+        self.__record('received', recv, size, perf_counter() - start)
+
+        if recv in (FTProto.PING, FTProto.PONG):
+            # Answered here, so there is nothing for the caller to do
+            return None, None
+
+        self.__note_response(recv, data)
+        return recv, data
+
+    def __pump(self):
+        """Feeds the parser whatever has arrived, without waiting.
+
+        :return: Whether anything had arrived.
+        :rtype: boolean
+        """
+
+        buf = self.__recv_buf
+        if not self.parser.buffered:
+            # Everything fed from the buffer has been handled, so it is
+            # received into again from the start
+            self.__recv_used = 0
+            if buf is None or len(buf) != self.fts.chunk_size:
+                buf = self.__recv_buf = memoryview(bytearray(self.fts.chunk_size))
+        elif self.__recv_used == len(buf):
+            # The parser still holds part of a message in it
+            buf = self.__recv_buf = memoryview(bytearray(self.fts.chunk_size))
+            self.__recv_used = 0
+
         self.fts.timeout_push(0)
-        recv = None
         try:
-            recv = self.fts.recv_bytes(1)
+            nrecvd = self.fts.recv_some_into(buf[self.__recv_used:])
         except BlockingIOError:
-            pass
+            return False
+        finally:
+            self.fts.timeout_pop()
 
-        self.fts.timeout_pop()
-        if recv == FTProto.REQ_LIST:
-            return recv, self.__receive_req_list()
-        elif recv == FTProto.REQ_FILE:
-            return recv, self.__receive_req_file()
-        elif recv == FTProto.RES_LIST:
-            return recv, self.__receive_res_list()
-        elif recv == FTProto.RES_FILE:
-            return recv, self.__receive_res_file()
-        else:
-            return recv, None
+        if nrecvd is None:
+            return False
+        if self.__message_start is None:
+            self.__message_start = perf_counter()
+        self.parser.feed(buf[self.__recv_used:self.__recv_used + nrecvd])
+        self.__recv_used += nrecvd
+        return True
+
+    def __note_response(self, recv, data):
+        """Updates the session state after receiving a response.
+        """
+
+        if recv == FTProto.RES_LIST:
+            self.remote_file_list = data
+            self.list_generation += 1
+        elif recv == FTProto.RES_LIST_PAGE:
+            cursor, next_cursor, file_list = data
+            for request in self.outstanding:
+                if request[0] == 'list_page':
+                    self.outstanding.remove(request)
+                    break
+            if cursor == 0:
+                # A new listing (also how an expired cursor is answered)
+                self.pending_list = []
+            self.pending_list.extend(file_list)
+            if next_cursor == 0:
+                self.remote_file_list, self.pending_list = self.pending_list, []
+                self.list_generation += 1
+        elif recv == FTProto.RES_HASH:
+            for request in self.outstanding:
+                if request[0] == 'hashes':
+                    self.outstanding.remove(request)
+                    break
+            hashes = {file_info.path: file_info for file_info in data}
+            for file_list in (self.remote_file_list or [], self.pending_list):
+                for i, file_info in enumerate(file_list):
+                    file_list[i] = hashes.get(file_info.path, file_info)
+            for path, file_info in hashes.items():
+                name = str(path).encode()
+                if name in self.__remote_files and not file_info.is_dir:
+                    self.__remote_files[name] = file_info
+        elif recv in (FTProto.RES_FILE, FTProto.RES_STRIPED, FTProto.RES_SPARSE):
+            if ('file', data[0]) in self.outstanding:
+                self.outstanding.remove(('file', data[0]))
+        elif recv == FTProto.RES_FILES:
+            for request in self.outstanding:
+                if request[0] == 'files':
+                    self.outstanding.remove(request)
+                    break
+
+
+class _Collector:
+    """Collects a streamed body in memory, for when there is no sink for it.
+    """
+
+    def __init__(self):
+        self.pieces = []
+
+    def write(self, data):
+        # (A copy, as data is in a buffer that is received into again)
+        self.pieces.append(bytes(data))
+
+    def close(self):
+        return b''.join(self.pieces)
+
+    def abort(self):
+        self.pieces = []
@@ -0,0 +1,60 @@
+"""Runs a headless node: `python -m ft_conn HOST:PORT --share DIR`."""
+
+import argparse
+import os
+import sys
+
+from . import FTConn
+from .daemon import FTDaemon
+from .ft_rate import rate_limiters
+from .ft_sock import FTSock
+
+def main():
+    """Parses the command line and serves the share until the connection
+    breaks."""
+
+    parser = argparse.ArgumentParser(prog='python -m ft_conn',
+                                     description='Serve a directory to another host without a GUI.')
+    parser.add_argument('address', help='the other host, as IP:PORT')
+    parser.add_argument('--share', default='shared_files',
+                        help='directory to serve (default: shared_files)')
+    parser.add_argument('--password', default=os.environ.get('FT_PASSWORD', ''),
+                        help='encryption password (default: $FT_PASSWORD)')
+    parser.add_argument('--stripes', type=int, default=4,
+                        help='data connections to split large files over (default: 4)')
+    parser.add_argument('--index', metavar='FILE',
+                        help='keep the hashes of the share in this SQLite database')
+    parser.add_argument('--stats', metavar='FILE',
+                        help='append transfer statistics to FILE as JSON lines')
+    parser.add_argument('--rate', type=float, metavar='BYTES',
+                        help='limit file contents sent to BYTES per second (default: no limit)')
+    parser.add_argument('--burst', type=int, metavar='BYTES',
+                        help="most bytes sent at once at full speed (default: one second's worth)")
+    args = parser.parse_args()
+    if args.rate is not None and args.rate <= 0:
+        parser.error('--rate must be positive')
+    if args.burst is not None and args.rate is None:
+        parser.error('--burst needs --rate')
+
+    host, port = args.address.rsplit(':', 1)
+    os.makedirs(args.share, exist_ok=True)
+
+    fts = FTSock(rate_limiters=rate_limiters(args.rate, args.burst))
+    daemon = FTDaemon(args.share, args.password, FTConn(fts, stripes=args.stripes), args.index)
+    # Hash the share while we wait for the other host
+    daemon.start_warming()
+
+    stats = open(args.stats, 'a') if args.stats else None
+    dumper = daemon.ftc.start_stats_dump(stats) if stats else None
+    try:
+        message = daemon.serve(host, int(port))
+    finally:
+        # Write the statistics since the last interval before leaving
+        if dumper is not None:
+            dumper.stop()
+            stats.close()
+    print(message)
+    return 0 if message == "Success" else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,349 @@
+"""Headless node that serves a shared directory to the other host without a
+GUI. Run it with `python -m ft_conn` (see `python -m ft_conn --help`).
+"""
+
+import threading
+import time
+from pathlib import Path
+
+from file_info import FileInfo, InfoCache, LocalFileInfoBrowser
+from . import FTConn, FTProto
+from .ft_notify import FTNotifier
+from .ft_pack import pack_files
+from .ft_pages import FTListPager
+from .ft_sched import FTScheduler, Priority
+
+class FTDaemon:
+    """Answers REQ_LIST, REQ_LIST_PAGE, REQ_HASH, REQ_FILE and REQ_FILES for
+    the files in a shared directory, and pushes CHANGED whenever it changes
+    if the other host subscribed.
+    """
+
+    # Time between looking for changes in the share while the other host
+    # is subscribed, in seconds. Most looks only stat the top of the share
+    # (see LocalFileInfoBrowser.changes()); every deep_watch_interval, the
+    # whole tree is looked through for files modified deeper down.
+    watch_interval = 0.25
+    deep_watch_interval = 30
+
+    def __init__(self, share, password, ftc=None, index=None):
+        """:param share: The directory to serve.
+        :type share: pathlib.Path
+
+        :param password: The password used to encrypt the files sent.
+        :type password: string
+
+        :param ftc: FTConn object to use. Constructs a new one if None
+            or missing.
+        :type ftc: FTConn
+
+        :param index: An SQLite database to keep the hashes of the share
+            in, so that they don't all have to be held in memory (or
+            worked out again after a restart). None to only keep the most
+            recently used ones in memory.
+        :type index: pathlib.Path
+        """
+
+        self.share = Path(share)
+        self.password = password
+        self.ftc = FTConn() if ftc is None else ftc
+        # Warmed with the hash algorithm most likely to be agreed on
+        self.browser = LocalFileInfoBrowser(self.ftc.hash_algorithms[0], InfoCache(index=index))
+        # LocalFileInfoBrowser is not thread-safe, and is shared with warm()
+        self.browser_lock = threading.Lock()
+        self.warm_thread = None
+        # Requests waiting to be answered, most urgent first
+        self.scheduler = FTScheduler()
+        # Paged file lists that are part way through being sent
+        self.pager = FTListPager()
+        # Changes in the share not pushed yet, and when we last looked
+        self.notifier = FTNotifier()
+        self.last_watch = None
+        self.last_deep_watch = None
+
+    def warm(self):
+        """Hashes every file in the share, one entry at a time so that
+        requests can be answered in between.
+        """
+
+        for f_path in list(self.share.iterdir()):
+            with self.browser_lock:
+                self.browser.get_info(f_path)
+        with self.browser_lock:
+            self.browser.flush()
+
+    def start_warming(self):
+        """Starts warm() on a background thread.
+        """
+
+        self.warm_thread = threading.Thread(target=self.warm, daemon=True)
+        self.warm_thread.start()
+
+    def iter_list(self, lazy=False):
+        """Lists the share one entry at a time, hashing each entry only when
+        it is reached.
+
+        :param lazy: If true, nothing is hashed, and entries that haven't
+            been hashed yet (by warm(), or for REQ_HASH) are sent with their
+            hashes pending.
+        :type lazy: boolean
+
+        :return: The entries, with paths relative to the share.
+        :rtype: generator of FileInfo
+        """
+
+        with self.browser_lock:
+            # Hashed with the algorithm agreed on with the other host
+            self.browser.algorithm = self.ftc.hash_algorithm
+
+        for f_path in self.share.iterdir():
+            with self.browser_lock:
+                if lazy:
+                    info = self.browser.peek_info(f_path)
+                else:
+                    info = self.browser.get_info(f_path)
+            if info is None:
+                # Deleted since it was listed
+                continue
+            yield self.relative(info)
+
+    def hashes(self, file_names):
+        """Hashes files for REQ_HASH.
+
+        :param file_names: File names as requested by the other host.
+        :type file_names: list of raw string
+
+        :return: The entries of the files (leaving out any that are gone or
+            outside of the share).
+        :rtype: list of FileInfo
+        """
+
+        entries = []
+        for file_name in file_names:
+            if self.resolve(file_name) is None:
+                continue
+            # Looked up as listed, so the same cache entries are used
+            path = self.share / file_name.decode()
+            with self.browser_lock:
+                self.browser.algorithm = self.ftc.hash_algorithm
+                info = self.browser.get_info(path)
+            if info is not None:
+                entries.append(self.relative(info))
+        return entries
+
+    def relative(self, info):
+        """:param info: An entry from the browser.
+        :type info: FileInfo
+
+        :return: A copy of the entry (since the original belongs to the
+            browser's cache), with its path relative to the share.
+        :rtype: FileInfo
+        """
+
+        return FileInfo(path=info.path.relative_to(self.share), file_hash=info.hash,
+                        is_dir=info.is_dir, mtime=info.mtime, algorithm=info.algorithm,
+                        chunks=info.chunks)
+
+    def resolve(self, file_name):
+        """:param file_name: A file name as requested by the other host.
+        :type file_name: raw string
+
+        :return: The path of the file in the share, or None if the name
+            refers to something outside of the share.
+        :rtype: pathlib.Path
+        """
+
+        share = self.share.resolve()
+        path = (share / file_name.decode()).resolve()
+        if share not in path.parents:
+            return None
+        return path
+
+    def encrypt(self, data):
+        """:param data: Data to encrypt.
+        :type data: raw string
+
+        :return: The encrypted data.
+        :rtype: raw string
+        """
+
+        # Imported here so that starting the daemon doesn't wait on rncryptor
+        from encryption import Encryption
+        return Encryption(data, self.password).encrypt()
+
+    def read(self, file_name):
+        """:param file_name: A file name as requested by the other host.
+        :type file_name: raw string
+
+        :return: The contents of the file.
+        :rtype: raw string
+
+        :raises PermissionError: when the file is outside of the share.
+        """
+
+        path = self.resolve(file_name)
+        if path is None:
+            raise PermissionError("'{}' is outside of the share".format(file_name.decode()))
+        return path.read_bytes()
+
+    def handle(self, message_type, data):
+        """Answers a single message received from the other host.
+
+        :param message_type: The message's token.
+        :type message_type: raw string
+
+        :param data: The message's contents, as returned by
+            FTConn.receive_data().
+        """
+
+        # Listings don't wait for hashing, if the other host can ask for
+        # the hashes it needs
+        lazy = bool(self.ftc.caps.get('lazy'))
+        if message_type == FTProto.REQ_LIST:
+            self.ftc.send_file_list(list(self.iter_list(lazy)))
+        elif message_type == FTProto.REQ_LIST_PAGE:
+            cursor, limit = data
+            self.ftc.send_file_list_page(*self.pager.page(cursor, limit,
+                                                          lambda: self.iter_list(lazy)))
+        elif message_type == FTProto.REQ_HASH:
+            self.ftc.send_hashes(self.hashes(data))
+        elif message_type == FTProto.REQ_FILE:
+            path = self.resolve(data)
+            if path is not None and self.ftc.should_send_sparse(path):
+                from encryption import Encryptor
+                self.ftc.send_file_sparse(data, path, lambda: Encryptor(self.password))
+            elif path is not None and self.ftc.should_stripe(path.stat().st_size):
+                from encryption import Encryptor
+                self.ftc.send_file_striped(data, path, lambda: Encryptor(self.password))
+            else:
+                self.ftc.send_file(data, self.encrypt(self.read(data)))
+        elif message_type == FTProto.REQ_FILES:
+            self.ftc.send_files(self.encrypt(pack_files((name, self.read(name)) for name in data)))
+        elif message_type == FTProto.SUBSCRIBE and data:
+            # Changes are looked for from now on (FTConn has already told
+            # the other host to list everything). changes() only touches
+            # its own snapshots, and is only called from this thread, so it
+            # doesn't hold up warming by taking browser_lock.
+            self.browser.changes(self.share)
+            self.notifier = FTNotifier()
+            self.last_watch = self.last_deep_watch = time.monotonic()
+
+    def push_changes(self):
+        """Looks for changes in the share (every watch_interval), and once
+        they have settled down, tells the other host about them if it
+        subscribed.
+        """
+
+        if not self.ftc.subscriber:
+            return
+        now = time.monotonic()
+        if self.last_watch is None or now - self.last_watch >= self.watch_interval:
+            deep = self.last_deep_watch is None \
+                or now - self.last_deep_watch >= self.deep_watch_interval
+            self.last_watch = now
+            if deep:
+                self.last_deep_watch = now
+            changed = self.browser.changes(self.share, deep)
+            self.notifier.add(str(path.relative_to(self.share)).encode() for path in changed)
+        names = self.notifier.due()
+        if names:
+            self.ftc.send_changes(names)
+
+    def size_of(self, file_names):
+        """:param file_names: File names as requested by the other host.
+        :type file_names: list of raw string
+
+        :return: The total size of the files (counting any that can't be
+            read as empty, since answering those is quick).
+        :rtype: integer
+        """
+
+        size = 0
+        for file_name in file_names:
+            path = self.resolve(file_name)
+            try:
+                size += path.stat().st_size if path is not None else 0
+            except OSError:
+                pass
+        return size
+
+    def schedule(self, message_type, data):
+        """Queues the answer to a message, to be sent by serve() once any
+        more urgent ones have been. File lists go first, then single files
+        (which are what the user asks for), then batches of files (which
+        are what syncing asks for), smallest first within each.
+
+        :param message_type: The message's token.
+        :type message_type: raw string
+
+        :param data: The message's contents, as returned by
+            FTConn.receive_data().
+
+        :return: The queued job, or None if the message needs no answer.
+        :rtype: ft_sched.Job
+        """
+
+        if message_type in (FTProto.REQ_LIST, FTProto.REQ_LIST_PAGE, FTProto.SUBSCRIBE):
+            priority, size = Priority.CONTROL, 0
+        elif message_type == FTProto.REQ_FILE:
+            priority, size = Priority.USER, self.size_of([data])
+        elif message_type == FTProto.REQ_HASH:
+            # Asked for just before the files themselves
+            priority, size = Priority.USER, self.size_of(data)
+        elif message_type == FTProto.REQ_FILES:
+            priority, size = Priority.BACKGROUND, self.size_of(data)
+        else:
+            return None
+        return self.scheduler.submit(self.answer, message_type, data,
+                                     priority=priority, size=size)
+
+    def answer(self, message_type, data):
+        """Answers a message, reporting (rather than raising) any error
+        answering it, so that one bad request or odd file in the share
+        can't stop the daemon.
+
+        :param message_type: The message's token.
+        :type message_type: raw string
+
+        :param data: The message's contents, as returned by
+            FTConn.receive_data().
+        """
+
+        try:
+            self.handle(message_type, data)
+        except Exception as ex:     # pylint: disable = broad-except
+            print('Could not answer', FTProto.name_of(message_type), repr(ex))
+
+    def serve(self, host, port):
+        """Connects to the other host and answers its requests, reconnecting
+        whenever the connection breaks.
+
+        :param host: Host to connect to (usually an IP).
+        :type host: string
+
+        :param port: Port to use for the connection.
+        :type port: number
+
+        :return: The status of the connection process (as returned by
+            FTConn.connect()).
+        :rtype: string
+        """
+
+        if self.warm_thread is None:
+            self.start_warming()
+
+        message = self.ftc.connect(host, port)
+        if message != "Success":
+            return message
+        # Keep serving if the connection drops (e.g. the other host restarts)
+        self.ftc.auto_reconnect = True
+
+        while True:
+            # Everything that has arrived is queued before answering the
+            # most urgent of it
+            message_type, data = self.ftc.receive_data()
+            if message_type is not None:
+                self.schedule(message_type, data)
+            elif not self.scheduler.run_next():
+                self.push_changes()
+                time.sleep(0.005)
@@ -0,0 +1,250 @@
+"""Packs and unpacks the fields of the transfer protocol (see ft_proto.py)
+with precompiled structs. A message is packed into one growable buffer
+(Encoder) and unpacked from a view of the bytes received (Decoder), so
+that a list of thousands of entries is a tight loop rather than a new
+bytes object and format string per field.
+"""
+
+import struct
+from functools import lru_cache
+from pathlib import Path
+
+from file_info import FileInfo, SHA256
+from .ft_error import UnexpectedValueError
+
+
+@lru_cache(maxsize=None)
+def struct_for(fmt):
+    """:param fmt: A struct format string.
+    :type fmt: string
+
+    :return: The compiled struct for the format (the same one every time).
+    :rtype: struct.Struct
+    """
+
+    return struct.Struct(fmt)
+
+
+BOOL = struct_for('!?')
+INT = struct_for('!i')
+UINT = struct_for('!I')
+LONG = struct_for('!q')
+ULONG = struct_for('!Q')
+DOUBLE = struct_for('!d')
+# (file size, number of extents or ranges)
+SIZE_COUNT = struct_for('!QI')
+# (offset, length) of an extent, or the two cursors of RES_LIST_PAGE
+EXTENT = CURSORS = struct_for('!QQ')
+# (offset, length) of a range, or the cursor and limit of REQ_LIST_PAGE
+RANGE = CURSOR_LIMIT = struct_for('!Qi')
+# The end of a file list entry: (algorithm, is_dir, mtime), or before the
+# hashes were negotiated, (SHA256 digest, is_dir, mtime)
+ENTRY = struct_for('!B?Q')
+LEGACY_ENTRY = struct_for('!32s?Q')
+
+
+class Encoder:
+    """A growable buffer that fields are packed straight into.
+    """
+
+    def __init__(self, size=256):
+        """:param size: How many bytes to make room for at first (the buffer
+            doubles whenever it runs out).
+        :type size: integer
+        """
+
+        self.buf = bytearray(size)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def reserve(self, num):
+        """Makes room for num more bytes.
+
+        :param num: How many bytes.
+        :type num: integer
+        """
+
+        needed = self.size + num
+        if needed > len(self.buf):
+            self.buf.extend(bytes(max(needed, 2 * len(self.buf)) - len(self.buf)))
+
+    def pack(self, compiled, *values):
+        """Packs values at the end of the buffer.
+
+        :param compiled: What to pack them as (e.g. INT).
+        :type compiled: struct.Struct
+
+        :param values: The values, as passed to struct.pack().
+        """
+
+        self.reserve(compiled.size)
+        compiled.pack_into(self.buf, self.size, *values)
+        self.size += compiled.size
+
+    def raw(self, data):
+        """Adds bytes as they are.
+
+        :param data: The bytes.
+        :type data: bytes-like object
+        """
+
+        num = len(data)
+        self.reserve(num)
+        self.buf[self.size:self.size + num] = data
+        self.size += num
+
+    def rstring(self, data):
+        """Adds a string (its '!i' length, then the string).
+
+        :param data: The string.
+        :type data: raw string
+        """
+
+        self.pack(INT, len(data))
+        self.raw(data)
+
+    def view(self):
+        """:return: What has been packed (valid until more is).
+        :rtype: memoryview
+        """
+
+        return memoryview(self.buf)[:self.size]
+
+
+class Decoder:
+    """Unpacks fields from a view of some bytes, one after another.
+    """
+
+    def __init__(self, data, offset=0):
+        """:param data: The bytes to unpack from. They are not copied.
+        :type data: bytes-like object
+
+        :param offset: Where to start.
+        :type offset: integer
+        """
+
+        self.view = memoryview(data)
+        self.offset = offset
+
+    @property
+    def left(self):
+        """:return: How many bytes haven't been unpacked yet.
+        :rtype: integer
+        """
+
+        return len(self.view) - self.offset
+
+    def unpack(self, compiled):
+        """:param compiled: What to unpack (e.g. INT).
+        :type compiled: struct.Struct
+
+        :return: The unpacked values.
+        :rtype: tuple
+
+        :raises UnexpectedValueError: if there aren't enough bytes left.
+        """
+
+        self.__check(compiled.size)
+        values = compiled.unpack_from(self.view, self.offset)
+        self.offset += compiled.size
+        return values
+
+    def raw(self, num):
+        """:param num: How many bytes to take.
+        :type num: integer
+
+        :return: The bytes, as a view of the data (not a copy).
+        :rtype: memoryview
+
+        :raises UnexpectedValueError: if there aren't enough bytes left.
+        """
+
+        self.__check(num)
+        piece = self.view[self.offset:self.offset + num]
+        self.offset += num
+        return piece
+
+    def rstring(self):
+        """:return: The next string.
+        :rtype: raw string
+        """
+
+        return bytes(self.raw(self.unpack(INT)[0]))
+
+    def __check(self, num):
+        if num < 0 or num > self.left:
+            raise UnexpectedValueError("{} more bytes".format(num),
+                                       "{} bytes".format(self.left))
+
+
+def encode_entries(enc, file_list, hashes, chunks=False):
+    """Packs file list entries, as in RES_LIST.
+
+    :param enc: Where to pack them.
+    :type enc: Encoder
+
+    :param file_list: The entries.
+    :type file_list: list of FileInfo
+
+    :param hashes: Whether caps['hashes'] was agreed on.
+    :type hashes: boolean
+
+    :param chunks: Whether to add the hashes of the chunks of each file,
+        as in RES_HASH when caps['chunks'] was agreed on.
+    :type chunks: boolean
+    """
+
+    enc.pack(INT, len(file_list))
+    for file_info in file_list:
+        enc.rstring(str(file_info.path).encode())
+        if hashes:
+            # (An empty digest means the hash is pending)
+            enc.rstring(file_info.hash or b'')
+            enc.pack(ENTRY, file_info.algorithm, file_info.is_dir, file_info.mtime)
+            if chunks:
+                # (Only with a hash, since that gives their length)
+                chunk_list = (file_info.chunks or []) if file_info.hash else []
+                enc.pack(INT, len(chunk_list))
+                for chunk in chunk_list:
+                    enc.raw(chunk)
+        else:
+            enc.pack(LEGACY_ENTRY, file_info.hash, file_info.is_dir, file_info.mtime)
+
+
+def decode_entries(dec, hashes, chunks=False):
+    """Unpacks file list entries, as in RES_LIST.
+
+    :param dec: Where to unpack them from.
+    :type dec: Decoder
+
+    :param hashes: Whether caps['hashes'] was agreed on.
+    :type hashes: boolean
+
+    :param chunks: Whether the entries have the hashes of their chunks
+        (see encode_entries()).
+    :type chunks: boolean
+
+    :return: The entries.
+    :rtype: list of FileInfo
+    """
+
+    file_list = []
+    for _ in range(dec.unpack(INT)[0]):
+        path = Path(str(dec.raw(dec.unpack(INT)[0]), 'utf-8'))
+        if hashes:
+            hashd = dec.rstring() or None
+            algorithm, is_dir, mtime = dec.unpack(ENTRY)
+        else:
+            hashd, is_dir, mtime = dec.unpack(LEGACY_ENTRY)
+            algorithm = SHA256.id
+        chunk_hashes = None
+        if hashes and chunks:
+            count, = dec.unpack(INT)
+            # Each chunk's hash is as long as the file's
+            size = len(hashd or b'')
+            chunk_hashes = [bytes(dec.raw(size)) for _ in range(count if size else 0)] or None
+        file_list.append(FileInfo(path=path, file_hash=hashd, is_dir=is_dir, mtime=mtime,
+                                  algorithm=algorithm, chunks=chunk_hashes))
+    return file_list
@@ -0,0 +1,75 @@
+"""Batches up changes to the local file list before they are pushed to a
+subscribed host (see FTProto.CHANGED). Saving a file often touches it
+several times in a row, and copying a directory touches many files, so
+instead of one CHANGED per touch, the changes are held until they have
+settled down and then sent together.
+"""
+
+import time
+
+class FTNotifier:
+    """Debounces and coalesces the names of changed files.
+    """
+
+    def __init__(self, debounce=0.2, max_delay=1.0, clock=time.monotonic):
+        """:param debounce: How long nothing must change for before the
+            changes are sent, in seconds.
+        :type debounce: number
+
+        :param max_delay: The longest a change is held back for, however
+            often files keep changing, in seconds.
+        :type max_delay: number
+
+        :param clock: Function returning the current time, in seconds.
+        :type clock: callable
+        """
+
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self._clock = clock
+        self._pending = set()
+        # When the first and the last of the pending changes were added
+        self._first = None
+        self._last = None
+
+    @property
+    def pending(self):
+        """:return: Whether there are changes that haven't been sent yet.
+        :rtype: boolean
+        """
+
+        return bool(self._pending)
+
+    def add(self, names):
+        """Notes that files have changed.
+
+        :param names: The names of the files (each is only sent once,
+            however often it changes before then).
+        :type names: iterable of raw string
+        """
+
+        names = set(names)
+        if not names:
+            return
+        now = self._clock()
+        if not self._pending:
+            self._first = now
+        self._pending |= names
+        self._last = now
+
+    def due(self):
+        """Takes the pending changes, if it is time to send them.
+
+        :return: The names of the changed files, or an empty list if there
+            are none or they haven't settled down yet.
+        :rtype: list of raw string
+        """
+
+        if not self._pending:
+            return []
+        now = self._clock()
+        if now - self._last < self.debounce and now - self._first < self.max_delay:
+            return []
+        names, self._pending = sorted(self._pending), set()
+        self._first = self._last = None
+        return names
@@ -0,0 +1,60 @@
+"""Packs many small files into a single tar-like byte stream (and back), so
+that a batch of files can be encrypted and sent as one message instead of
+one message per file.
+
+Each member of the stream is a '!iQ' header (name length and data length),
+followed by the raw name and then the raw file contents.
+"""
+
+import struct
+from .ft_error import UnexpectedValueError
+
+_HEADER = struct.Struct('!iQ')
+
+def pack_files(entries):
+    """Concatenates files into a single packed stream.
+
+    :param entries: The files to pack, as (name, contents) pairs.
+    :type entries: iterable of (raw string, raw string)
+
+    :return: The packed stream.
+    :rtype: bytes
+    """
+
+    parts = []
+    for name, data in entries:
+        parts.append(_HEADER.pack(len(name), len(data)))
+        parts.append(name)
+        parts.append(data)
+    return b''.join(parts)
+
+def unpack_files(packed):
+    """Splits a packed stream back into its files. The contents are returned
+    as memoryviews into the packed stream, so no file data is copied.
+
+    :param packed: A stream produced by pack_files().
+    :type packed: bytes-like object
+
+    :return: The files in the stream, as (name, contents) pairs.
+    :rtype: list of (bytes, memoryview)
+
+    :raises UnexpectedValueError: when the stream is truncated.
+    """
+
+    view = memoryview(packed)
+    entries = []
+    offset = 0
+    while offset < len(view):
+        if offset + _HEADER.size > len(view):
+            raise UnexpectedValueError("packed file header", "end of stream")
+        name_len, data_len = _HEADER.unpack_from(view, offset)
+        offset += _HEADER.size
+
+        if offset + name_len + data_len > len(view):
+            raise UnexpectedValueError("packed file contents", "end of stream")
+        name = bytes(view[offset:offset + name_len])
+        offset += name_len
+        entries.append((name, view[offset:offset + data_len]))
+        offset += data_len
+
+    return entries
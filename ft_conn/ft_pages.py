@@ -0,0 +1,57 @@
+"""Answers requests for the file list a page at a time (REQ_LIST_PAGE), so
+that huge directories can be listed (and hashed) as they are sent rather
+than all before the first entry is.
+"""
+
+import itertools
+from collections import OrderedDict
+
+class FTListPager:
+    """Keeps the listings that are part way through being sent, each under
+    the cursor the other host uses to ask for its next page. Not thread-safe.
+    """
+
+    # How many unfinished listings to keep; the oldest is dropped to make
+    # room for a new one (asking for it again starts the listing over)
+    max_listings = 16
+
+    # The most entries sent in one page, whatever the other host asks for
+    max_page_size = 4096
+
+    def __init__(self):
+        self._listings = OrderedDict()
+        self._cursors = itertools.count(1)
+
+    def page(self, cursor, limit, start):
+        """Takes the next page off a listing.
+
+        :param cursor: The cursor asked for, or 0 to start a new listing.
+        :type cursor: integer
+
+        :param limit: The most entries to put in the page.
+        :type limit: integer
+
+        :param start: Called with no arguments to start a new listing,
+            returning its entries (lazily, e.g. from a generator).
+        :type start: callable
+
+        :return: The cursor of the page (0 if it starts a new listing, which
+            is also the case when cursor has expired), its entries, and the
+            cursor of the next page (0 if this is the last).
+        :rtype: (integer, list, integer)
+        """
+
+        entries = self._listings.pop(cursor, None) if cursor else None
+        if entries is None:
+            cursor, entries = 0, iter(start())
+
+        limit = max(1, min(limit, self.max_page_size))
+        page = list(itertools.islice(entries, limit))
+        if len(page) < limit:
+            return cursor, page, 0
+
+        next_cursor = next(self._cursors)
+        self._listings[next_cursor] = entries
+        while len(self._listings) > self.max_listings:
+            self._listings.popitem(last=False)
+        return cursor, page, next_cursor
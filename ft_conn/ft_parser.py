@@ -0,0 +1,442 @@
+"""A sans-IO parser for the messages of the transfer protocol (see
+ft_proto.py). It is fed bytes as they arrive, in pieces of any size, and
+hands out each message once enough of it has arrived. It never reads from
+a socket itself, so it never blocks, and the same parser can be driven by
+a thread, an asyncio protocol or a selector loop.
+"""
+
+import struct
+from collections import deque, namedtuple
+from pathlib import Path
+
+from file_info import FileInfo, SHA256
+from .ft_codec import Decoder, decode_entries, BOOL, INT, ULONG, DOUBLE, SIZE_COUNT, EXTENT, \
+    CURSORS, CURSOR_LIMIT, ENTRY, LEGACY_ENTRY
+from .ft_error import UnexpectedValueError
+from .ft_proto import FTProto, FRAME_HEADER
+
+# A whole message: its token, its contents, and its size in bytes (token
+# included). For a message whose body was streamed, data is its header
+# again (see Start).
+Message = namedtuple('Message', 'token data size')
+
+# The start of a message whose body is streamed (RES_FILE, RES_FILES and
+# RES_SPARSE), so that a large body never has to be held in memory. It is
+# followed by Body events holding the body, and then a Message.
+Start = namedtuple('Start', 'token header')
+
+# A piece of a streamed body. data is a memoryview of the bytes that were
+# fed, not a copy of them.
+Body = namedtuple('Body', 'token data')
+
+class _Stream:
+    """Asks for the next length bytes to be handed out as Body events."""
+
+    def __init__(self, length):
+        self.left = length
+
+
+class _Skip(_Stream):
+    """Asks for the next length bytes to be thrown away."""
+
+
+class _View:
+    """Asks for the next length bytes, as a view of what was fed where
+    possible."""
+
+    def __init__(self, length):
+        self.length = length
+
+
+# Returned for a frame that was skipped, which makes no Message
+_SKIPPED = object()
+
+
+def _length(what):
+    """Parses a length or count, which a well-behaved host never sends
+    negative (a negative length would never be used up)."""
+
+    length, = yield INT
+    if length < 0:
+        raise UnexpectedValueError("a {} of at least 0".format(what), str(length))
+    return length
+
+
+def _rstring():
+    return (yield (yield from _length('string length')))
+
+
+def _rstrings():
+    count = yield from _length('string count')
+    strings = []
+    for _ in range(count):
+        strings.append((yield from _rstring()))
+    return strings
+
+
+class FTParser:
+    """Turns the bytes received on the main connection into events
+    (Message, Start and Body). Each message is parsed by a generator, which
+    asks for what it needs next (a struct, a number of bytes or a streamed
+    body) and is resumed once that has been fed, so nothing is parsed
+    twice however the bytes are split up.
+
+    If a message turns out to be malformed, UnexpectedValueError is raised
+    once, and the message is dropped. A framed one is skipped to the end of
+    its frame (and counted in skipped), so the messages after it parse as
+    usual; without frames there is no telling where the next one starts.
+    """
+
+    def __init__(self, caps=None, framed=False):
+        """:param caps: The capabilities agreed on with the other host (as
+            in FTConn.caps), which decide the format of file list entries.
+        :type caps: dict of string to integer
+
+        :param framed: Whether messages come in frames (see
+            ft_proto.FRAME_HEADER).
+        :type framed: boolean
+        """
+
+        self.caps = {} if caps is None else caps
+        self.framed = framed
+        # How many frames have been skipped, for having a token we don't know
+        # or a malformed message
+        self.skipped = 0
+        # The bytes fed but not parsed yet, as memoryviews
+        self._chunks = deque()
+        self._buffered = 0
+        self._events = deque()
+
+        # The message being parsed: its token, generator, what the
+        # generator asked for, and how many of its bytes have been parsed
+        self._token = None
+        self._body = None
+        self._request = None
+        self._size = 0
+        # What is left of its frame (None if it isn't framed)
+        self._frame_left = None
+
+    @property
+    def in_message(self):
+        """:return: Whether part of a message has been parsed.
+        :rtype: boolean
+        """
+
+        return self._body is not None
+
+    @property
+    def buffered(self):
+        """:return: How many of the bytes fed haven't been parsed yet.
+        :rtype: integer
+        """
+
+        return self._buffered
+
+    def feed(self, data):
+        """Adds bytes that have arrived. They are not copied, so they must
+        not be changed afterwards.
+
+        :param data: The next bytes received.
+        :type data: bytes-like object
+        """
+
+        if len(data):
+            self._chunks.append(memoryview(data))
+            self._buffered += len(data)
+
+    def next_event(self):
+        """:return: The next event, or None if more bytes must be fed first.
+        :rtype: Message, Start or Body
+        """
+
+        while not self._events:
+            if not self.__step():
+                return None
+        return self._events.popleft()
+
+    def __iter__(self):
+        """Iterates over the events that are ready.
+        """
+
+        event = self.next_event()
+        while event is not None:
+            yield event
+            event = self.next_event()
+
+    def __step(self):
+        """Parses as much of the current message as one request allows.
+
+        :return: Whether anything was parsed.
+        :rtype: boolean
+        """
+
+        if self._body is None:
+            return self.__start()
+
+        request = self._request
+        if isinstance(request, _Stream):
+            if not self._buffered:
+                return False
+            piece = self.__take(min(request.left, len(self._chunks[0])))
+            request.left -= len(piece)
+            if not isinstance(request, _Skip):
+                self._events.append(Body(self._token, piece))
+            if not request.left:
+                self.__resume(None)
+            return True
+
+        if isinstance(request, struct.Struct):
+            if self._buffered < request.size:
+                return False
+            self.__resume(request.unpack(self.__take(request.size)))
+            return True
+
+        if isinstance(request, _View):
+            if self._buffered < request.length:
+                return False
+            self.__resume(self.__take(request.length))
+            return True
+
+        if self._buffered < request:
+            return False
+        self.__resume(bytes(self.__take(request)))
+        return True
+
+    def __start(self):
+        """Starts parsing the next message, once its token (or frame header)
+        has been fed.
+
+        :return: Whether it was started.
+        :rtype: boolean
+        """
+
+        if not self.framed:
+            if not self._buffered:
+                return False
+            self._token = bytes(self.__take(1))
+            self._size = 1
+            self._body = self.__parse(self._token)
+        else:
+            if self._buffered < FRAME_HEADER.size:
+                return False
+            self._size = 0
+            self._token, _, length = FRAME_HEADER.unpack(self.__take(FRAME_HEADER.size))
+            self._frame_left = length
+            self._body = self.__frame(self._token)
+        self.__resume(None)
+        return True
+
+    def __frame(self, token):
+        """Parses the body of a frame, skipping it all if the token is one
+        we don't know, and whatever is left of it after what we know of
+        the message.
+        """
+
+        if token not in self.__parsers():
+            yield _Skip(self._frame_left)
+            return _SKIPPED
+        if token in (FTProto.RES_LIST, FTProto.RES_HASH, FTProto.RES_LIST_PAGE):
+            # The whole list is known to be in the frame, so it is decoded
+            # in one go, straight from what was fed
+            dec = Decoder((yield _View(self._frame_left)))
+            hashes = bool(self.caps.get('hashes'))
+            if token == FTProto.RES_LIST_PAGE:
+                cursor, next_cursor = dec.unpack(CURSORS)
+                return cursor, next_cursor, decode_entries(dec, hashes)
+            chunks = token == FTProto.RES_HASH and bool(self.caps.get('chunks'))
+            return decode_entries(dec, hashes, chunks)
+        data = yield from self.__parse(token)
+        yield _Skip(self._frame_left)
+        return data
+
+    def __resume(self, value):
+        """Hands value to the current message's generator, and runs it until
+        it asks for something that hasn't been fed (or finishes)."""
+
+        while True:
+            try:
+                request = self._body.send(value)
+            except UnexpectedValueError:
+                self.__drop()
+                raise
+            except StopIteration as done:
+                if done.value is _SKIPPED:
+                    self.skipped += 1
+                else:
+                    self._events.append(Message(self._token, done.value, self._size))
+                self._token = self._body = self._request = self._frame_left = None
+                return
+            value = None
+            if isinstance(request, Start):
+                self._events.append(request)
+                continue
+            if isinstance(request, _Stream) and not request.left:
+                continue
+            self._request = request
+            return
+
+    def __drop(self):
+        """Drops the message being parsed, which is malformed, skipping the
+        rest of its frame if it has one."""
+
+        if self._frame_left is None:
+            self._token = self._body = self._request = None
+            return
+        self._body = self.__skip_rest()
+        self._request = None
+        self.__resume(None)
+
+    def __skip_rest(self):
+        yield _Skip(self._frame_left)
+        return _SKIPPED
+
+    def __take(self, num):
+        """Takes num bytes (which must have been fed) off the front.
+
+        :return: The bytes, as a view of what was fed if they are all in one
+            piece of it, and a copy otherwise.
+        :rtype: bytes-like object
+        """
+
+        if not num:
+            return b''
+        if self._frame_left is not None:
+            if num > self._frame_left:
+                error = UnexpectedValueError("the rest of a {} frame ({} bytes)".format(
+                    FTProto.name_of(self._token), self._frame_left), "{} bytes".format(num))
+                self.__drop()
+                raise error
+            self._frame_left -= num
+        self._buffered -= num
+        self._size += num
+        first = self._chunks[0]
+        if len(first) >= num:
+            if len(first) == num:
+                self._chunks.popleft()
+            else:
+                self._chunks[0] = first[num:]
+            return first[:num]
+
+        pieces = []
+        while num:
+            piece = self._chunks.popleft()
+            if len(piece) > num:
+                self._chunks.appendleft(piece[num:])
+                piece = piece[:num]
+            pieces.append(piece)
+            num -= len(piece)
+        return b''.join(pieces)
+
+    def __parse(self, token):
+        """Starts parsing the body of a message.
+
+        :param token: The message's token.
+        :type token: raw string
+
+        :return: A generator that parses the body and returns its contents.
+        :rtype: generator
+        """
+
+        return self.__parsers().get(token, self.__nothing)()
+
+    def __parsers(self):
+        """:return: The parser of each token's message.
+        :rtype: dict of raw string to generator function
+        """
+
+        return {
+            FTProto.REQ_LIST: self.__nothing,
+            FTProto.REQ_FILE: _rstring,
+            FTProto.REQ_FILES: _rstrings,
+            FTProto.REQ_HASH: _rstrings,
+            FTProto.REQ_LIST_PAGE: self.__req_list_page,
+            FTProto.RES_LIST: self.__entries,
+            FTProto.RES_HASH: self.__res_hash,
+            FTProto.RES_LIST_PAGE: self.__res_list_page,
+            FTProto.RES_FILE: self.__res_file,
+            FTProto.RES_FILES: self.__res_files,
+            FTProto.RES_STRIPED: self.__res_striped,
+            FTProto.RES_SPARSE: self.__res_sparse,
+            FTProto.SUBSCRIBE: self.__subscribe,
+            FTProto.CHANGED: _rstrings,
+            FTProto.PING: self.__stamp,
+            FTProto.PONG: self.__stamp,
+        }
+
+    @staticmethod
+    def __nothing():
+        return None
+        yield       # pylint: disable = unreachable
+
+    @staticmethod
+    def __req_list_page():
+        return (yield CURSOR_LIMIT)
+
+    def __res_list_page(self):
+        cursor, next_cursor = yield CURSORS
+        return cursor, next_cursor, (yield from self.__entries())
+
+    def __res_hash(self):
+        return (yield from self.__entries(bool(self.caps.get('chunks'))))
+
+    def __entries(self, chunks=False):
+        file_list = []
+        for _ in range((yield from _length('entry count'))):
+            path = (yield from _rstring()).decode()
+            chunk_hashes = None
+            if self.caps.get('hashes'):
+                hashd = (yield from _rstring()) or None
+                (algorithm, is_dir, mtime) = yield ENTRY
+                if chunks:
+                    count = yield from _length('chunk count')
+                    size = len(hashd or b'')
+                    data = yield count * size
+                    chunk_hashes = [data[i:i + size] for i in range(0, len(data), size or 1)] or None
+            else:
+                (hashd, is_dir, mtime) = yield LEGACY_ENTRY
+                algorithm = SHA256.id
+            file_list.append(FileInfo(path=Path(path), file_hash=hashd, is_dir=is_dir,
+                                      mtime=mtime, algorithm=algorithm, chunks=chunk_hashes))
+        return file_list
+
+    @staticmethod
+    def __res_file():
+        fname = yield from _rstring()
+        length = yield from _length('file length')
+        yield Start(FTProto.RES_FILE, (fname, length))
+        yield _Stream(length)
+        return fname, length
+
+    @staticmethod
+    def __res_files():
+        length = yield from _length('stream length')
+        yield Start(FTProto.RES_FILES, length)
+        yield _Stream(length)
+        return length
+
+    @staticmethod
+    def __res_striped():
+        fname = yield from _rstring()
+        size, count = yield SIZE_COUNT
+        return fname, size, count
+
+    @staticmethod
+    def __res_sparse():
+        fname = yield from _rstring()
+        size, count = yield SIZE_COUNT
+        extents = []
+        for _ in range(count):
+            extents.append((yield EXTENT))
+        length, = yield ULONG
+        header = (fname, size, extents, length)
+        yield Start(FTProto.RES_SPARSE, header)
+        yield _Stream(length)
+        return header
+
+    @staticmethod
+    def __subscribe():
+        return (yield BOOL)[0]
+
+    @staticmethod
+    def __stamp():
+        return (yield DOUBLE)[0]
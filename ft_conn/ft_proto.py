@@ -0,0 +1,120 @@
+"""The tokens that start each message of the transfer protocol, and the
+frames messages are sent in.
+"""
+
+import struct
+
+# From network version 3 on (see FTConn._network_version), each message on
+# the main connection is sent as a frame: this header, then the message's
+# body. The header is the token, flags (none are defined yet, so they are
+# sent as 0 and ignored), and '!Q' (the length of the body). A receiver
+# skips frames it has no parser for, and whatever is left of a frame after
+# the fields it knows, so newer versions can add messages and fields
+# without breaking older ones.
+FRAME_HEADER = struct.Struct('!cBQ')
+
+# The first network version whose messages are framed
+FRAMED_VERSION = 3
+
+
+class FTProto:
+    """Internally used to define control tokens for data transmission.
+    """
+
+    # Used to request the remote filelist.
+    REQ_LIST = b'l'
+
+    # Used to request a file. Following is a string of the file name/path
+    REQ_FILE = b'f'
+
+    # Used to send the filelist. Following is a '!i' representing the
+    # number of entries, and then each entry is sent as a string (path),
+    # '!32s?Q' (SHA256 digest, is_dir, and mtime int). If caps['hashes']
+    # was agreed on, each entry is instead a string (path), a string (hash
+    # digest) and '!B?Q' (hash algorithm ID, is_dir, and mtime int). If
+    # caps['lazy'] was also agreed on, an empty digest means the hash is
+    # pending (see REQ_HASH).
+    RES_LIST = b'L'
+
+    # Used to send the file. Following is a raw string of the contents of the file
+    RES_FILE = b'F'
+
+    # Used to request many files at once. Following is a '!i' representing
+    # the number of files, and then each file name/path as a string.
+    REQ_FILES = b'm'
+
+    # Used to send many files at once. Following is a raw string holding
+    # the files packed together by ft_pack.pack_files().
+    RES_FILES = b'M'
+
+    # Used to send a file split into ranges over the data connections.
+    # Following is a string (file name/path) and '!QI' (file size and number
+    # of ranges). The ranges follow on the data connections.
+    RES_STRIPED = b'S'
+
+    # Starts the ranges of a striped file on one data connection. Following
+    # is a string (file name/path) and '!I' (number of ranges on this
+    # connection), then for each range '!Qi' (offset and length) and the
+    # (possibly encrypted) contents of the range.
+    RES_RANGES = b'R'
+
+    # Used to send a sparse file without its holes. Following is a string
+    # (file name/path), '!QI' (file size and number of extents of data),
+    # then for each extent '!QQ' (offset and length), and then '!Q' (length
+    # of the contents) and the (possibly encrypted) contents of all of the
+    # extents, one after another.
+    RES_SPARSE = b'H'
+
+    # Used to request the remote filelist a page at a time. Following is
+    # '!Qi' (the cursor of the page, 0 to start a new listing, and the most
+    # entries to send in it).
+    REQ_LIST_PAGE = b'g'
+
+    # Used to send a page of the filelist. Following is '!QQ' (the cursor
+    # of this page, 0 if it starts a new listing, and the cursor of the next
+    # page, 0 if this is the last), and then the entries as in RES_LIST.
+    RES_LIST_PAGE = b'G'
+
+    # Used to ask for the hashes of files that a file list left pending.
+    # Following is a '!i' (number of files) and each file name/path as a
+    # string.
+    REQ_HASH = b'h'
+
+    # Used to send the hashes asked for by REQ_HASH. Following is the
+    # entries of the files, as in RES_LIST. If caps['chunks'] was agreed
+    # on, each entry ends with a '!i' (number of chunks, 0 unless the file
+    # was hashed with a tree hash) and the hash of each chunk, each as long
+    # as the file's hash, so the file can be checked a chunk at a time.
+    RES_HASH = b'D'
+
+    # Used to ask to be told when the file list changes (only if
+    # caps['push'] was agreed on). Following is a '!?' (whether to be told
+    # from now on, or to stop being told).
+    SUBSCRIBE = b'w'
+
+    # Used to tell a host that asked with SUBSCRIBE that the file list has
+    # changed. Following is a '!i' (number of files) and each changed
+    # (added, modified or removed) file name/path as a string. No files
+    # means anything may have changed, e.g. right after SUBSCRIBE.
+    CHANGED = b'c'
+
+    # Used to measure the round trip time. Following is a '!d' (a timestamp
+    # of the sender's, which the other host echoes back in a PONG).
+    PING = b'p'
+
+    # Used to answer a PING. Following is the '!d' from the PING.
+    PONG = b'P'
+
+    @classmethod
+    def name_of(cls, token):
+        """:param token: A token, as received from the network.
+        :type token: raw string
+
+        :return: The name of the token (e.g. 'REQ_LIST'), or 'UNKNOWN'.
+        :rtype: string
+        """
+
+        for name, value in vars(cls).items():
+            if name.isupper() and value == token:
+                return name
+        return 'UNKNOWN'
@@ -0,0 +1,92 @@
+"""Token buckets used by FTSock to limit the rate at which bulk data (i.e. file
+contents) is sent. A bucket can be given to a single FTSock to limit that
+connection, or shared between several to limit all of them together.
+"""
+
+import threading
+import time
+
+class TokenBucket:
+    """Allows a long-term average rate of bytes per second, with bursts of up
+    to a fixed number of bytes.
+    """
+
+    def __init__(self, rate, burst=None, clock=time.monotonic, sleep=time.sleep):
+        """:param rate: The average number of bytes allowed per second.
+        :type rate: number
+
+        :param burst: The largest number of bytes that can be sent at once
+            after the bucket has been idle. Defaults to one second's worth.
+        :type burst: number
+
+        :param clock: Function returning the current time, in seconds.
+        :type clock: callable
+
+        :param sleep: Function used to wait for tokens, in seconds.
+        :type sleep: callable
+        """
+
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+
+        self.rate = rate
+        self.burst = max(1, int(burst if burst is not None else rate))
+        self._clock = clock
+        self.sleep = sleep
+        self._tokens = self.burst
+        self._last = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def reserve(self, num):
+        """Takes tokens from the bucket without waiting for them. The bucket
+        may go into debt, which later callers have to wait out.
+
+        :param num: The number of bytes about to be sent.
+        :type num: number
+
+        :return: How long to wait before sending, in seconds.
+        :rtype: number
+        """
+
+        with self._lock:
+            self._refill()
+            self._tokens -= num
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / self.rate
+
+    def consume(self, num):
+        """Takes tokens from the bucket, waiting until they are available.
+
+        :param num: The number of bytes about to be sent.
+        :type num: number
+        """
+
+        wait = self.reserve(num)
+        if wait > 0:
+            self.sleep(wait)
+
+
+def rate_limiters(rate, burst=None):
+    """Makes the limiters for FTSock(rate_limiters=...) from a rate the user
+    asked for (e.g. on the command line).
+
+    :param rate: The average number of bytes allowed per second, or None
+        for no limit.
+    :type rate: number
+
+    :param burst: As for TokenBucket.
+    :type burst: number
+
+    :return: A bucket limiting to the rate, or none if there is no limit.
+    :rtype: list of TokenBucket
+    """
+
+    if rate is None:
+        return []
+    return [TokenBucket(rate, burst)]
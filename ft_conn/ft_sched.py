@@ -0,0 +1,133 @@
+"""Queues outgoing work so that the most urgent is done first: control
+messages before anything the user asked for, and that before background
+syncing. Within a class, smaller jobs go first, so a tiny file never waits
+behind a huge one.
+"""
+
+import heapq
+import itertools
+import threading
+
+class Priority:
+    """Classes of work, most urgent first.
+    """
+
+    # Requests and answers that keep the session going (e.g. file lists)
+    CONTROL = 0
+
+    # Transfers the user is waiting on (e.g. a file they double-clicked)
+    USER = 1
+
+    # Everything else (e.g. syncing every file)
+    BACKGROUND = 2
+
+
+class Job:
+    """A queued call, as returned by FTScheduler.submit().
+    """
+
+    def __init__(self, priority, size, seq, func, args):
+        self.priority = priority
+        self.size = size
+        self.func = func
+        self.args = args
+        self.cancelled = False
+        # Ties are broken by submission order
+        self._key = (priority, size, seq)
+
+    def __lt__(self, other):
+        return self._key < other._key
+
+    def cancel(self):
+        """Stops the job from being run, if it hasn't started yet.
+        """
+
+        self.cancelled = True
+
+
+class FTScheduler:
+    """Thread-safe priority queue of jobs.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        with self._cond:
+            return sum(1 for job in self._heap if not job.cancelled)
+
+    def submit(self, func, *args, priority=Priority.USER, size=0):
+        """Queues a call.
+
+        :param func: What to call.
+        :type func: callable
+
+        :param args: What to call it with.
+
+        :param priority: The class of the job (see Priority).
+        :type priority: integer
+
+        :param size: How much work the job is (e.g. bytes to send), so that
+            smaller jobs can go first.
+        :type size: number
+
+        :return: The queued job, which can be cancelled.
+        :rtype: Job
+        """
+
+        job = Job(priority, size, next(self._seq), func, args)
+        with self._cond:
+            heapq.heappush(self._heap, job)
+            self._cond.notify()
+        return job
+
+    def cancel_all(self, priority=None):
+        """Cancels every queued job (of one class, if priority is given).
+
+        :param priority: The class of jobs to cancel, or None for all.
+        :type priority: integer
+        """
+
+        with self._cond:
+            for job in self._heap:
+                if priority is None or job.priority == priority:
+                    job.cancel()
+
+    def pop(self, timeout=None):
+        """Takes the most urgent job off the queue, waiting for one if the
+        queue is empty.
+
+        :param timeout: How long to wait, in seconds (None means forever,
+            and 0 means not at all).
+        :type timeout: number
+
+        :return: The job, or None if there was none in time.
+        :rtype: Job
+        """
+
+        with self._cond:
+            while True:
+                while self._heap:
+                    job = heapq.heappop(self._heap)
+                    if not job.cancelled:
+                        return job
+                if timeout == 0 or not self._cond.wait(timeout):
+                    return None
+
+    def run_next(self, timeout=0):
+        """Runs the most urgent job (on the calling thread).
+
+        :param timeout: How long to wait for a job, in seconds (as in pop()).
+        :type timeout: number
+
+        :return: Whether there was a job to run.
+        :rtype: boolean
+        """
+
+        job = self.pop(timeout)
+        if job is None:
+            return False
+        job.func(*job.args)
+        return True
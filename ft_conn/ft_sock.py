@@ -3,8 +3,12 @@ data from the other host after the connection is established.
 """
 
 import socket
-import struct            # For networky data packing
+from contextlib import contextmanager
+from time import perf_counter
+from .ft_codec import Encoder, INT, struct_for
 from .ft_error import BrokenSocketError
+from .ft_proto import FRAME_HEADER
+from .ft_stats import FTStats
 
 # Basic network unit, used for connecting and transferring data over TCP
 class FTSock:
@@ -12,20 +16,50 @@ class FTSock:
     arbitrary message sending."""
 
 
-    def __init__(self, sock=None):
+    def __init__(self, sock=None, rate_limiters=None):
         """Initializes the ft_sock object
 
         :param sock: Socket object to use. If not provided (or None), we
         generate a new one.
         :type sock: socket.socket()
+
+        :param rate_limiters: Token buckets that bulk sends must draw from.
+            A bucket shared with other FTSocks limits all of them together,
+            while one used only here limits just this connection.
+        :type rate_limiters: list of ft_rate.TokenBucket
         """
 
         self.sock = sock
+        # When we connected as the server, the socket we accepted on (kept
+        # open so that data connections can be accepted after the handshake)
+        self.listener = None
+        self.rate_limiters = list(rate_limiters) if rate_limiters else []
+        # Counters and histograms about what this socket has done
+        self.metrics = FTStats()
+        # Size of the pieces bulk data is received and read in (FTConn
+        # adjusts it to suit the connection, see FTConn.tune())
+        self.chunk_size = 1 << 18
+        # Requested size of the send and receive buffers (None leaves them
+        # to the OS, see set_buffer_size())
+        self.buffer_size = None
         # Initialize timeout stack
         self.timeout_stack = []
+        # Whether messages are sent in frames (see frame()), and the buffer
+        # of the message being put together, if any
+        self.framed = False
+        self._frame = None
+        self._frame_bulk = False
 
     # 	These three functions allow us to quickly and easily switch between
     # timeouts
+    def stats(self):
+        """:return: A snapshot of this socket's counters (bytes, syscalls and
+            time spent blocked in send/recv).
+        :rtype: dict
+        """
+
+        return self.metrics.snapshot()
+
     def timeout_push(self, val):
         """Push a value to the timeout stack (basically set a timeout but keep
         track of old values so they can be restored afterwards).
@@ -74,6 +108,33 @@ class FTSock:
         if self.sock:
             self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             self.sock.settimeout(self.timeout_get())
+            if self.buffer_size:
+                self.__grow_buffers(self.sock)
+
+    def set_buffer_size(self, size):
+        """Asks the OS for send and receive buffers (SO_SNDBUF and SO_RCVBUF)
+        of at least size bytes, for this socket and any made later. Sockets
+        made later get them before connecting, so that the TCP window can
+        be scaled to match.
+
+        Buffers are never made smaller than what the OS already gave us,
+        since it may be growing them by itself.
+
+        :param size: The buffer size, in bytes.
+        :type size: number
+        """
+
+        self.buffer_size = size
+        if self.sock:
+            self.__grow_buffers(self.sock)
+
+    def __grow_buffers(self, sock):
+        for option in (socket.SO_SNDBUF, socket.SO_RCVBUF):
+            try:
+                if sock.getsockopt(socket.SOL_SOCKET, option) < self.buffer_size:
+                    sock.setsockopt(socket.SOL_SOCKET, option, self.buffer_size)
+            except OSError as ex:
+                print('OSError while setting socket buffer size:', ex)
 
 
     def __connect_client(self, host, port):
@@ -94,7 +155,7 @@ class FTSock:
             self.set_socket(None)
             raise ex
 
-    def __connect_server(self, host, port):
+    def __connect_server(self, host, port, listen_timeout):
         """ Connect to host as if we are the server and they are the client (i.e.
         listen for connections from this host).
 
@@ -103,32 +164,38 @@ class FTSock:
 
         :param port: Port to listen on.
         :type port: number
+
+        :param listen_timeout: How long to wait for the host, in seconds.
+        :type listen_timeout: number
         """
         self.set_socket(socket.socket(socket.AF_INET, socket.SOCK_STREAM))
 
         try:
             conn, addr = "", ""
 
-            # Reject connections until the host matches (within 5m)
-            self.timeout_push(300)
-            while True:
-                self.sock.bind(("", port))
-                self.sock.listen(1)
-                conn, (addr, port) = self.sock.accept()
-
-                if addr == host:
-                    break
-                else:
-                    self.set_socket(socket.socket(socket.AF_INET, socket.SOCK_STREAM))
-
-            self.timeout_pop()
-
+            # Reject connections until the host matches (within the timeout)
+            self.timeout_push(listen_timeout)
+            try:
+                while True:
+                    self.sock.bind(("", port))
+                    self.sock.listen(1)
+                    conn, (addr, _) = self.sock.accept()
+
+                    if addr == host:
+                        break
+                    else:
+                        self.set_socket(socket.socket(socket.AF_INET, socket.SOCK_STREAM))
+            finally:
+                self.timeout_pop()
+
+            self.close_listener()
+            self.listener = self.sock
             self.sock = conn
         except Exception as ex:
             self.set_socket(None)
             raise ex
 
-    def connect(self, host, port):
+    def connect(self, host, port, listen_timeout=300):
         """Starts a pseudo-symmetric connection by trying to connect to
         the host as a client, and if that doesn't work (i.e. there is
         no server running on the other host), start listening as a server.
@@ -139,6 +206,10 @@ class FTSock:
         :param port: The port to use for the server's connection.
         :type port: string
 
+        :param listen_timeout: How long to listen for the host (if it
+            wasn't listening itself), in seconds.
+        :type listen_timeout: number
+
         :return: A boolean representing the success (True
             for success, False for failure), a string representing the mode
             of connection we are in ("Client" or "Server"), and another string
@@ -154,11 +225,72 @@ class FTSock:
         # This is the error that we will get if there is no server
         # 	running on the other host
         except ConnectionRefusedError:
-            self.__connect_server(host, port)
+            self.__connect_server(host, port, listen_timeout)
             return True, "Server", "Success"
 
         return True, "Client", "Success"
 
+    def close_listener(self):
+        """Stops accepting connections (if we connected as the server).
+        """
+
+        if self.listener:
+            self.listener.close()
+            self.listener = None
+
+    def connect_data(self, mode, host, port, count):
+        """Opens extra connections to the same host, once the main connection
+        has been made with connect(). As the client we connect to the host
+        again, and as the server we accept more connections from it.
+
+        :param mode: The mode connect() returned ("Client" or "Server").
+        :type mode: string
+
+        :param host: The host we are connected to (usually an IP).
+        :type host: string
+
+        :param port: The port used for the main connection.
+        :type port: number
+
+        :param count: How many connections to open.
+        :type count: number
+
+        :return: The new connections, sharing this socket's rate limiters
+            and statistics.
+        :rtype: list of FTSock
+        """
+
+        socks = []
+        try:
+            if mode == "Client":
+                for _ in range(count):
+                    socks.append(socket.create_connection((host, port), self.timeout_get()))
+            else:
+                self.listener.settimeout(self.timeout_get())
+                self.listener.listen(count)
+                while len(socks) < count:
+                    conn, (addr, _) = self.listener.accept()
+                    if addr == host:
+                        socks.append(conn)
+                    else:
+                        conn.close()
+        except Exception as ex:
+            for sock in socks:
+                sock.close()
+            raise ex
+
+        data_socks = []
+        for sock in socks:
+            # Data connections wait as long as it takes for the next range
+            sock.settimeout(None)
+            fts = FTSock(sock, self.rate_limiters)
+            fts.metrics = self.metrics
+            fts.chunk_size = self.chunk_size
+            if self.buffer_size:
+                fts.set_buffer_size(self.buffer_size)
+            data_socks.append(fts)
+        return data_socks
+
     def recv_bytes(self, num):
         """Receives a known number of bytes from the other host.
 
@@ -180,13 +312,84 @@ class FTSock:
 
         chunks = []
         totalrecvd = 0
+        start = perf_counter()
+        try:
+            while totalrecvd < num:
+                chunk = self.sock.recv(min(num-totalrecvd, self.chunk_size))
+                self.metrics.add('recv_syscalls')
+                if chunk == b'':
+                    raise BrokenSocketError()
+                chunks.append(chunk)
+                totalrecvd = totalrecvd + len(chunk)
+        finally:
+            self.metrics.add('recv_blocked_secs', perf_counter() - start)
+            self.metrics.add('bytes_received', totalrecvd)
+        return b''.join(chunks)
+
+    def recv_some_into(self, buf):
+        """Receives whatever has arrived from the other host into a buffer,
+        with a single call to the socket (which blocks, or raises
+        BlockingIOError with a zero timeout, if nothing has).
+
+        :param buf: Where to put what is received (at most its length).
+        :type buf: writable bytes-like object
+
+        :return: How many bytes were received (at least one), or None
+            without a connection.
+        :rtype: integer
+
+        :raises BrokenSocketError: when the other host has closed the
+            connection.
+        """
+
+        if not self.sock:
+            return None
+
+        start = perf_counter()
+        try:
+            nrecvd = self.sock.recv_into(buf)
+        finally:
+            self.metrics.add('recv_syscalls')
+            self.metrics.add('recv_blocked_secs', perf_counter() - start)
+        if nrecvd == 0:
+            raise BrokenSocketError()
+        self.metrics.add('bytes_received', nrecvd)
+        return nrecvd
+
+    def recv_stream(self, num, bufsize=None):
+        """Receives a known number of bytes from the other host, a piece at a
+        time, straight into a single reusable buffer (so that large payloads
+        never have to be held in memory all at once).
+
+        :param num: The number of bytes to receive.
+        :type num: number
+
+        :param bufsize: The size of the buffer, i.e. the largest piece
+            (chunk_size if None or missing).
+        :type bufsize: number
+
+        :return: The pieces received. Each one is only valid until the next
+            one is requested.
+        :rtype: generator of memoryview
+
+        :raises BrokenSocketError: when the socket is broken before
+            we recieve the specified number of bytes.
+        """
+
+        buf = memoryview(bytearray(min(num, bufsize or self.chunk_size)))
+        totalrecvd = 0
         while totalrecvd < num:
-            chunk = self.sock.recv(min(num-totalrecvd, 2048))
-            if chunk == b'':
+            start = perf_counter()
+            try:
+                nrecvd = self.sock.recv_into(buf, min(num - totalrecvd, len(buf)))
+            finally:
+                self.metrics.add('recv_syscalls')
+                self.metrics.add('recv_blocked_secs', perf_counter() - start)
+            if nrecvd == 0:
                 raise BrokenSocketError()
-            chunks.append(chunk)
-            totalrecvd = totalrecvd + len(chunk)
-        return b''.join(chunks)
+            self.metrics.add('bytes_received', nrecvd)
+            totalrecvd = totalrecvd + nrecvd
+            yield buf[:nrecvd]
 
     def recv_struct(self, fmt):
         """Receives and unpacks a struct.
@@ -200,8 +403,8 @@ class FTSock:
             (usually an indexable tuple/list).
         """
 
-        slen = struct.calcsize(fmt)
-        return struct.unpack(fmt, self.recv_bytes(slen))
+        compiled = struct_for(fmt)
+        return compiled.unpack(self.recv_bytes(compiled.size))
 
     def recv_rstring(self):
         """Receives a string from the network sensibly (fixed-length).
@@ -210,9 +413,8 @@ class FTSock:
         :rtype: string
         """
 
-        length = self.recv_struct('!i')[0]
-        rstr = self.recv_struct('!{}s'.format(length))[0]
-        return rstr
+        length = INT.unpack(self.recv_bytes(INT.size))[0]
+        return self.recv_bytes(length)
 
     def recv_int(self):
         """Receives an integer from the network.
@@ -221,24 +423,63 @@ class FTSock:
         :rtype: integer
         """
 
-        return self.recv_struct('!i')[0]
+        return INT.unpack(self.recv_bytes(INT.size))[0]
 
-    def send_bytes(self, bstr):
+    def send_bytes(self, bstr, bulk=False):
         """Send raw bytes over the connection.
 
         :param bstr: A raw string of data to send.
         :type bstr: raw string
 
+        :param bulk: Whether this is bulk data (e.g. file contents) that is
+            subject to the rate limiters. Control messages are not, so they
+            are never stuck behind a large transfer's budget.
+        :type bulk: boolean
+
         :raises BrokenSocketError: when the socket is broken before we
             send all of the bytes passed.
         """
+        if self._frame is not None:
+            self._frame.raw(bstr)
+            self._frame_bulk = self._frame_bulk or bulk
+            return
+
+        if bulk and self.rate_limiters:
+            self.__send_limited(bstr)
+            return
+
         num = len(bstr)
         totalsent = 0
-        while totalsent < num:
-            sent = self.sock.send(bstr[totalsent:])
-            if sent == 0:
-                raise BrokenSocketError()
-            totalsent = totalsent + sent
+        start = perf_counter()
+        try:
+            while totalsent < num:
+                sent = self.sock.send(bstr[totalsent:])
+                self.metrics.add('send_syscalls')
+                if sent == 0:
+                    raise BrokenSocketError()
+                totalsent = totalsent + sent
+        finally:
+            self.metrics.add('send_blocked_secs', perf_counter() - start)
+            self.metrics.add('bytes_sent', totalsent)
+
+    def __send_limited(self, bstr):
+        """Sends bytes in pieces no larger than the smallest burst, waiting
+        on every rate limiter before each piece.
+
+        :param bstr: A raw string of data to send.
+        :type bstr: raw string
+        """
+
+        view = memoryview(bstr)
+        step = min(limiter.burst for limiter in self.rate_limiters)
+        for start in range(0, len(view), step):
+            piece = view[start:start + step]
+            wait, limiter = max(((limiter.reserve(len(piece)), limiter)
+                                 for limiter in self.rate_limiters),
+                                key=lambda reserved: reserved[0])
+            if wait > 0:
+                limiter.sleep(wait)
+            self.send_bytes(piece)
 
     def send_tok(self, token):
         """Sends a token by sending its raw schar equivalent.
@@ -249,6 +490,50 @@ class FTSock:
 
         self.send_bytes(token)
 
+    @contextmanager
+    def frame(self, token, length=None):
+        """Sends a message: its token (or, if framed is set, its frame
+        header), and then whatever is sent inside the with block as its body.
+
+        Unless length is given, the message is packed into one buffer and
+        sent all at once at the end of the block. The buffer is what the
+        with statement gives, so fields can be packed straight into it
+        (anything sent with send_struct() and the like goes there too).
+
+        :param token: The message's token.
+        :type token: FTProto
+
+        :param length: The length of the body, if known in advance, in which
+            case the body is sent as it is sent rather than being collected
+            in memory (so it should be given for bodies that are large).
+        :type length: integer
+
+        :return: The buffer, or None if length was given.
+        :rtype: ft_codec.Encoder
+        """
+
+        if length is not None:
+            self.send_bytes(FRAME_HEADER.pack(token, 0, length) if self.framed else token)
+            yield None
+            return
+
+        enc = Encoder()
+        if self.framed:
+            # The length is filled in at the end
+            enc.pack(FRAME_HEADER, token, 0, 0)
+        else:
+            enc.raw(token)
+        self._frame = enc
+        self._frame_bulk = False
+        try:
+            yield enc
+            bulk = self._frame_bulk
+        finally:
+            self._frame = None
+        if self.framed:
+            FRAME_HEADER.pack_into(enc.buf, 0, token, 0, len(enc) - FRAME_HEADER.size)
+        self.send_bytes(enc.view(), bulk)
+
     def send_struct(self, fmt, *data):
         """Packs and sends data over the network as a struct.
 
@@ -259,16 +544,26 @@ class FTSock:
         :type data: whatever the structure describes
         """
 
-        self.send_bytes(struct.pack(fmt, *data))
+        if self._frame is not None:
+            self._frame.pack(struct_for(fmt), *data)
+        else:
+            self.send_bytes(struct_for(fmt).pack(*data))
 
-    def send_rstring(self, rstr):
+    def send_rstring(self, rstr, bulk=False):
         """Packs and sends a raw string sensibly.
 
         :param rstr: The raw string to send.
         :type rstr: raw string
+
+        :param bulk: Whether the contents are bulk data (see send_bytes()).
+        :type bulk: boolean
         """
 
-        self.send_struct('!i{}s'.format(len(rstr)), len(rstr), rstr)
+        if self._frame is not None and not bulk:
+            self._frame.rstring(rstr)
+        else:
+            self.send_int(len(rstr))
+            self.send_bytes(rstr, bulk)
 
     def send_int(self, num):
         """Sends an integer over the network.
@@ -277,4 +572,4 @@ class FTSock:
         :type num: integer
         """
 
-        self.send_struct('!i', num)
+        self.send_bytes(INT.pack(num))
@@ -0,0 +1,163 @@
+"""Counters and histograms describing what the transfer layer is doing. FTSock
+and FTConn record into an FTStats object, which can be read with snapshot()
+or written out periodically as JSON lines by a StatsDumper.
+"""
+
+import json
+import math
+import threading
+import time
+
+class Histogram:
+    """Counts observed values in power-of-two sized buckets, along with their
+    count, sum, minimum and maximum.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        # Maps the exponent e to the number of values in (2**(e-1), 2**e]
+        self.buckets = {}
+
+    def observe(self, value):
+        """Records a single value.
+
+        :param value: The value to record (should not be negative).
+        :type value: number
+        """
+
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+        mantissa, exponent = math.frexp(value)
+        if mantissa == 0.5:
+            # Exact powers of two belong to the bucket they bound
+            exponent -= 1
+        self.buckets[exponent] = self.buckets.get(exponent, 0) + 1
+
+    def snapshot(self):
+        """:return: The current state of the histogram. Buckets are keyed by
+            their upper bound.
+        :rtype: dict
+        """
+
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'min': self.min,
+            'max': self.max,
+            'buckets': {repr(2.0 ** e): n for e, n in sorted(self.buckets.items())},
+        }
+
+
+class FTStats:
+    """Thread-safe collection of named counters and histograms.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+
+    def add(self, name, amount=1):
+        """Increases a counter.
+
+        :param name: The counter's name.
+        :type name: string
+
+        :param amount: How much to add to it.
+        :type amount: number
+        """
+
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def counter(self, name):
+        """:param name: The counter's name.
+        :type name: string
+
+        :return: The current value of a counter (0 if it was never added to).
+        :rtype: number
+        """
+
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def observe(self, name, value):
+        """Records a value in a histogram.
+
+        :param name: The histogram's name.
+        :type name: string
+
+        :param value: The value to record.
+        :type value: number
+        """
+
+        with self._lock:
+            hist = self._histograms.get(name)
+            if hist is None:
+                hist = self._histograms[name] = Histogram()
+            hist.observe(value)
+
+    def snapshot(self):
+        """:return: A copy of every counter and histogram, suitable for
+            serializing as JSON.
+        :rtype: dict
+        """
+
+        with self._lock:
+            return {
+                'time': time.time(),
+                'counters': dict(self._counters),
+                'histograms': {name: hist.snapshot()
+                               for name, hist in self._histograms.items()},
+            }
+
+    def dump(self, stream):
+        """Writes a snapshot to a stream as a single JSON line.
+
+        :param stream: Where to write the snapshot.
+        :type stream: text file-like object
+        """
+
+        stream.write(json.dumps(self.snapshot(), sort_keys=True) + '\n')
+        stream.flush()
+
+
+class StatsDumper(threading.Thread):
+    """Background thread that dumps an FTStats object to a stream at a fixed
+    interval, until stop() is called.
+    """
+
+    def __init__(self, stats, stream, interval=10):
+        """:param stats: The statistics to dump.
+        :type stats: FTStats
+
+        :param stream: Where to write each snapshot.
+        :type stream: text file-like object
+
+        :param interval: Time between snapshots, in seconds.
+        :type interval: number
+        """
+
+        super().__init__(daemon=True)
+        self.stats = stats
+        self.stream = stream
+        self.interval = interval
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            self.stats.dump(self.stream)
+
+    def stop(self):
+        """Stops dumping (after writing one final snapshot).
+        """
+
+        self._stopped.set()
+        self.join()
+        self.stats.dump(self.stream)
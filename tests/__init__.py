@@ -9,7 +9,18 @@
 from .test_ft_error import TestFTErrors
 from .test_ft_conn import TestFTConn
 from .test_ft_sock import TestFTSock
+from .test_ft_pack import TestFTPack
+from .test_ft_rate import TestTokenBucket
+from .test_ft_stats import TestFTStats
+from .test_ft_sched import TestFTScheduler
+from .test_ft_pages import TestFTListPager
+from .test_ft_parser import TestFTParser
+from .test_ft_codec import TestFTCodec
+from .test_ft_notify import TestFTNotifier
+from .test_ft_emul import TestEmulator
 from .test_encryption import TestPasswordMethods, \
 	TestDataMethods, TestEncryptMethod, \
-	TestDecryptMethod
-from .test_file_info import TestLocalFileInfoBrowser
+	TestDecryptMethod, TestDecryptor, TestEncryptor
+from .test_file_info import TestLocalFileInfoBrowser, TestIncomingFile, TestSparse, \
+	TestMerkle, TestInfoCache
+from .test_daemon import TestFTDaemon
@@ -0,0 +1,361 @@
+# pylint: disable = missing-docstring, missing-return-doc, missing-return-type-doc
+# pylint: disable = invalid-name
+# pylint: disable = protected-access
+
+# This file contains an emulated network, for testing how FTSock and FTConn
+# behave over links with latency, limited bandwidth, jitter, short reads and
+# writes and disconnects, without leaving the process.
+#
+# Time on the emulated links is virtual (see EmulatedClock): a recv() that
+# has to wait for data still in flight moves the clock forward instead of
+# sleeping, so a transfer over a slow WAN takes as long as the CPU needs,
+# and its virtual duration is the same on every run (for a given seed).
+
+import random
+import socket
+import threading
+from collections import deque
+from ft_conn.ft_sock import FTSock
+
+# How long (in real seconds) a blocked call waits for another thread to do
+# something, before deciding it never will (rather than hanging the tests)
+REAL_TIMEOUT = 10
+
+
+class EmulatedClock:
+    # Virtual time, shared by all the links of a network. Can be used as the
+    # clock and sleep of a ft_rate.TokenBucket.
+    def __init__(self):
+        self.now = 0.0
+        self.lock = threading.Lock()
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, secs):
+        self.advance_to(self.now + secs)
+
+    def advance_to(self, when):
+        with self.lock:
+            self.now = max(self.now, when)
+
+
+class RingBuffer:
+    # Fixed size circular byte buffer, so that queued data is never copied
+    # around as it is read
+    def __init__(self, capacity):
+        self._buf = bytearray(capacity)
+        self._start = 0
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    @property
+    def capacity(self):
+        return len(self._buf)
+
+    def free(self):
+        return len(self._buf) - self._len
+
+    def write(self, data):
+        # Adds as much of data as fits, returning how much that was
+        data = memoryview(data).cast('B')
+        num = min(len(data), self.free())
+        end = (self._start + self._len) % len(self._buf)
+        first = min(num, len(self._buf) - end)
+        self._buf[end:end + first] = data[:first]
+        self._buf[:num - first] = data[first:num]
+        self._len += num
+        return num
+
+    def read_into(self, view, num):
+        # Moves up to num bytes into view, returning how many were moved
+        num = min(num, self._len, len(view))
+        first = min(num, len(self._buf) - self._start)
+        view[:first] = self._buf[self._start:self._start + first]
+        view[first:num] = self._buf[:num - first]
+        self._start = (self._start + num) % len(self._buf)
+        self._len -= num
+        return num
+
+    def grow(self, capacity):
+        if capacity <= len(self._buf):
+            return
+        buf = bytearray(capacity)
+        num = self.read_into(memoryview(buf), self._len)
+        self._buf, self._start, self._len = buf, 0, num
+
+
+class EmulatedPipe:
+    # One direction of a link. Written data waits in the ring buffer (which
+    # stands for the send and receive buffers together) until its segment
+    # has crossed the link.
+    def __init__(self, clock, rng, latency=0, bandwidth=None, jitter=0,
+                 buffer_size=1 << 20, segment_size=1448, disconnect_after=None):
+        self.clock = clock
+        self.rng = rng
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.jitter = jitter
+        self.segment_size = segment_size
+        # Bytes that may still be written before the link breaks
+        self.disconnect_after = disconnect_after
+
+        self.ring = RingBuffer(buffer_size)
+        # (arrival time, size) of each segment still crossing the link
+        self.in_flight = deque()
+        # Bytes that have arrived and can be read
+        self.ready = 0
+        # When the link will be done sending what was written so far
+        self.link_free_at = 0.0
+        self.last_arrival = 0.0
+
+        self.closed = False     # Writer closed: reader gets EOF when drained
+        self.broken = False     # Connection reset: both ends get errors
+        self.cond = threading.Condition()
+
+    def write(self, data):
+        # Called with cond held
+        num = self.ring.write(data)
+        if self.disconnect_after is not None:
+            self.disconnect_after -= num
+        for start in range(0, num, self.segment_size):
+            size = min(self.segment_size, num - start)
+            if self.bandwidth:
+                self.link_free_at = max(self.clock(), self.link_free_at) + size / self.bandwidth
+            else:
+                self.link_free_at = self.clock()
+            arrival = self.link_free_at + self.latency + self.rng.uniform(0, self.jitter)
+            # TCP delivers in order, however much the segments were delayed
+            self.last_arrival = max(self.last_arrival, arrival)
+            self.in_flight.append((self.last_arrival, size))
+        self.cond.notify_all()
+        return num
+
+    def deliver(self):
+        # Called with cond held; moves arrived segments to ready
+        while self.in_flight and self.in_flight[0][0] <= self.clock():
+            self.ready += self.in_flight.popleft()[1]
+
+    def break_link(self):
+        with self.cond:
+            self.broken = True
+            self.cond.notify_all()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+class EmulatedSocket:
+    # The end of an emulated link, with the parts of the socket.socket
+    # interface that FTSock uses
+    def __init__(self, rx, tx, rng, short_reads=False, short_writes=False):
+        self._rx = rx
+        self._tx = tx
+        self._rng = rng
+        self.short_reads = short_reads
+        self.short_writes = short_writes
+        self._timeout = None
+        self._closed = False
+
+    def gettimeout(self):
+        return self._timeout
+
+    def settimeout(self, ntimeout):
+        self._timeout = ntimeout
+
+    def setsockopt(self, level, option, value):
+        # Larger buffers let more data be in flight at once
+        if level == socket.SOL_SOCKET and option == socket.SO_SNDBUF:
+            with self._tx.cond:
+                self._tx.ring.grow(value)
+        elif level == socket.SOL_SOCKET and option == socket.SO_RCVBUF:
+            with self._rx.cond:
+                self._rx.ring.grow(value)
+
+    def getsockopt(self, level, option):
+        if level == socket.SOL_SOCKET and option == socket.SO_SNDBUF:
+            return self._tx.ring.capacity
+        if level == socket.SOL_SOCKET and option == socket.SO_RCVBUF:
+            return self._rx.ring.capacity
+        return 0
+
+    def __wait(self, pipe, deadline):
+        # Called with pipe.cond held. Waits for the other end to do
+        # something, or (when something is in flight) for it to arrive.
+        if self._timeout == 0:
+            raise BlockingIOError(11, 'Resource temporarily unavailable')
+        if pipe.in_flight:
+            arrival = pipe.in_flight[0][0]
+            if deadline is not None and arrival > deadline:
+                pipe.clock.advance_to(deadline)
+                raise socket.timeout('timed out')
+            pipe.clock.advance_to(arrival)
+            return
+        if not pipe.cond.wait(REAL_TIMEOUT):
+            raise socket.timeout('timed out (nothing else is running)')
+
+    def __deadline(self, clock):
+        return None if self._timeout is None else clock() + self._timeout
+
+    def recv_into(self, buf, nbytes=0):
+        if self._closed:
+            raise OSError(9, 'Bad file descriptor')
+        view = memoryview(buf).cast('B')
+        nbytes = nbytes or len(view)
+        pipe = self._rx
+        deadline = self.__deadline(pipe.clock)
+        with pipe.cond:
+            while True:
+                if pipe.broken:
+                    raise ConnectionResetError(104, 'Connection reset by peer')
+                pipe.deliver()
+                if pipe.ready or nbytes == 0:
+                    break
+                if pipe.closed and not pipe.in_flight:
+                    return 0
+                self.__wait(pipe, deadline)
+
+            num = min(nbytes, pipe.ready)
+            if self.short_reads:
+                num = self._rng.randint(1, num)
+            num = pipe.ring.read_into(view, num)
+            pipe.ready -= num
+            pipe.cond.notify_all()
+            return num
+
+    def recv(self, num):
+        buf = bytearray(num)
+        return bytes(buf[:self.recv_into(buf, num)])
+
+    def send(self, data):
+        if self._closed:
+            raise OSError(9, 'Bad file descriptor')
+        pipe = self._tx
+        with pipe.cond:
+            while True:
+                if pipe.broken:
+                    raise ConnectionResetError(104, 'Connection reset by peer')
+                if pipe.closed:
+                    raise BrokenPipeError(32, 'Broken pipe')
+                if pipe.ring.free():
+                    break
+                # Buffers are full until the other end reads
+                if self._timeout == 0:
+                    raise BlockingIOError(11, 'Resource temporarily unavailable')
+                if not pipe.cond.wait(REAL_TIMEOUT):
+                    raise socket.timeout('timed out (nothing is reading)')
+
+            data = memoryview(data).cast('B')
+            num = len(data)
+            if pipe.disconnect_after is not None:
+                num = min(num, pipe.disconnect_after)
+            if self.short_writes and num > 1:
+                num = self._rng.randint(1, num)
+            num = pipe.write(data[:num])
+
+        if pipe.disconnect_after is not None and pipe.disconnect_after <= 0:
+            # The connection is reset just after these bytes were sent
+            self._tx.break_link()
+            self._rx.break_link()
+        return num
+
+    def sendall(self, data):
+        data = memoryview(data).cast('B')
+        while data:
+            data = data[self.send(data):]
+
+    def shutdown(self, how):
+        if how in (socket.SHUT_WR, socket.SHUT_RDWR):
+            self._tx.close()
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._tx.close()
+
+
+class EmulatedLink:
+    # A connection between two EmulatedSockets (a and b). The keyword
+    # arguments describe the link in both directions:
+    #   latency, jitter: one way delay, and the most extra random delay
+    #       per segment (seconds)
+    #   bandwidth: bytes per second (None for unlimited)
+    #   buffer_size: how much may be written but not yet read (bytes)
+    #   segment_size: how the data is split when crossing the link
+    #   disconnect_after: bytes that may be sent each way before the
+    #       connection is reset (None for never)
+    #   short_reads, short_writes: whether recv/send handle a random
+    #       amount of what was asked for
+    #   seed: seeds the randomness, so runs can be repeated
+    def __init__(self, clock=None, seed=0, short_reads=False, short_writes=False, **options):
+        self.clock = EmulatedClock() if clock is None else clock
+        rng = random.Random(seed)
+        ab = EmulatedPipe(self.clock, rng, **options)
+        ba = EmulatedPipe(self.clock, rng, **options)
+        self.a = EmulatedSocket(ba, ab, rng, short_reads, short_writes)
+        self.b = EmulatedSocket(ab, ba, rng, short_reads, short_writes)
+
+    def disconnect(self):
+        # Resets the connection, losing whatever was still in flight
+        self.a._tx.break_link()
+        self.b._tx.break_link()
+
+
+def emulated_pair(**options):
+    # Like socket.socketpair(), over an EmulatedLink
+    link = EmulatedLink(**options)
+    return link.a, link.b
+
+
+class EmulatedNetwork:
+    # Makes EmulatedLinks between EmulatedFTSocks that connect() on the same
+    # port, with the first to arrive playing the server, so that FTConn can
+    # connect, disconnect and reconnect as it would over a real network
+    def __init__(self, **options):
+        self.clock = options.pop('clock', None) or EmulatedClock()
+        self.options = options
+        self.links = []
+        self._waiting = {}
+        self._cond = threading.Condition()
+
+    def ftsock(self):
+        return EmulatedFTSock(self)
+
+    def connect(self, port, listen_timeout):
+        with self._cond:
+            waiting = self._waiting.pop(port, None)
+            if waiting is not None:
+                link = EmulatedLink(self.clock, seed=len(self.links), **self.options)
+                self.links.append(link)
+                waiting.append(link.b)
+                self._cond.notify_all()
+                return link.a, "Client"
+
+            slot = []
+            self._waiting[port] = slot
+            if not self._cond.wait_for(lambda: slot, min(listen_timeout, REAL_TIMEOUT)):
+                if self._waiting.get(port) is slot:
+                    del self._waiting[port]
+                raise socket.timeout('timed out')
+            return slot[0], "Server"
+
+    def disconnect(self):
+        # Resets every connection made so far
+        for link in self.links:
+            link.disconnect()
+
+
+class EmulatedFTSock(FTSock):
+    # Connects over an EmulatedNetwork instead of the real one
+    def __init__(self, network):
+        super().__init__()
+        self.network = network
+
+    def connect(self, host, port, listen_timeout=300):
+        sock, mode = self.network.connect(port, listen_timeout)
+        self.set_socket(sock)
+        return True, mode, "Success"
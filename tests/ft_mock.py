@@ -14,11 +14,12 @@ class MockSock():
         # Whether the socket is "connected" after init
         self.connected = con
 
-        # Receive buffer (receives come from here)
-        self.rbuf = b''
+        # Receive buffer (receives come from here). Bytearrays, so that
+        # taking bytes off the front doesn't copy the rest each time.
+        self.rbuf = bytearray()
 
         # Send buffer (sends go here)
-        self.sbuf = b''
+        self.sbuf = bytearray()
 
         # Error to raise if we read from an empty buffer (usually timeout or
         # ft_conn.ft_error.BrokenSocketError)
@@ -43,6 +44,10 @@ class MockSock():
         # Does nothing but the code does call this (for setting test options)
         pass
 
+    def getsockopt(self, a, b):
+        # The code only reads buffer sizes, which we don't have
+        return 0
+
     def recv(self, num):
         # Simulates socket.recv but gets data from the recv buffer
 
@@ -53,13 +58,20 @@ class MockSock():
         if self.pshutdown:
             return b''
 
-        if num > len(self.rbuf) and self.raise_on_end_recv is not None:
+        # Like a socket, give what there is rather than waiting for more
+        if num and not self.rbuf and self.raise_on_end_recv is not None:
             raise self.raise_on_end_recv
 
-        br = self.rbuf[:num]
-        self.rbuf = self.rbuf[num:]
+        br = bytes(self.rbuf[:num])
+        del self.rbuf[:num]
         return br
 
+    def recv_into(self, buf, num=0):
+        # Simulates socket.recv_into using recv
+        br = self.recv(num or len(buf))
+        buf[:len(br)] = br
+        return len(br)
+
     def send(self, br):
         # Simulates socket.send but sends data to the send buffer
 
@@ -75,7 +87,7 @@ class MockSock():
                                             # even though we check to make sure we don't
             raise self.raise_on_send        # pylint: disable = raising-bad-type
 
-        self.sbuf = self.sbuf + br
+        self.sbuf += br
 
         return len(br)
 
@@ -85,12 +97,12 @@ class MockSock():
 
     def append_bytes(self, br):
         # Add bytes for the socket to receive
-        self.rbuf = self.rbuf + br
+        self.rbuf += br
 
     def check_bytes(self, br):
         # Check that the socket sent the proper bytes
         if self.sbuf.startswith(br):
-            self.sbuf = self.sbuf[len(br):]
+            del self.sbuf[:len(br)]
             return True
 
         print(br, self.sbuf)
@@ -99,9 +111,9 @@ class MockSock():
 
     def retrieve_bytes(self, clear=True):
         # Takes the whole send buffer (used for faking connections)
-        br = self.sbuf
+        br = bytes(self.sbuf)
         if clear:
-            self.sbuf = b''
+            self.sbuf = bytearray()
         return br
 
     def ensure_esend(self):
@@ -121,7 +133,7 @@ class MockFTSock(FTSock):
         # What connect returns (if the bool is True, the socket gets "connected")
         self.crv = (True, "Server", "Success")
 
-    def connect(self, host, port):
+    def connect(self, host, port, listen_timeout=300):
         if self.crv[1]:
             self.sock.connected = True
         return self.crv
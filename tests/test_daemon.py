@@ -0,0 +1,194 @@
+# pylint: disable = missing-docstring, missing-return-doc, missing-return-type-doc
+# pylint: disable = invalid-name
+# pylint: disable = no-self-use
+# pylint: disable = protected-access
+
+import json
+import sys
+
+import pytest
+
+from hashlib import sha256
+from pathlib import Path
+
+from encryption import Encryption
+from file_info import FileInfo, SHA256, BLAKE2B_TREE, hash_file_chunks
+from ft_conn import FTProto, FTConn
+from ft_conn.daemon import FTDaemon
+from ft_conn.__main__ import main
+from ft_conn.ft_notify import FTNotifier
+from .ft_mock import MockFTSock
+
+def make_daemon(tmp_path):
+    share = tmp_path / 'share'
+    share.mkdir()
+    (share / 'a.txt').write_bytes(b'Hello')
+    (share / 'sub').mkdir()
+    (tmp_path / 'secret').write_bytes(b'Not shared')
+    return FTDaemon(share, 'pw', FTConn(MockFTSock(True)))
+
+def relay(daemon):
+    # Receive whatever the daemon sent, on another connection
+    c = FTConn(MockFTSock(True))
+    c.fts.sock.append_bytes(daemon.ftc.fts.sock.retrieve_bytes())
+    return c.receive_data()
+
+class TestFTDaemon:
+    def test_list(self, tmp_path):
+        d = make_daemon(tmp_path)
+        d.warm()
+        d.handle(FTProto.REQ_LIST, None)
+
+        tok, fl = relay(d)
+        assert tok == FTProto.RES_LIST
+        assert sorted(str(f.path) for f in fl) == ['a.txt', 'sub']
+
+        # The cached entries must keep their full paths
+        assert all(p.parent == d.share for p in d.browser._cache if p != d.share)
+
+    def test_list_pages(self, tmp_path):
+        d = make_daemon(tmp_path)
+        (d.share / 'b.txt').write_bytes(b'Hi')
+        d.handle(FTProto.REQ_LIST_PAGE, (0, 2))
+
+        tok, (cursor, next_cursor, page) = relay(d)
+        assert tok == FTProto.RES_LIST_PAGE and cursor == 0 and next_cursor
+        assert len(page) == 2
+
+        d.handle(FTProto.REQ_LIST_PAGE, (next_cursor, 2))
+        tok, (cursor, last_cursor, rest) = relay(d)
+        assert cursor == next_cursor and last_cursor == 0
+        assert sorted(str(f.path) for f in page + rest) == ['a.txt', 'b.txt', 'sub']
+
+    def test_lazy(self, tmp_path):
+        d = make_daemon(tmp_path)
+        d.ftc.caps = {'hashes': 1 << SHA256.id, 'lazy': 1}
+        d.handle(FTProto.REQ_LIST, None)
+
+        # Nothing has been hashed yet
+        c = FTConn(MockFTSock(True))
+        c.caps = d.ftc.caps
+        c.fts.sock.append_bytes(d.ftc.fts.sock.retrieve_bytes())
+        tok, fl = c.receive_data()
+        assert tok == FTProto.RES_LIST and [f.hash for f in fl] == [None, None]
+
+        d.handle(FTProto.REQ_HASH, [b'a.txt', b'../secret'])
+        c.fts.sock.append_bytes(d.ftc.fts.sock.retrieve_bytes())
+        tok, fl = c.receive_data()
+        assert tok == FTProto.RES_HASH and [str(f.path) for f in fl] == ['a.txt']
+        assert c.expected_hash(b'a.txt') == sha256(b'Hello').digest()
+
+    def test_chunk_hashes(self, tmp_path):
+        d = make_daemon(tmp_path)
+        d.ftc.caps = {'hashes': 1 << BLAKE2B_TREE.id, 'lazy': 1, 'chunks': 1}
+        d.handle(FTProto.REQ_HASH, [b'a.txt'])
+
+        c = FTConn(MockFTSock(True))
+        c.caps = d.ftc.caps
+        c.remote_file_list = [FileInfo(path=Path('a.txt'), file_hash=None, is_dir=False,
+                                       mtime=0, algorithm=BLAKE2B_TREE.id)]
+        c.fts.sock.append_bytes(d.ftc.fts.sock.retrieve_bytes())
+        assert c.receive_data()[0] == FTProto.RES_HASH
+        assert c.expected_chunks(b'a.txt') == hash_file_chunks(d.share / 'a.txt', BLAKE2B_TREE)[1]
+
+    def test_file(self, tmp_path):
+        d = make_daemon(tmp_path)
+        d.handle(FTProto.REQ_FILE, b'a.txt')
+
+        tok, (name, data) = relay(d)
+        assert tok == FTProto.RES_FILE and name == b'a.txt'
+        assert Encryption(data, 'pw').decrypt() == b'Hello'
+
+    def test_outside_share(self, tmp_path):
+        d = make_daemon(tmp_path)
+        with pytest.raises(PermissionError):
+            d.handle(FTProto.REQ_FILE, b'../secret')
+        assert d.ftc.fts.sock.ensure_esend()
+
+    def test_answer_errors(self, tmp_path, capsys):
+        # A bad request is reported, not raised, so the daemon keeps serving
+        d = make_daemon(tmp_path)
+        d.answer(FTProto.REQ_FILE, b'\xff.txt')
+        d.answer(FTProto.REQ_FILE, b'../secret')
+        assert capsys.readouterr().out.count('Could not answer REQ_FILE') == 2
+        assert d.ftc.fts.sock.ensure_esend()
+
+    def test_schedule(self, tmp_path):
+        d = make_daemon(tmp_path)
+        (d.share / 'b.txt').write_bytes(b'Hello there')
+        answered = []
+        d.answer = lambda message_type, data: answered.append((message_type, data))
+
+        d.schedule(FTProto.REQ_FILES, [b'a.txt', b'b.txt'])
+        d.schedule(FTProto.REQ_FILE, b'b.txt')
+        d.schedule(FTProto.REQ_FILE, b'a.txt')
+        d.schedule(FTProto.REQ_LIST, None)
+        assert d.schedule(FTProto.RES_LIST, []) is None
+
+        while d.scheduler.run_next():
+            pass
+        # The list goes first, then single files (smallest first), then batches
+        assert answered == [(FTProto.REQ_LIST, None),
+                            (FTProto.REQ_FILE, b'a.txt'),
+                            (FTProto.REQ_FILE, b'b.txt'),
+                            (FTProto.REQ_FILES, [b'a.txt', b'b.txt'])]
+
+    def test_push_changes(self, tmp_path):
+        d = make_daemon(tmp_path)
+        d.watch_interval = 0
+        d.push_changes()
+        assert d.ftc.fts.sock.retrieve_bytes() == b''
+
+        # Once subscribed, changes in the share are pushed when they settle down
+        d.ftc.subscriber = True
+        d.handle(FTProto.SUBSCRIBE, True)
+        d.notifier = FTNotifier(debounce=0, max_delay=0)
+        (d.share / 'a.txt').write_bytes(b'Hello again')
+        (d.share / 'sub' / 'b.txt').write_bytes(b'Hi')
+        d.push_changes()
+        assert relay(d) == (FTProto.CHANGED, [b'a.txt', b'sub'])
+
+        d.push_changes()
+        assert d.ftc.fts.sock.retrieve_bytes() == b''
+
+        # Files modified deeper down are only noticed by the occasional deep look
+        (d.share / 'sub' / 'b.txt').write_bytes(b'Hello')
+        d.push_changes()
+        assert d.ftc.fts.sock.retrieve_bytes() == b''
+        d.deep_watch_interval = 0
+        d.push_changes()
+        assert relay(d) == (FTProto.CHANGED, [b'sub'])
+
+    def test_main_stats(self, tmp_path, monkeypatch):
+        # The statistics file gets a final snapshot and is closed, however
+        # serving ends
+        stats = tmp_path / 'stats.jsonl'
+        monkeypatch.setattr(sys, 'argv', ['ft_conn', '127.0.0.1:1', '--share', str(tmp_path / 's'),
+                                          '--stats', str(stats)])
+        def interrupted(self, host, port):
+            raise KeyboardInterrupt()
+        monkeypatch.setattr(FTDaemon, 'serve', interrupted)
+        with pytest.raises(KeyboardInterrupt):
+            main()
+        assert 'counters' in json.loads(stats.read_text().splitlines()[-1])
+
+    def test_main_rate(self, tmp_path, monkeypatch):
+        # --rate and --burst limit what the daemon's connection sends
+        served = []
+        def serve(self, host, port):
+            served.append(self)
+            return "Connection failed"
+        monkeypatch.setattr(FTDaemon, 'serve', serve)
+        argv = ['ft_conn', '127.0.0.1:1', '--share', str(tmp_path / 's')]
+        monkeypatch.setattr(sys, 'argv', argv + ['--rate', '1000', '--burst', '200'])
+        assert main() == 1
+        (limiter,) = served[0].ftc.fts.rate_limiters
+        assert (limiter.rate, limiter.burst) == (1000, 200)
+
+        monkeypatch.setattr(sys, 'argv', argv)
+        main()
+        assert served[1].ftc.fts.rate_limiters == []
+
+        monkeypatch.setattr(sys, 'argv', argv + ['--burst', '200'])
+        with pytest.raises(SystemExit):
+            main()
@@ -12,6 +12,8 @@ import unittest
 from encryption import PasswordError
 from encryption import DataError
 from encryption import Encryption
+from encryption import Decryptor
+from encryption import Encryptor
 
 
 class TestPasswordMethods(unittest.TestCase):
@@ -100,4 +102,59 @@ class TestDecryptMethod(unittest.TestCase):
     def test_decrypt(self):
         self.enc.encrypt()
         d_data = self.enc.decrypt()
-        self.assertEqual(self.enc.data, d_data)
\ No newline at end of file
+        self.assertEqual(self.enc.data, d_data)
+
+    def test_decrypt_binary(self):
+        data = bytes(range(256))
+        encrypted = Encryption(data, "defaultP").encrypt()
+        self.assertEqual(Encryption(encrypted, "defaultP").decrypt(), data)
+
+
+class TestDecryptor(unittest.TestCase):
+    """Testing class to test decrypting a piece at a time
+    """
+
+    def decrypt_in_pieces(self, encrypted, step, password="defaultP"):
+        dec = Decryptor(password)
+        pieces = [dec.update(encrypted[i:i + step]) for i in range(0, len(encrypted), step)]
+        return b"".join(pieces) + dec.finalize()
+
+    def test_pieces(self):
+        for data in (b"", b"defaultD", bytes(range(256)) * 40):
+            encrypted = Encryption(data, "defaultP").encrypt()
+            for step in (1, 13, 4096):
+                self.assertEqual(self.decrypt_in_pieces(encrypted, step), data)
+
+    def test_size_bound(self):
+        for data in (b"", b"defaultD", b"0123456789abcdef"):
+            encrypted = Encryption(data, "defaultP").encrypt()
+            self.assertGreaterEqual(Decryptor.plaintext_size_bound(len(encrypted)), len(data))
+
+    def test_wrong_password(self):
+        encrypted = Encryption(b"defaultD", "defaultP").encrypt()
+        self.assertRaises(DataError, self.decrypt_in_pieces, encrypted, 7, "wrong")
+
+    def test_truncated(self):
+        encrypted = Encryption(b"defaultD", "defaultP").encrypt()
+        self.assertRaises(DataError, self.decrypt_in_pieces, encrypted[:40], 7)
+
+    def test_password_error(self):
+        self.assertRaises(PasswordError, Decryptor, None)
+
+
+class TestEncryptor(unittest.TestCase):
+    """Testing class to test encrypting a piece at a time
+    """
+
+    def test_pieces(self):
+        for data in (b"", b"defaultD", bytes(range(256)) * 40):
+            for step in (1, 13, 4096):
+                enc = Encryptor("defaultP")
+                pieces = [enc.update(data[i:i + step]) for i in range(0, len(data), step)]
+                encrypted = b"".join(pieces) + enc.finalize()
+
+                self.assertEqual(len(encrypted), Encryptor.encrypted_size(len(data)))
+                self.assertEqual(Encryption(encrypted, "defaultP").decrypt(), data)
+
+    def test_password_error(self):
+        self.assertRaises(PasswordError, Encryptor, 123)
@@ -8,8 +8,19 @@ import pytest
 from base64 import b64decode
 from pathlib import PurePath
 from hashlib import sha256
+import hashlib
+import os
+import tempfile
+import threading
 from os import fsencode
-from file_info import FileInfo, LocalFileInfoBrowser, UnrecognizedSpecialFile
+from file_info import FileInfo, LocalFileInfoBrowser, UnrecognizedSpecialFile, IncomingFile, \
+    IntegrityError, CommitBatch, Durability, data_extents, hash_file, is_sparse, \
+    BLAKE2B, SHA256, hash_algorithm, HashAlgorithm, TreeHash, hash_file_chunks, InfoCache
+from file_info.cache import _entry_size
+
+# Where the contents of mock files are written, so that they can be hashed
+# like real files
+_mock_dir = tempfile.TemporaryDirectory()
 
 class MockPath:
 
@@ -42,6 +53,12 @@ class MockPath:
         return self._read_bytes
     def iterdir(self):
         return self._iterdir
+    def __fspath__(self):
+        # Written every time, since tests change _read_bytes
+        path = os.path.join(_mock_dir.name, str(id(self)))
+        with open(path, "wb") as f:
+            f.write(self._read_bytes)
+        return path
 
 class MockStatResult:
     def __init__(self, *, st_mtime_ns):
@@ -149,6 +166,61 @@ class TestLocalFileInfoBrowser:
         L._shallow_refresh(p)
         assert p not in L._cache
 
+    def test_algorithm(self):
+        p = get_mock_file_path()
+        L = LocalFileInfoBrowser(BLAKE2B)
+        info = L.get_info(p)
+        assert info.hash == BLAKE2B.new(b"Mock contents").digest()
+        assert info.algorithm == BLAKE2B.id
+        assert not L.is_possibly_changed(p)
+
+        # Entries made with another algorithm are hashed again
+        L.algorithm = SHA256
+        assert L.is_possibly_changed(p)
+        assert L.get_info(p).hash == sha256(b"Mock contents").digest()
+        assert hash_algorithm(SHA256.id) is SHA256
+
+    def test_peek_info(self, tmp_path):
+        p = tmp_path / "file"
+        p.write_bytes(b"Hello")
+        L = LocalFileInfoBrowser()
+
+        # Nothing is hashed until get_info()
+        info = L.peek_info(p)
+        assert info.hash is None and not info.is_dir
+        assert p not in L._cache
+        assert [i.hash for i in L.iter_info(tmp_path, lazy=True)] == [None]
+
+        L.get_info(p)
+        assert L.peek_info(p).hash == sha256(b"Hello").digest()
+        assert L.peek_info(tmp_path / "gone") is None
+
+    def test_changes(self, tmp_path):
+        (tmp_path / "a").write_bytes(b"Hello")
+        (tmp_path / "b").write_bytes(b"Gone")
+        (tmp_path / "dir").mkdir()
+        L = LocalFileInfoBrowser()
+
+        # The first call only takes a snapshot
+        assert L.changes(tmp_path) == set()
+        assert L.changes(tmp_path) == set()
+
+        (tmp_path / "a").write_bytes(b"Hello again")
+        (tmp_path / "b").unlink()
+        (tmp_path / "c").write_bytes(b"New")
+        (tmp_path / "dir" / "inner").write_bytes(b"Deep")
+        assert L.changes(tmp_path) == {tmp_path / name for name in ("a", "b", "c", "dir")}
+        assert L.changes(tmp_path) == set()
+
+        # Without looking deep, only directories with new or removed entries are looked inside
+        inner = tmp_path / "dir" / "inner"
+        inner.write_bytes(b"Deeper")
+        os.utime(str(inner), ns=(1, 1))
+        assert L.changes(tmp_path, deep=False) == set()
+        assert L.changes(tmp_path) == {tmp_path / "dir"}
+        (tmp_path / "dir" / "new").write_bytes(b"")
+        assert L.changes(tmp_path, deep=False) == {tmp_path / "dir"}
+
     def test__force_refresh(self):
         p = get_mock_dir_path(iterdir=[
             get_mock_file_path("HAM", b"sandwich"),
@@ -156,4 +228,356 @@ class TestLocalFileInfoBrowser:
         L = LocalFileInfoBrowser()
         L.force_refresh(p)
         assert p in L._cache
-        assert p._iterdir[1] in L._cache
\ No newline at end of file
+        assert p._iterdir[1] in L._cache
+
+
+def make_info(name, is_dir=False):
+    return FileInfo(path=PurePath(name), file_hash=get_mock_hash(), is_dir=is_dir, mtime=0)
+
+
+class TestInfoCache:
+
+    def test_lru(self):
+        c = InfoCache(max_entries=3)
+        for name in "abc":
+            c[PurePath(name)] = make_info(name)
+        assert PurePath("a") in c
+        c[PurePath("d")] = make_info("d")
+
+        # "b" was the least recently used
+        assert PurePath("b") not in c
+        assert sorted(str(p) for p in c) == ["a", "c", "d"]
+
+    def test_dirs_kept(self):
+        c = InfoCache(max_entries=2)
+        c[PurePath("dir")] = make_info("dir", is_dir=True)
+        c[PurePath("a")] = make_info("a")
+        c[PurePath("b")] = make_info("b")
+        assert PurePath("dir") in c and PurePath("a") not in c
+
+    def test_max_bytes(self):
+        c = InfoCache(max_entries=None, max_bytes=1000)
+        for name in "abcdef":
+            c[PurePath(name)] = make_info(name)
+        assert 0 < len(c) < 6
+
+    def test_index(self, tmp_path):
+        c = InfoCache(max_entries=1, index=tmp_path / "index.db")
+        info = make_info("a")
+        info.chunks = [b"1" * 32, b"2" * 32]
+        c[PurePath("a")] = info
+        c[PurePath("b")] = make_info("b")
+
+        # "a" was evicted to the index, and comes back from it
+        assert c[PurePath("a")].chunks == info.chunks
+        assert c.get(PurePath("nope")) is None
+        del c[PurePath("b")]
+        c.close()
+
+        c = InfoCache(index=tmp_path / "index.db")
+        assert c[PurePath("a")].hash == get_mock_hash()
+        assert PurePath("b") not in c
+
+    def test_threads(self, tmp_path):
+        # Several threads can share a cache without losing track of its budget
+        c = InfoCache(max_entries=50, index=tmp_path / "index.db")
+        def churn(start):
+            for i in range(start, start + 500):
+                c[PurePath(str(i % 200))] = make_info(str(i % 200))
+                c.get(PurePath(str((i * 7) % 200)))
+        threads = [threading.Thread(target=churn, args=(n * 1000,)) for n in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert len(c) <= 50
+        assert c._bytes == sum(_entry_size(path, c[path]) for path in list(c))
+
+    def test_browser_bounded(self, tmp_path):
+        for i in range(10):
+            (tmp_path / str(i)).write_bytes(bytes([i]))
+        L = LocalFileInfoBrowser(cache=InfoCache(max_entries=4))
+        assert len(L.list_info(tmp_path)) == 10
+        assert len(L._cache) == 4
+
+
+class TestIncomingFile:
+
+    def test_write(self, tmp_path):
+        p = tmp_path / "received"
+        f = IncomingFile(p, 1000)
+        f.write(b"Hello, ")
+        f.write(memoryview(b"World!"))
+        assert f.close() == p
+        assert p.read_bytes() == b"Hello, World!"
+
+    def test_abort(self, tmp_path):
+        p = tmp_path / "received"
+        f = IncomingFile(p)
+        f.write(b"partial")
+        f.abort()
+        assert not p.exists()
+
+    def test_write_at(self, tmp_path):
+        p = tmp_path / "received"
+        f = IncomingFile(p, 10)
+        f.write_at(5, b"World")
+        f.write_at(0, b"Hello")
+        f.close()
+        assert p.read_bytes() == b"HelloWorld"
+
+    def test_abort_keeps_old(self, tmp_path):
+        p = tmp_path / "received"
+        p.write_bytes(b"old")
+        f = IncomingFile(p)
+        f.write(b"partial")
+        f.abort()
+        assert p.read_bytes() == b"old"
+        assert list(tmp_path.iterdir()) == [p]
+
+    def test_verify(self, tmp_path):
+        p = tmp_path / "received"
+        f = IncomingFile(p, expected_hash=sha256(b"HelloWorld").digest())
+        f.write(b"Hello")
+        f.write(b"World")
+        assert f.close() == p
+        assert p.read_bytes() == b"HelloWorld"
+
+    def test_verify_out_of_order(self, tmp_path):
+        p = tmp_path / "received"
+        f = IncomingFile(p, 10, expected_hash=sha256(b"HelloWorld").digest())
+        f.write_at(5, b"World")
+        assert f.digest() is None
+        f.write_at(0, b"Hello")
+        assert f.digest() == sha256(b"HelloWorld").digest()
+        f.close()
+        assert p.read_bytes() == b"HelloWorld"
+
+    def test_verify_algorithm(self, tmp_path):
+        p = tmp_path / "received"
+        f = IncomingFile(p, expected_hash=BLAKE2B.new(b"Hello").digest(), algorithm=BLAKE2B)
+        f.write(b"Hello")
+        assert f.close() == p
+
+    def test_verify_mismatch(self, tmp_path):
+        p = tmp_path / "received"
+        p.write_bytes(b"old")
+        f = IncomingFile(p, expected_hash=sha256(b"HelloWorld").digest())
+        f.write(b"HelloThere")
+        with pytest.raises(IntegrityError):
+            f.close()
+        assert p.read_bytes() == b"old"
+        assert list(tmp_path.iterdir()) == [p]
+
+    def count_syncs(self, monkeypatch):
+        syncs = []
+        monkeypatch.setattr(os, 'fdatasync', lambda fd: syncs.append('data'), raising=False)
+        monkeypatch.setattr(os, 'fsync', lambda fd: syncs.append('fsync'))
+        return syncs
+
+    @pytest.mark.parametrize('durability, expected', [
+        (Durability.NONE, []),
+        (Durability.BATCH, ['data', 'data', 'data', 'fsync']),
+        (Durability.STRICT, ['data'] * 3 + ['fsync'] * 3),
+    ])
+    def test_commit_batch(self, tmp_path, monkeypatch, durability, expected):
+        syncs = self.count_syncs(monkeypatch)
+        batch = CommitBatch(durability)
+        for name in ("a", "b", "c"):
+            f = IncomingFile(tmp_path / name, batch=batch)
+            f.write(name.encode())
+            f.close()
+
+        # Nothing is in place until the batch is committed
+        assert not (tmp_path / "a").exists()
+        assert batch.commit() == [tmp_path / "a", tmp_path / "b", tmp_path / "c"]
+        assert syncs == expected
+        assert sorted(p.name for p in tmp_path.iterdir()) == ["a", "b", "c"]
+
+    def test_commit_batch_closes_files(self, tmp_path):
+        # A batch holds no descriptors, so it can be larger than the limit on them
+        resource = pytest.importorskip('resource')
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(64, hard), hard))
+        try:
+            batch = CommitBatch(Durability.NONE)
+            for i in range(200):
+                f = IncomingFile(tmp_path / str(i), batch=batch)
+                f.write(b"x")
+                f.close()
+            assert len(batch.commit()) == 200
+        finally:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+        assert len(list(tmp_path.iterdir())) == 200
+
+    def test_commit_batch_abort(self, tmp_path):
+        batch = CommitBatch()
+        f = IncomingFile(tmp_path / "a", batch=batch)
+        f.write(b"a")
+        f.close()
+        batch.abort()
+        assert list(tmp_path.iterdir()) == []
+
+    def test_strict(self, tmp_path, monkeypatch):
+        syncs = self.count_syncs(monkeypatch)
+        f = IncomingFile(tmp_path / "a", durability=Durability.STRICT)
+        f.write(b"a")
+        f.close()
+        assert syncs == ['data', 'fsync']
+        assert (tmp_path / "a").read_bytes() == b"a"
+
+
+def make_sparse(path):
+    # 1 MiB hole, 5 bytes of data, 1 MiB hole, 5 bytes, and a hole to the end
+    with open(str(path), "wb") as out:
+        out.truncate(4 << 20)
+        out.seek(1 << 20)
+        out.write(b"Hello")
+        out.seek(2 << 20)
+        out.write(b"World")
+    dense = bytearray(4 << 20)
+    dense[1 << 20:(1 << 20) + 5] = b"Hello"
+    dense[2 << 20:(2 << 20) + 5] = b"World"
+    return bytes(dense)
+
+
+class TestSparse:
+
+    def test_data_extents(self, tmp_path):
+        p = tmp_path / "sparse"
+        dense = make_sparse(p)
+        fd = os.open(str(p), os.O_RDONLY)
+        try:
+            extents = list(data_extents(fd, len(dense)))
+        finally:
+            os.close(fd)
+
+        # Whatever the filesystem can tell us, all of the data is covered,
+        # and only zeros are left out
+        covered = bytearray(len(dense))
+        for offset, length in extents:
+            covered[offset:offset + length] = dense[offset:offset + length]
+        assert covered == dense
+        if is_sparse(p):
+            assert sum(length for _, length in extents) < len(dense)
+
+    def test_hash_file(self, tmp_path):
+        p = tmp_path / "sparse"
+        dense = make_sparse(p)
+        assert hash_file(p) == sha256(dense).digest()
+        assert LocalFileInfoBrowser().get_fresh_hash(p) == sha256(dense).digest()
+
+        (tmp_path / "empty").write_bytes(b"")
+        assert hash_file(tmp_path / "empty") == sha256().digest()
+
+    def test_incoming_sparse(self, tmp_path):
+        p = tmp_path / "received"
+        dense = make_sparse(tmp_path / "original")
+        extents = [(1 << 20, 5), (2 << 20, 5)]
+        f = IncomingFile(p, len(dense), sha256(dense).digest(), extents=extents)
+        f.write(b"Hel")
+        f.write(b"loWor")
+        f.write(b"ld")
+        with pytest.raises(ValueError):
+            f.write(b"!")
+        assert f.close() == p
+
+        assert p.read_bytes() == dense
+        assert is_sparse(p) == is_sparse(tmp_path / "original")
+
+
+# A tree hash with small chunks, so tests don't need huge files
+SMALL_TREE = HashAlgorithm('blake2b-small-tree', 60, hashlib.blake2b, 1000)
+
+class TestMerkle:
+
+    def test_tree_hash(self, tmp_path):
+        p = tmp_path / "file"
+        data = bytes(range(256)) * 20
+        p.write_bytes(data)
+
+        # Hashing the chunks in parallel gives the same as hashing in order
+        root, leaves = hash_file_chunks(p, SMALL_TREE, workers=3)
+        tree = SMALL_TREE.new()
+        tree.update(data[:1500])
+        tree.update(data[1500:])
+        assert len(leaves) == 6 and tree.chunk_digests() == leaves
+        assert tree.digest() == root == hash_file(p, SMALL_TREE)
+
+        # Changing one byte changes only its chunk
+        p.write_bytes(data[:2500] + b"!" + data[2501:])
+        new_root, new_leaves = hash_file_chunks(p, SMALL_TREE)
+        assert new_root != root
+        assert [a == b for a, b in zip(leaves, new_leaves)] == [True, True, False, True, True, True]
+
+    def test_small_files(self, tmp_path):
+        (tmp_path / "empty").write_bytes(b"")
+        assert hash_file_chunks(tmp_path / "empty", SMALL_TREE)[1] == [TreeHash(hashlib.blake2b).digest()]
+        assert hash_file(tmp_path / "empty", SMALL_TREE) == SMALL_TREE.new().digest()
+
+    def test_sparse(self, tmp_path):
+        p = tmp_path / "sparse"
+        dense = make_sparse(p)
+        tree = SMALL_TREE.new()
+        tree.update(dense)
+        assert hash_file_chunks(p, SMALL_TREE) == (tree.digest(), tree.chunk_digests())
+
+    def test_index(self, tmp_path):
+        p = tmp_path / "file"
+        p.write_bytes(bytes(2500))
+        info = LocalFileInfoBrowser(SMALL_TREE).get_info(p)
+        assert (info.hash, info.chunks) == hash_file_chunks(p, SMALL_TREE)
+
+    def test_append(self, tmp_path, monkeypatch):
+        p = tmp_path / "log"
+        data = bytes(range(256)) * 22
+        p.write_bytes(data[:5500])
+        L = LocalFileInfoBrowser(SMALL_TREE)
+        L.get_info(p)
+
+        # Only the old last chunk and what was appended are read again
+        reads = []
+        pread = os.pread
+        def recording_pread(fd, num, offset):
+            reads.append(offset)
+            return pread(fd, num, offset)
+        monkeypatch.setattr(os, "pread", recording_pread)
+        with open(p, "ab") as f:
+            f.write(data[5500:])
+        os.utime(p, ns=(0, p.stat().st_mtime_ns + 1))
+        info = L.get_info(p)
+        assert reads and min(reads) == 5000
+        monkeypatch.undo()
+        assert (info.hash, info.chunks) == hash_file_chunks(p, SMALL_TREE)
+
+        # One whose last chunk changed as it grew is read again in full
+        p.write_bytes(data[:5600] + b"!" * 500)
+        os.utime(p, ns=(0, info.mtime + 1))
+        info = L.get_info(p)
+        assert (info.hash, info.chunks) == hash_file_chunks(p, SMALL_TREE)
+
+        # So is one that didn't grow
+        p.write_bytes(data[:100])
+        os.utime(p, ns=(0, info.mtime + 1))
+        info = L.get_info(p)
+        assert (info.hash, info.chunks) == hash_file_chunks(p, SMALL_TREE)
+
+    def test_incoming_chunks(self, tmp_path):
+        data = bytes(range(256)) * 10
+        tree = SMALL_TREE.new()
+        tree.update(data)
+
+        f = IncomingFile(tmp_path / "good", expected_hash=tree.digest(), algorithm=SMALL_TREE,
+                         expected_chunks=tree.chunk_digests())
+        f.write(data)
+        assert f.chunk_digests() == tree.chunk_digests()
+        f.close()
+
+        # A bad chunk is caught as soon as it is written
+        f = IncomingFile(tmp_path / "bad", algorithm=SMALL_TREE,
+                         expected_chunks=tree.chunk_digests())
+        f.write(data[:1000])
+        with pytest.raises(IntegrityError):
+            f.write(b"!" * 1000)
+        f.abort()
+        assert list(tmp_path.iterdir()) == [tmp_path / "good"]
@@ -0,0 +1,73 @@
+# pylint: disable = missing-docstring, missing-return-doc, missing-return-type-doc
+# pylint: disable = invalid-name
+# pylint: disable = no-self-use
+# pylint: disable = protected-access
+
+import struct
+from pathlib import Path
+import pytest
+
+from file_info import FileInfo, BLAKE2B
+from ft_conn.ft_codec import Encoder, Decoder, encode_entries, decode_entries, struct_for, \
+    INT, CURSORS
+from ft_conn.ft_error import UnexpectedValueError
+
+class TestFTCodec:
+    def test_struct_for(self):
+        assert struct_for('!i') is INT
+        assert struct_for('!QQ').size == 16
+
+    def test_encoder(self):
+        # The buffer grows as needed, and holds exactly what was packed
+        enc = Encoder(4)
+        enc.pack(CURSORS, 1, 2)
+        enc.rstring(b'abc')
+        enc.raw(b'!')
+        assert bytes(enc.view()) == struct.pack('!QQi', 1, 2, 3) + b'abc!'
+        assert len(enc) == 24 and len(enc.buf) >= 24
+
+    def test_decoder(self):
+        dec = Decoder(struct.pack('!Qi', 7, 2) + b'ab' + b'x')
+        assert dec.unpack(struct_for('!Q')) == (7,)
+        assert dec.rstring() == b'ab' and dec.left == 1
+        with pytest.raises(UnexpectedValueError):
+            dec.unpack(INT)
+        with pytest.raises(UnexpectedValueError):
+            dec.raw(2)
+
+    def test_entries(self):
+        file_list = [FileInfo(path=Path('a/b.txt'), file_hash=b'h' * 32, is_dir=False, mtime=5),
+                     FileInfo(path=Path('a'), file_hash=b'd' * 32, is_dir=True, mtime=6)]
+        enc = Encoder()
+        encode_entries(enc, file_list, False)
+        assert bytes(enc.view()) == struct.pack('!i', 2) \
+            + struct.pack('!i7s32s?Q', 7, b'a/b.txt', b'h' * 32, False, 5) \
+            + struct.pack('!i1s32s?Q', 1, b'a', b'd' * 32, True, 6)
+        decoded = decode_entries(Decoder(enc.view()), False)
+        assert [(f.path, f.hash, f.is_dir, f.mtime) for f in decoded] == \
+            [(f.path, f.hash, f.is_dir, f.mtime) for f in file_list]
+
+        # With the hashes negotiated, digests can be any length, or pending
+        file_list = [FileInfo(path=Path('c'), file_hash=None, is_dir=False, mtime=1,
+                              algorithm=BLAKE2B.id)]
+        enc = Encoder()
+        encode_entries(enc, file_list, True)
+        (decoded,) = decode_entries(Decoder(enc.view()), True)
+        assert decoded.hash is None and decoded.algorithm == BLAKE2B.id
+
+    def test_chunks(self):
+        # The hashes of the chunks follow each entry, and only when asked for
+        file_list = [FileInfo(path=Path('big'), file_hash=b'r' * 4, is_dir=False, mtime=1,
+                              chunks=[b'1111', b'2222']),
+                     FileInfo(path=Path('small'), file_hash=None, is_dir=False, mtime=1)]
+        enc = Encoder()
+        encode_entries(enc, file_list, True, chunks=True)
+        dec = Decoder(enc.view())
+        big, small = decode_entries(dec, True, chunks=True)
+        assert big.chunks == [b'1111', b'2222'] and small.chunks is None
+        assert dec.left == 0
+
+        enc = Encoder()
+        encode_entries(enc, file_list, True)
+        (big, _) = decode_entries(Decoder(enc.view()), True)
+        assert big.chunks is None
@@ -3,12 +3,20 @@
 # pylint: disable = no-self-use
 # pylint: disable = protected-access
 
+import socket
 import struct
+from hashlib import sha256
+import pytest
 from pathlib import Path
 
-from file_info import FileInfo
+from file_info import FileInfo, IncomingFile, is_sparse, SHA256, BLAKE2B, BLAKE2S, \
+    BLAKE2B_TREE
 
 from ft_conn import FTProto, FTConn
+from ft_conn.ft_sock import FTSock
+from ft_conn.ft_error import BrokenSocketError, UnexpectedValueError
+from ft_conn.ft_proto import FRAME_HEADER
+from ft_conn.ft_pack import pack_files
 
 from .ft_mock import MockFTSock
 
@@ -21,8 +29,9 @@ wrong_handshake = b'lolwut??'   # Wrong handshake
 wrong_hs_resp = b'response'     # Wrong response to correct handshake
 wrong_hs_c_resp = b'??tuwlol'   # Correct response to wrong handshake
 
-correct_version =  1
-wrong_version = 0
+correct_version =  3
+old_version = 2     # Still spoken, without frames
+wrong_version = 1
 
 test_file_name = 'test.txt'
 test_file_contents = b'Hello, World!'
@@ -45,6 +54,19 @@ def pr(rstr):
     # Packs a raw string (like the protocol does)
     return struct.pack('!i{}s'.format(len(rstr)), len(rstr), rstr)
 
+def pc(stripes=1, ticket=0, heartbeat=1, sparse=1, pages=1, hashes=0b11110, lazy=1, push=1,
+       chunks=1):
+    # Packs the capabilities sent during the handshake
+    return pi(9) + pr(b'chunks') + struct.pack('!q', chunks) \
+        + pr(b'hashes') + struct.pack('!q', hashes) \
+        + pr(b'heartbeat') + struct.pack('!q', heartbeat) \
+        + pr(b'lazy') + struct.pack('!q', lazy) \
+        + pr(b'pages') + struct.pack('!q', pages) \
+        + pr(b'push') + struct.pack('!q', push) \
+        + pr(b'sparse') + struct.pack('!q', sparse) \
+        + pr(b'stripes') + struct.pack('!q', stripes) \
+        + pr(b'ticket') + struct.pack('!q', ticket)
+
 
 class TestFTConn:
     def test_connect_fail(self):
@@ -89,12 +111,15 @@ class TestFTConn:
         c = FTConn(MockFTSock())
         c.fts.sock.append_bytes(correct_handshake)
         c.fts.sock.append_bytes(pi(correct_version))
+        c.fts.sock.append_bytes(pc())
+        c._new_ticket = lambda: 1234
 
         assert c.connect(0, 0) == "Success"
 
-        # Checking sent handshake
+        # Checking sent handshake (with a new session ticket)
         assert c.fts.sock.check_bytes(correct_hs_resp)
         assert c.fts.sock.check_bytes(pi(correct_version))
+        assert c.fts.sock.check_bytes(pc(ticket=1234))
         assert c.fts.sock.ensure_esend() and c.fts.sock.ensure_erecv()
         assert c.fts.sock.connected
 
@@ -114,6 +139,7 @@ class TestFTConn:
         # Check sent handshake initiation
         assert c.fts.sock.check_bytes(correct_handshake)
         assert c.fts.sock.check_bytes(pi(correct_version))
+        assert c.fts.sock.check_bytes(pc())
         assert c.fts.sock.ensure_esend() and c.fts.sock.ensure_erecv()
 
     def tst_connect_hs_c_v(self):
@@ -132,6 +158,7 @@ class TestFTConn:
         # Check sent handhsake initiation
         assert c.fts.sock.check_bytes(correct_handshake)
         assert c.fts.sock.check_bytes(pi(correct_version))
+        assert c.fts.sock.check_bytes(pc())
         assert c.fts.sock.ensure_esend() and c.fts.sock.ensure_erecv()
 
     def test_connect_hs_c_c(self):
@@ -144,13 +171,89 @@ class TestFTConn:
         # response before the socket sends the initiation
         c.fts.sock.append_bytes(correct_hs_resp)
         c.fts.sock.append_bytes(pi(correct_version))
+        c.fts.sock.append_bytes(pc(4, 1234))
 
         assert c.connect(0, 0) == "Success"
 
         # Check sent handshake initiation
         assert c.fts.sock.check_bytes(correct_handshake)
         assert c.fts.sock.check_bytes(pi(correct_version))
+        assert c.fts.sock.check_bytes(pc())
+
+        # We only asked for one connection, so no data connections are made
+        assert c.caps == {'stripes': 1, 'heartbeat': 1, 'sparse': 1, 'pages': 1, 'hashes': 0b11110,
+                          'lazy': 1, 'push': 1, 'chunks': 1}
+        assert c.data_socks == []
+
+        # We keep the ticket the server gave us, but this is a new session
+        assert c.session_ticket == 1234 and not c.resumed
         assert c.fts.sock.ensure_esend() and c.fts.sock.ensure_erecv()
+        # The handshake's timeout doesn't outlive it
+        assert c.fts.timeout_stack == []
+
+    def test_connect_old_version(self):
+        # Testing that an older (but still supported) version is used as is
+        c = FTConn(MockFTSock())
+        c.fts.sock.append_bytes(correct_handshake)
+        c.fts.sock.append_bytes(pi(old_version))
+        c.fts.sock.append_bytes(pc())
+
+        assert c.connect(0, 0) == "Success"
+        assert c.fts.sock.check_bytes(correct_hs_resp)
+        assert c.fts.sock.check_bytes(pi(correct_version))
+        assert c.version == old_version and not c.framed and not c.fts.framed
+
+        # So messages aren't framed
+        c.fts.sock.retrieve_bytes()
+        c.request_file_list()
+        assert c.fts.sock.check_bytes(FTProto.REQ_LIST)
+
+    def test_framed(self):
+        # Testing that messages are framed from version 3 on
+        c = FTConn(MockFTSock())
+        c.fts.sock.append_bytes(correct_handshake)
+        c.fts.sock.append_bytes(pi(correct_version))
+        c.fts.sock.append_bytes(pc())
+        assert c.connect(0, 0) == "Success"
+        assert c.version == correct_version and c.framed
+        c.fts.sock.retrieve_bytes()
+
+        c.request_file(b'a.txt')
+        assert c.fts.sock.check_bytes(FRAME_HEADER.pack(FTProto.REQ_FILE, 0, 9) + pr(b'a.txt'))
+        c.send_file(b'a.txt', b'hi')
+        assert c.fts.sock.check_bytes(FRAME_HEADER.pack(FTProto.RES_FILE, 0, 15)
+                                      + pr(b'a.txt') + pr(b'hi'))
+
+        # Frames we don't know are skipped, as is anything in a frame after
+        # what we know of the message
+        c.fts.sock.append_bytes(FRAME_HEADER.pack(b'?', 0, 3) + b'new')
+        c.fts.sock.append_bytes(FRAME_HEADER.pack(FTProto.REQ_FILE, 1, 11) + pr(b'a.txt') + b'xx')
+        assert c.receive_data() == (FTProto.REQ_FILE, b'a.txt')
+        assert c.parser.skipped == 1
+
+        # File lists are decoded from the whole frame at once
+        fl = [FileInfo(path=Path('a.txt'), file_hash=b'h' * 32, is_dir=False, mtime=1)]
+        c.fts.sock.retrieve_bytes()     # (A PING)
+        c.send_file_list(fl)
+        c.fts.sock.append_bytes(c.fts.sock.retrieve_bytes())
+        t, flr = c.receive_data()
+        assert t == FTProto.RES_LIST and file_info_equals(flr[0], fl[0])
+
+        # A message can't run past the end of its frame: it is skipped, and
+        # so is the file it was being written to, but the next one arrives
+        aborted = []
+        class Sink:
+            def write(self, data):
+                pass
+            def abort(self):
+                aborted.append(True)
+        c.file_sink = lambda name, length: Sink()
+        c.fts.sock.append_bytes(FRAME_HEADER.pack(FTProto.REQ_FILE, 0, 6) + pr(b'a.txt')[:6])
+        c.fts.sock.append_bytes(FRAME_HEADER.pack(FTProto.RES_FILE, 0, 12)
+                                + (pr(b'a') + pr(b'long'))[:12])
+        c.fts.sock.append_bytes(FRAME_HEADER.pack(FTProto.REQ_FILE, 0, 5) + pr(b'b'))
+        assert c.receive_data() == (FTProto.REQ_FILE, b'b')
+        assert c.parser.skipped == 3 and aborted == [True]
 
     def test_recv_req_l(self):
         # Testing receive list request
@@ -255,3 +358,523 @@ class TestFTConn:
         assert c.receive_data() == (b'Y', None)
         assert c.fts.sock.ensure_erecv and c.fts.sock.ensure_esend()
 
+
+    def test_fs_sr(self):
+        # Test send/recv of a multi-file request
+        c1 = FTConn(MockFTSock(True))
+        c2 = FTConn(MockFTSock(True))
+
+        names = [b'a.txt', b'b.txt', b'c.txt']
+        c1.request_files(names)
+        c2.fts.sock.append_bytes(c1.fts.sock.retrieve_bytes())
+        assert c2.receive_data() == (FTProto.REQ_FILES, names)
+        assert c2.fts.sock.ensure_esend() and c2.fts.sock.ensure_erecv()
+
+    def test_res_fs_sr(self):
+        # Test send/recv of packed files
+        c1 = FTConn(MockFTSock(True))
+        c2 = FTConn(MockFTSock(True))
+
+        packed = pack_files([(test_file_name.encode(), test_file_contents)])
+        c1.send_files(packed)
+        c2.fts.sock.append_bytes(c1.fts.sock.retrieve_bytes())
+        assert c2.receive_data() == (FTProto.RES_FILES, packed)
+
+        assert c1.fts.sock.ensure_esend() and c1.fts.sock.ensure_erecv()
+        assert c2.fts.sock.ensure_esend() and c2.fts.sock.ensure_erecv()
+
+    def test_stats(self):
+        # Test that sending and receiving are counted
+        c1 = FTConn(MockFTSock(True))
+        c2 = FTConn(MockFTSock(True))
+
+        c1.send_file(test_file_name.encode(), test_file_contents)
+        c2.fts.sock.append_bytes(c1.fts.sock.retrieve_bytes())
+        c2.receive_data()
+
+        sent = c1.stats()
+        recvd = c2.stats()
+        size = 1 + len(pr(test_file_name.encode())) + len(pr(test_file_contents))
+
+        assert sent['counters']['bytes_sent'] == size
+        assert sent['counters']['messages_sent.RES_FILE'] == 1
+        assert sent['histograms']['latency_sent.RES_FILE']['count'] == 1
+        assert recvd['counters']['bytes_received'] == size
+        assert recvd['counters']['messages_received.RES_FILE'] == 1
+
+    def test_recv_res_f_sink(self):
+        # Testing receiving a file response into a file sink
+        class Sink:
+            def __init__(self, name, length, fail=False):
+                self.name, self.length, self.fail = name, length, fail
+                self.data = b''
+                self.aborted = False
+            def write(self, data):
+                if self.fail:
+                    raise ValueError()
+                self.data += data
+            def close(self):
+                return self
+            def abort(self):
+                self.aborted = True
+
+        c = FTConn(MockFTSock(True))
+        c.file_sink = Sink
+
+        c.fts.sock.append_bytes(FTProto.RES_FILE)
+        c.fts.sock.append_bytes(pr(test_file_name.encode()))
+        c.fts.sock.append_bytes(pr(test_file_contents))
+
+        t, (name, sink) = c.receive_data()
+        assert t == FTProto.RES_FILE and name == test_file_name.encode()
+        assert sink.length == len(test_file_contents)
+        assert sink.data == test_file_contents
+        assert c.fts.sock.ensure_erecv() and c.fts.sock.ensure_esend()
+
+        # A failing sink is aborted, but the whole message is still read
+        sinks = []
+        def failing_sink(name, length):
+            sinks.append(Sink(name, length, fail=True))
+            return sinks[-1]
+        c.file_sink = failing_sink
+        c.fts.sock.append_bytes(FTProto.RES_FILE)
+        c.fts.sock.append_bytes(pr(test_file_name.encode()))
+        c.fts.sock.append_bytes(pr(test_file_contents))
+
+        with pytest.raises(ValueError):
+            c.receive_data()
+        assert sinks[0].aborted
+        assert c.fts.sock.ensure_erecv()
+
+    def test_negative_length(self):
+        # A negative length is an error, rather than a file that never ends
+        c = FTConn(MockFTSock(True))
+        c.fts.sock.append_bytes(FTProto.RES_FILE + pr(test_file_name.encode()) + pi(-1))
+        with pytest.raises(UnexpectedValueError):
+            c.receive_data()
+        assert not c.parser.in_message
+
+        # Without frames the connection is out of step after that, so it is
+        # reconnected if it would be when broken
+        reconnects = []
+        c.reconnect = lambda: reconnects.append(True)
+        c.auto_reconnect = True
+        c.fts.sock.append_bytes(FTProto.REQ_FILE + pi(-1))
+        assert c.receive_data() == (None, None)
+        assert reconnects == [True]
+
+    def test_striped_sr(self, tmp_path):
+        # Test send/recv of a file striped over data connections
+        c1 = FTConn(MockFTSock(True))
+        c2 = FTConn(MockFTSock(True))
+        c1.stripe_size = 10
+
+        pairs = [socket.socketpair() for _ in range(3)]
+        c1.data_socks = [FTSock(a) for a, _ in pairs]
+        # The other host may have accepted the connections in any order
+        c2.data_socks = [FTSock(b) for _, b in reversed(pairs)]
+
+        contents = bytes(range(256)) * 3
+        path = tmp_path / 'striped'
+        path.write_bytes(contents)
+
+        assert c1.should_stripe(len(contents)) == (len(contents) >= c1.stripe_threshold)
+        c1.send_file_striped(test_file_name.encode(), path)
+        c2.fts.sock.append_bytes(c1.fts.sock.retrieve_bytes())
+
+        t, (name, ranges) = c2.receive_data()
+        assert t == FTProto.RES_STRIPED and name == test_file_name.encode()
+        assert [offset for offset, _ in ranges] == list(range(0, len(contents), 10))
+        assert b''.join(data for _, data in ranges) == contents
+
+        # A range that can't be written fails the file, but the rest of it
+        # is still read, so the next file over the same connections arrives
+        class Sink:
+            def __init__(self, fail_at):
+                self.fail_at, self.aborted = fail_at, False
+            def open_range(self, offset, _):
+                return RangeSink(offset == self.fail_at)
+            def close(self):
+                return self
+            def abort(self):
+                self.aborted = True
+        class RangeSink:
+            def __init__(self, fail):
+                self.fail = fail
+            def write(self, data):
+                if self.fail:
+                    raise OSError('No space left on device')
+            def close(self):
+                pass
+            def abort(self):
+                pass
+
+        sinks = []
+        def range_sink(name, size):
+            # Only the first file fails, at the range at offset 100
+            sinks.append(Sink(100 if not sinks else None))
+            return sinks[-1]
+        c2.range_sink = range_sink
+        for _ in range(2):
+            c1.send_file_striped(test_file_name.encode(), path)
+            c2.fts.sock.append_bytes(c1.fts.sock.retrieve_bytes())
+        with pytest.raises(OSError):
+            c2.receive_data()
+        assert sinks[0].aborted
+        t, (name, sink) = c2.receive_data()
+        assert t == FTProto.RES_STRIPED and sink is sinks[1] and not sink.aborted
+
+        for a, b in pairs:
+            a.close()
+            b.close()
+
+    def test_connect_resume(self):
+        # Testing that a server resumes a session when given its ticket
+        c = FTConn(MockFTSock())
+        c.session_ticket = 1234
+        c.list_generation = 3
+        c.fts.sock.append_bytes(correct_handshake)
+        c.fts.sock.append_bytes(pi(correct_version))
+        c.fts.sock.append_bytes(pc(ticket=1234))
+
+        assert c.connect(0, 0) == "Success"
+        assert c.resumed and c.list_generation == 3
+
+        assert c.fts.sock.check_bytes(correct_hs_resp)
+        assert c.fts.sock.check_bytes(pi(correct_version))
+        assert c.fts.sock.check_bytes(pc(ticket=1234))
+
+        # Whereas a wrong ticket starts a new session
+        c = FTConn(MockFTSock())
+        c.session_ticket = 1234
+        c.list_generation = 3
+        c._new_ticket = lambda: 5678
+        c.fts.sock.append_bytes(correct_handshake)
+        c.fts.sock.append_bytes(pi(correct_version))
+        c.fts.sock.append_bytes(pc(ticket=999))
+
+        assert c.connect(0, 0) == "Success"
+        assert not c.resumed and c.list_generation == 0
+        assert c.session_ticket == 5678
+
+    def test_reconnect(self):
+        # Testing reconnecting with backoff, and sending unanswered requests again
+        c = FTConn(MockFTSock(True))
+        c.address = ('host', 1)
+        c.reconnect_min_delay = 0
+        c.close = lambda: None
+        c.request_file(test_file_name.encode())
+        c.fts.sock.retrieve_bytes()
+
+        attempts = []
+        def connect(host, port, listen_timeout):
+            attempts.append((host, port))
+            if len(attempts) < 3:
+                raise ConnectionRefusedError()
+            c.resumed = True
+            return "Success"
+        c.connect = connect
+
+        assert c.reconnect() == "Success"
+        assert attempts == [('host', 1)] * 3
+        assert c.fts.sock.check_bytes(FTProto.REQ_FILE + pr(test_file_name.encode()))
+        assert c.fts.sock.ensure_esend()
+
+        # The request is answered, so it isn't sent again next time
+        c.fts.sock.append_bytes(FTProto.RES_FILE)
+        c.fts.sock.append_bytes(pr(test_file_name.encode()))
+        c.fts.sock.append_bytes(pr(test_file_contents))
+        c.receive_data()
+        assert c.outstanding == []
+
+    def test_outstanding_bounded(self):
+        # Testing that requests which are never answered don't pile up
+        c = FTConn(MockFTSock(True))
+        c.request_hashes([b'gone.txt'])
+        c.request_hashes([b'gone.txt'])
+        c.request_file_list_page(0)
+        c.request_file_list_page(5)
+        c.request_file_list_page(0)
+        assert c.outstanding == [('hashes', [b'gone.txt']), ('list_page', (0, 256))]
+
+        c.max_outstanding = 3
+        for name in (b'a', b'b', b'c'):
+            c.request_file(name)
+        assert c.outstanding == [('file', b'a'), ('file', b'b'), ('file', b'c')]
+
+    def test_auto_reconnect(self):
+        # Testing that a broken connection is reconnected while receiving
+        c = FTConn(MockFTSock(True))
+        c.fts.sock.pshutdown = True
+        with pytest.raises(BrokenSocketError):
+            c.receive_data()
+
+        reconnects = []
+        c.reconnect = lambda: reconnects.append(True)
+        c.auto_reconnect = True
+        assert c.receive_data() == (None, None)
+        assert reconnects == [True]
+
+    def test_partial_message(self):
+        # Testing that half a message doesn't block, and is finished later
+        c = FTConn(MockFTSock(True))
+        c.fts.sock.raise_on_end_recv = BlockingIOError()
+        message = FTProto.RES_FILE + pr(test_file_name.encode()) + pr(test_file_contents)
+        c.fts.sock.append_bytes(message[:15])
+        assert c.receive_data() == (None, None)
+        assert c.parser.in_message
+
+        c.fts.sock.append_bytes(message[15:] + FTProto.REQ_LIST)
+        assert c.receive_data() == (FTProto.RES_FILE,
+                                    (test_file_name.encode(), test_file_contents))
+        assert c.receive_data() == (FTProto.REQ_LIST, None)
+        assert c.receive_data() == (None, None)
+        assert c.stats()['counters']['messages_received.RES_FILE'] == 1
+
+    def test_recv_buffer(self):
+        # Testing that the main connection receives into one buffer, which
+        # is reused once the parser is done with what is in it
+        c = FTConn(MockFTSock(True))
+        c.fts.sock.raise_on_end_recv = BlockingIOError()
+        c.fts.chunk_size = 16
+        contents = bytes(range(100))
+        long_name = b'abcdefghijklmnopqrstuvwxyz'
+        c.fts.sock.append_bytes(FTProto.RES_FILE + pr(test_file_name.encode()) + pr(contents)
+                                + FTProto.REQ_FILE + pr(long_name))
+        assert c.receive_data() == (FTProto.RES_FILE, (test_file_name.encode(), contents))
+        # (A message longer than the buffer gets a new one)
+        assert c.receive_data() == (FTProto.REQ_FILE, long_name)
+
+        buf = c._FTConn__recv_buf
+        c.fts.sock.append_bytes(FTProto.REQ_FILE + pr(b'a.txt'))
+        assert c.receive_data() == (FTProto.REQ_FILE, b'a.txt')
+        assert c._FTConn__recv_buf is buf
+
+    def test_ping(self):
+        # Testing that a PING is answered, and that it isn't passed on
+        c = FTConn(MockFTSock(True))
+        c.fts.sock.append_bytes(FTProto.PING + struct.pack('!d', 1.5))
+
+        assert c.receive_data() == (None, None)
+        assert c.fts.sock.check_bytes(FTProto.PONG + struct.pack('!d', 1.5))
+        assert c.fts.sock.ensure_esend()
+        assert c.fts.sock.ensure_erecv()
+
+    def test_heartbeat(self):
+        # Testing that PINGs are sent when the other host supports them,
+        # and that the PONG gives the round trip time
+        c = FTConn(MockFTSock(True))
+        c.fts.sock.raise_on_end_recv = BlockingIOError()
+        c.receive_data()
+        assert c.fts.sock.ensure_esend()
+
+        c.caps = {'stripes': 1, 'heartbeat': 1}
+        c.receive_data()
+        assert c.fts.sock.check_bytes(FTProto.PING + struct.pack('!d', c.last_ping))
+        c.receive_data()
+        assert c.fts.sock.ensure_esend()
+
+        c.fts.sock.append_bytes(FTProto.PONG + struct.pack('!d', c.last_ping - 0.25))
+        assert c.receive_data() == (None, None)
+        assert c.rtt >= 0.25 and c.min_rtt == c.rtt
+
+    def test_tune(self):
+        # Testing that the chunk and buffer sizes follow the bandwidth-delay product
+        c = FTConn(MockFTSock(True))
+        assert c.tune() is None
+
+        c.min_rtt = 0.05
+        c.bandwidth = 100 << 20
+        bdp = c.tune()
+        assert bdp == 5 << 20
+        assert c.fts.chunk_size == c.max_chunk_size
+        assert c.fts.buffer_size == 10 << 20
+
+        # A LAN doesn't get chunks smaller than the minimum, and the
+        # buffers aren't shrunk
+        c.min_rtt = 0.0001
+        assert c.tune() < c.min_chunk_size
+        assert c.fts.chunk_size == c.min_chunk_size
+        assert c.fts.buffer_size == 10 << 20
+
+    def test_bandwidth(self):
+        # Testing that only received messages measure the bandwidth, since
+        # sending a message only copies it into the socket buffer
+        c1 = FTConn(MockFTSock(True))
+        c2 = FTConn(MockFTSock(True))
+        contents = bytes(200 << 10)
+        c1.send_file(test_file_name.encode(), contents)
+        assert c1.bandwidth is None
+
+        c2.fts.sock.append_bytes(c1.fts.sock.retrieve_bytes())
+        assert c2.receive_data() == (FTProto.RES_FILE, (test_file_name.encode(), contents))
+        assert c2.bandwidth is not None
+
+    def test_expected_hash(self):
+        # Testing looking up the hash a file was advertised with
+        c = FTConn(MockFTSock(True))
+        assert c.expected_hash(b'a.txt') is None
+
+        c.remote_file_list = [
+            FileInfo(path=Path('a.txt'), file_hash=b'1' * 32, is_dir=False, mtime=0),
+            FileInfo(path=Path('sub'), file_hash=b'2' * 32, is_dir=True, mtime=0),
+        ]
+        assert c.expected_hash(b'a.txt') == b'1' * 32
+        assert c.expected_hash(b'sub') is None
+        assert c.expected_hash(b'b.txt') is None
+
+    def test_sparse(self, tmp_path):
+        # Test send/recv of a sparse file, with and without a sparse sink
+        original = tmp_path / 'original'
+        with open(str(original), 'wb') as out:
+            out.truncate(3 << 20)
+            out.seek(1 << 20)
+            out.write(b'Hello')
+
+        c = FTConn(MockFTSock(True))
+        assert not c.should_send_sparse(original)
+        c.caps['sparse'] = 1
+        assert c.should_send_sparse(original) == is_sparse(original)
+
+        c.send_file_sparse(b'sparse', original)
+        sent = c.fts.sock.retrieve_bytes()
+
+        r = FTConn(MockFTSock(True))
+        r.fts.sock.append_bytes(sent)
+        t, (name, (size, extents, contents)) = r.receive_data()
+        assert t == FTProto.RES_SPARSE and name == b'sparse' and size == 3 << 20
+        dense = bytearray(size)
+        for offset, length in extents:
+            dense[offset:offset + length] = contents[:length]
+            contents = contents[length:]
+        assert dense == original.read_bytes()
+
+        # Received straight into a sparse file, checking its hash as it goes
+        received = tmp_path / 'received'
+        r.sparse_sink = lambda name, length, size, extents: IncomingFile(
+            received, size, sha256(original.read_bytes()).digest(), extents=extents)
+        r.fts.sock.append_bytes(sent)
+        assert r.receive_data() == (FTProto.RES_SPARSE, (b'sparse', received))
+        assert received.read_bytes() == original.read_bytes()
+
+    def test_list_pages(self):
+        # Test requesting and receiving a file list a page at a time
+        c = FTConn(MockFTSock(True))
+        s = FTConn(MockFTSock(True))
+        fl = [FileInfo(path=Path(name), file_hash=b'1' * 32, is_dir=False, mtime=0)
+              for name in ('a', 'b', 'c')]
+
+        c.request_file_list_page(limit=2)
+        assert c.listing
+        s.fts.sock.append_bytes(c.fts.sock.retrieve_bytes())
+        assert s.receive_data() == (FTProto.REQ_LIST_PAGE, (0, 2))
+
+        s.send_file_list_page(0, fl[:2], 7)
+        c.fts.sock.append_bytes(s.fts.sock.retrieve_bytes())
+        t, (cursor, next_cursor, page) = c.receive_data()
+        assert t == FTProto.RES_LIST_PAGE and (cursor, next_cursor) == (0, 7)
+        assert [str(f.path) for f in page] == ['a', 'b']
+        # The list isn't complete until the last page
+        assert c.remote_file_list is None and not c.listing
+
+        c.request_file_list_page(next_cursor)
+        assert c.fts.sock.retrieve_bytes() == FTProto.REQ_LIST_PAGE + struct.pack('!Qi', 7, 256)
+        s.send_file_list_page(7, fl[2:], 0)
+        c.fts.sock.append_bytes(s.fts.sock.retrieve_bytes())
+        c.receive_data()
+        assert [str(f.path) for f in c.remote_file_list] == ['a', 'b', 'c']
+        assert c.list_generation == 1 and not c.listing
+
+    def test_hash_algorithms(self):
+        # Testing the agreed hash algorithm, and lists with longer digests
+        c = FTConn(MockFTSock(True))
+        assert c.hash_algorithm is SHA256
+        c.caps['hashes'] = (1 << SHA256.id) | (1 << BLAKE2S.id)
+        assert c.hash_algorithm is BLAKE2S
+        c.caps['hashes'] = (1 << SHA256.id) | (1 << BLAKE2B.id)
+        assert c.hash_algorithm is BLAKE2B
+
+        fl = [FileInfo(path=Path('a.txt'), file_hash=b'1' * 64, is_dir=False, mtime=98,
+                       algorithm=BLAKE2B.id),
+              FileInfo(path=Path('b.txt'), file_hash=b'2' * 32, is_dir=False, mtime=99)]
+        c.send_file_list(fl)
+
+        r = FTConn(MockFTSock(True))
+        r.caps['hashes'] = c.caps['hashes']
+        r.fts.sock.append_bytes(c.fts.sock.retrieve_bytes())
+        t, flr = r.receive_data()
+        assert t == FTProto.RES_LIST
+        for orig, recv in zip(fl, flr):
+            assert file_info_equals(orig, recv) and orig.algorithm == recv.algorithm
+
+        # Only hashes made with the agreed algorithm can be checked
+        assert r.expected_hash(b'a.txt') == b'1' * 64
+        assert r.expected_hash(b'b.txt') is None
+
+    def test_lazy_hashes(self):
+        # Testing lists with pending hashes, and asking for them
+        c = FTConn(MockFTSock(True))
+        s = FTConn(MockFTSock(True))
+        c.caps = s.caps = {'hashes': 1 << SHA256.id, 'lazy': 1}
+
+        s.send_file_list([FileInfo(path=Path('a.txt'), file_hash=None, is_dir=False, mtime=1)])
+        c.fts.sock.append_bytes(s.fts.sock.retrieve_bytes())
+        t, fl = c.receive_data()
+        assert t == FTProto.RES_LIST and fl[0].hash is None
+        assert c.expected_hash(b'a.txt') is None
+
+        c.request_hashes([b'a.txt'])
+        s.fts.sock.append_bytes(c.fts.sock.retrieve_bytes())
+        assert s.receive_data() == (FTProto.REQ_HASH, [b'a.txt'])
+
+        s.send_hashes([FileInfo(path=Path('a.txt'), file_hash=b'1' * 32, is_dir=False, mtime=1)])
+        c.fts.sock.append_bytes(s.fts.sock.retrieve_bytes())
+        assert c.receive_data()[0] == FTProto.RES_HASH
+        assert c.expected_hash(b'a.txt') == b'1' * 32
+        assert c.outstanding == []
+
+    def test_subscribe(self):
+        # Testing subscribing to changes, which are then pushed
+        c = FTConn(MockFTSock(True))
+        s = FTConn(MockFTSock(True))
+
+        c.subscribe()
+        assert c.subscribed
+        assert c.fts.sock.check_bytes(FTProto.SUBSCRIBE + struct.pack('!?', True))
+        s.fts.sock.append_bytes(FTProto.SUBSCRIBE + struct.pack('!?', True))
+        assert s.receive_data() == (FTProto.SUBSCRIBE, True)
+        assert s.subscriber
+
+        # The subscriber is told to list everything right away
+        c.fts.sock.append_bytes(s.fts.sock.retrieve_bytes())
+        assert c.receive_data() == (FTProto.CHANGED, [])
+
+        s.send_changes([b'a.txt', b'sub'])
+        c.fts.sock.append_bytes(s.fts.sock.retrieve_bytes())
+        assert c.receive_data() == (FTProto.CHANGED, [b'a.txt', b'sub'])
+
+        # Subscriptions are renewed after reconnecting, in case anything was missed
+        c.address = ('host', 1)
+        c.close = lambda: None
+        c.caps = {'push': 1}
+        c.connect = lambda host, port, listen_timeout: "Success"
+        assert c.reconnect() == "Success"
+        assert c.fts.sock.check_bytes(FTProto.SUBSCRIBE + struct.pack('!?', True))
+        assert c.fts.sock.ensure_esend()
+
+    def test_chunk_hashes(self):
+        # Testing that RES_HASH carries the hashes of the chunks when agreed on
+        c = FTConn(MockFTSock(True))
+        s = FTConn(MockFTSock(True))
+        c.caps = s.caps = {'hashes': 1 << BLAKE2B_TREE.id, 'lazy': 1, 'chunks': 1}
+        c.remote_file_list = [FileInfo(path=Path('big'), file_hash=None, is_dir=False, mtime=1,
+                                       algorithm=BLAKE2B_TREE.id)]
+        chunks = [b'1' * 64, b'2' * 64]
+
+        s.send_hashes([FileInfo(path=Path('big'), file_hash=b'0' * 64, is_dir=False, mtime=1,
+                                algorithm=BLAKE2B_TREE.id, chunks=chunks)])
+        c.fts.sock.append_bytes(s.fts.sock.retrieve_bytes())
+        assert c.receive_data()[0] == FTProto.RES_HASH
+        assert c.expected_hash(b'big') == b'0' * 64
+        assert c.expected_chunks(b'big') == chunks
+        assert c.expected_chunks(b'other') is None
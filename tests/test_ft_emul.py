@@ -0,0 +1,167 @@
+# pylint: disable = missing-docstring, missing-return-doc, missing-return-type-doc
+# pylint: disable = invalid-name
+# pylint: disable = no-self-use
+# pylint: disable = protected-access
+
+import threading
+import pytest
+
+from ft_conn import FTConn, FTProto
+from ft_conn.ft_sock import FTSock
+from ft_conn.ft_error import BrokenSocketError
+from .ft_emul import RingBuffer, EmulatedLink, EmulatedNetwork, emulated_pair
+
+def run(func, *args):
+    # Runs func on another thread, returning a function that waits for it
+    # and returns its result
+    result = []
+    thread = threading.Thread(target=lambda: result.append(func(*args)))
+    thread.start()
+    def join():
+        thread.join()
+        return result[0]
+    return join
+
+def receive(conn, clock):
+    # Polls for a message like the daemon does, waiting in virtual time
+    while True:
+        message_type, data = conn.receive_data()
+        if message_type is not None:
+            return message_type, data
+        clock.sleep(0.005)
+
+class TestEmulator:
+    def test_ring_buffer(self):
+        r = RingBuffer(8)
+        assert r.write(b'0123456789') == 8
+
+        out = bytearray(8)
+        assert r.read_into(memoryview(out), 5) == 5
+        assert out[:5] == b'01234'
+
+        # Wraps around the end of the buffer
+        assert r.write(b'abcd') == 4
+        r.grow(16)
+        assert r.capacity == 16
+        assert r.read_into(memoryview(out), 8) == 7
+        assert out[:7] == b'567abcd'
+
+    def test_latency(self):
+        link = EmulatedLink(latency=0.05)
+        a, b = FTSock(link.a), FTSock(link.b)
+        a.send_bytes(b'Hello')
+
+        # Nothing has arrived yet
+        b.timeout_push(0)
+        with pytest.raises(BlockingIOError):
+            b.recv_bytes(5)
+        b.timeout_pop()
+
+        # And a short timeout runs out before it does
+        b.timeout_push(0.01)
+        with pytest.raises(OSError):
+            b.recv_bytes(5)
+        b.timeout_pop()
+
+        assert b.recv_bytes(5) == b'Hello'
+        assert link.clock() == pytest.approx(0.05)
+
+    def test_bandwidth(self):
+        link = EmulatedLink(latency=0.01, bandwidth=1 << 20, buffer_size=4 << 20)
+        a, b = FTSock(link.a), FTSock(link.b)
+        a.send_bytes(bytes(2 << 20))
+
+        assert b.recv_bytes(2 << 20) == bytes(2 << 20)
+        assert link.clock() == pytest.approx(2.01)
+
+    def test_jitter(self):
+        link = EmulatedLink(latency=0.01, jitter=0.02, segment_size=10, seed=1)
+        a, b = FTSock(link.a), FTSock(link.b)
+        data = bytes(range(256)) * 4
+        a.send_bytes(data)
+
+        # Segments are delayed by different amounts, but stay in order
+        assert b.recv_bytes(len(data)) == data
+        assert 0.01 < link.clock() <= 0.03
+
+    def test_short_reads_writes(self):
+        a, b = emulated_pair(short_reads=True, short_writes=True, seed=2)
+        a, b = FTSock(a), FTSock(b)
+        data = bytes(range(256)) * 64
+        a.send_bytes(data)
+        assert b.recv_bytes(len(data)) == data
+
+        assert a.stats()['counters']['send_syscalls'] > 1
+        assert b.stats()['counters']['recv_syscalls'] > 1
+
+    def test_full_buffer(self):
+        # Sends wait for the other end to read, as with a real socket
+        a, b = emulated_pair(latency=0.1, bandwidth=1 << 20, buffer_size=1024)
+        a, b = FTSock(a), FTSock(b)
+        data = bytes(range(256)) * 1024
+
+        wait = run(a.send_bytes, data)
+        assert b.recv_bytes(len(data)) == data
+        wait()
+
+    def test_close(self):
+        a, b = emulated_pair(latency=0.01)
+        a, b = FTSock(a), FTSock(b)
+        a.send_bytes(b'Bye')
+        a.set_socket(None)
+
+        assert b.recv_bytes(3) == b'Bye'
+        with pytest.raises(BrokenSocketError):
+            b.recv_bytes(1)
+
+    def test_disconnect(self):
+        a, b = emulated_pair(latency=0.01, disconnect_after=100)
+        a, b = FTSock(a), FTSock(b)
+
+        # The connection is reset part way through, losing what was in flight
+        a.send_bytes(bytes(100))
+        with pytest.raises(ConnectionResetError):
+            a.send_bytes(bytes(100))
+        with pytest.raises(ConnectionResetError):
+            b.recv_bytes(100)
+
+    def test_wan_transfer(self):
+        # A file sent over a 50ms, 10MB/s link takes as long as it should
+        net = EmulatedNetwork(latency=0.05, bandwidth=10 << 20, buffer_size=8 << 20)
+        a, b = FTConn(net.ftsock()), FTConn(net.ftsock())
+        wait = run(b.connect, 'a', 1)
+        assert a.connect('b', 1) == "Success"
+        assert wait() == "Success"
+
+        data = bytes(range(256)) * (16 << 10)
+        start = net.clock()
+        # (The buffers hold all of it, so sending doesn't wait for receiving)
+        a.send_file(b'big', data)
+        tok, (name, contents) = receive(b, net.clock)
+
+        assert tok == FTProto.RES_FILE and name == b'big' and contents == data
+        assert net.clock() - start == pytest.approx(0.45, rel=0.05)
+
+    def test_resume(self):
+        # Both ends reconnect after the network drops, resuming the session
+        # and sending the request that was lost again
+        net = EmulatedNetwork(latency=0.01)
+        a, b = FTConn(net.ftsock()), FTConn(net.ftsock())
+        a.reconnect_min_delay = b.reconnect_min_delay = 0.01
+        wait = run(b.connect, 'a', 1)
+        assert a.connect('b', 1) == "Success"
+        assert wait() == "Success"
+        ticket = a.session_ticket
+
+        a.request_file(b'wanted')
+        net.disconnect()
+        with pytest.raises(ConnectionResetError):
+            b.receive_data()
+
+        wait = run(b.reconnect, 5)
+        assert a.reconnect(5) == "Success"
+        assert wait() == "Success"
+        assert a.resumed and b.resumed and a.session_ticket == ticket
+
+        assert receive(b, net.clock) == (FTProto.REQ_FILE, b'wanted')
+        assert net.clock() < 1
@@ -0,0 +1,47 @@
+# pylint: disable = missing-docstring, missing-return-doc, missing-return-type-doc
+# pylint: disable = invalid-name
+# pylint: disable = no-self-use
+# pylint: disable = protected-access
+
+from ft_conn.ft_notify import FTNotifier
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+class TestFTNotifier:
+    def test_debounce(self):
+        clk = FakeClock()
+        n = FTNotifier(0.2, 1.0, clock=clk)
+        assert n.due() == [] and not n.pending
+
+        # Changes are held until nothing has changed for a while
+        n.add([b'a'])
+        clk.now = 0.1
+        n.add([b'b', b'a'])
+        clk.now = 0.2
+        assert n.due() == [] and n.pending
+        clk.now = 0.5
+        assert n.due() == [b'a', b'b']
+        assert n.due() == [] and not n.pending
+
+    def test_max_delay(self):
+        clk = FakeClock()
+        n = FTNotifier(0.2, 1.0, clock=clk)
+
+        # Files that never stop changing are still sent every so often
+        for i in range(10):
+            clk.now = i * 0.1
+            n.add([b'log'])
+            assert n.due() == []
+        clk.now = 1.0
+        n.add([b'log'])
+        assert n.due() == [b'log']
+
+    def test_nothing_added(self):
+        n = FTNotifier(clock=FakeClock())
+        n.add([])
+        assert not n.pending and n._first is None
@@ -0,0 +1,28 @@
+# pylint: disable = missing-docstring, missing-return-doc, missing-return-type-doc
+# pylint: disable = invalid-name
+# pylint: disable = no-self-use
+# pylint: disable = protected-access
+
+import pytest
+from ft_conn.ft_pack import pack_files, unpack_files
+from ft_conn.ft_error import UnexpectedValueError
+
+class TestFTPack:
+    def test_round_trip(self):
+        files = [(b'a.txt', b'Hello'), (b'empty', b''), (b'bin', bytes(range(256)))]
+        unpacked = unpack_files(pack_files(files))
+
+        assert [(name, bytes(data)) for name, data in unpacked] == files
+
+    def test_empty(self):
+        assert pack_files([]) == b''
+        assert unpack_files(b'') == []
+
+    def test_truncated(self):
+        packed = pack_files([(b'a.txt', b'Hello')])
+
+        with pytest.raises(UnexpectedValueError):
+            unpack_files(packed[:-1])
+
+        with pytest.raises(UnexpectedValueError):
+            unpack_files(packed[:5])
@@ -0,0 +1,46 @@
+# pylint: disable = missing-docstring, missing-return-doc, missing-return-type-doc
+# pylint: disable = invalid-name
+# pylint: disable = no-self-use
+# pylint: disable = protected-access
+
+from ft_conn.ft_pages import FTListPager
+
+class TestFTListPager:
+    def test_pages(self):
+        p = FTListPager()
+        started = []
+        def start():
+            started.append(True)
+            return iter(range(5))
+
+        cursor, page, next_cursor = p.page(0, 2, start)
+        assert (cursor, page) == (0, [0, 1]) and next_cursor
+        cursor, page, next_cursor = p.page(next_cursor, 2, start)
+        assert page == [2, 3] and next_cursor
+        last = next_cursor
+        assert p.page(last, 2, start) == (last, [4], 0)
+        assert len(started) == 1
+
+        # A finished (or unknown) cursor starts the listing over
+        assert p.page(last, 10, start) == (0, [0, 1, 2, 3, 4], 0)
+
+    def test_lazy(self):
+        # Only the entries in the page are produced
+        produced = []
+        def start():
+            for i in range(1000):
+                produced.append(i)
+                yield i
+
+        p = FTListPager()
+        p.page(0, 3, start)
+        assert produced == [0, 1, 2]
+
+    def test_max_listings(self):
+        p = FTListPager()
+        p.max_listings = 2
+        cursors = [p.page(0, 1, lambda: range(5))[2] for _ in range(3)]
+
+        # The oldest was dropped, so asking for it starts over
+        assert p.page(cursors[0], 1, lambda: range(5)) == (0, [0], cursors[2] + 1)
+        assert p.page(cursors[2], 1, lambda: range(5)) == (cursors[2], [1], cursors[2] + 2)
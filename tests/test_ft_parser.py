@@ -0,0 +1,150 @@
+# pylint: disable = missing-docstring, missing-return-doc, missing-return-type-doc
+# pylint: disable = invalid-name
+# pylint: disable = no-self-use
+# pylint: disable = protected-access
+
+import struct
+from pathlib import Path
+
+import pytest
+
+from ft_conn import FTProto
+from ft_conn.ft_error import UnexpectedValueError
+from ft_conn.ft_proto import FRAME_HEADER
+from ft_conn.ft_parser import FTParser, Message, Start, Body
+
+def pr(rstr):
+    return struct.pack('!i', len(rstr)) + rstr
+
+def feed_bytewise(parser, data):
+    # Feeds one byte at a time, collecting the events as they come
+    events = []
+    for i in range(len(data)):
+        parser.feed(data[i:i + 1])
+        events.extend(parser)
+    return events
+
+class TestFTParser:
+    def test_requests(self):
+        p = FTParser()
+        data = (FTProto.REQ_LIST + FTProto.REQ_FILE + pr(b'a.txt')
+                + FTProto.REQ_FILES + struct.pack('!i', 2) + pr(b'a') + pr(b'bc')
+                + FTProto.REQ_LIST_PAGE + struct.pack('!Qi', 7, 100))
+        assert feed_bytewise(p, data) == [
+            Message(FTProto.REQ_LIST, None, 1),
+            Message(FTProto.REQ_FILE, b'a.txt', 10),
+            Message(FTProto.REQ_FILES, [b'a', b'bc'], 16),
+            Message(FTProto.REQ_LIST_PAGE, (7, 100), 13)]
+        assert not p.in_message
+
+    def test_partial(self):
+        # Nothing comes out until the message is complete, however it is split
+        p = FTParser()
+        data = FTProto.PING + struct.pack('!d', 1.5)
+        p.feed(data[:4])
+        assert p.next_event() is None and p.in_message
+        p.feed(data[4:])
+        assert p.next_event() == Message(FTProto.PING, 1.5, 9)
+        assert p.next_event() is None and not p.in_message
+
+    def test_res_list(self):
+        entry = pr(b'a.txt') + struct.pack('!32s?Q', b'h' * 32, False, 5)
+        data = FTProto.RES_LIST + struct.pack('!i', 1) + entry
+        (message,) = feed_bytewise(FTParser(), data)
+        (file_info,) = message.data
+        assert (file_info.path, file_info.hash, file_info.mtime) == (Path('a.txt'), b'h' * 32, 5)
+
+        # The entries have a different format when the hashes were negotiated
+        entry = pr(b'b') + pr(b'') + struct.pack('!B?Q', 2, True, 6)
+        data = FTProto.RES_LIST_PAGE + struct.pack('!QQi', 0, 3, 1) + entry
+        (message,) = feed_bytewise(FTParser({'hashes': 0b110}), data)
+        cursor, next_cursor, (file_info,) = message.data
+        assert (cursor, next_cursor) == (0, 3)
+        assert file_info.hash is None and file_info.is_dir and file_info.algorithm == 2
+
+    def test_streamed(self):
+        # The body of a file is handed out in pieces, as views of what was fed
+        p = FTParser()
+        contents = b'0123456789'
+        chunk = FTProto.RES_FILE + pr(b'f') + pr(contents)
+        p.feed(chunk[:12])
+        p.feed(chunk[12:])
+        events = list(p)
+        assert events[0] == Start(FTProto.RES_FILE, (b'f', 10))
+        bodies = [event.data for event in events[1:-1]]
+        assert all(isinstance(event, Body) for event in events[1:-1])
+        assert all(isinstance(body, memoryview) for body in bodies)
+        assert b''.join(bodies) == contents and len(bodies) == 2
+        assert events[-1] == Message(FTProto.RES_FILE, (b'f', 10), len(chunk))
+
+    def test_sparse(self):
+        data = (FTProto.RES_SPARSE + pr(b's') + struct.pack('!QI', 100, 2)
+                + struct.pack('!QQQQ', 0, 2, 50, 1) + struct.pack('!Q', 3) + b'abc')
+        events = feed_bytewise(FTParser(), data)
+        header = (b's', 100, [(0, 2), (50, 1)], 3)
+        assert events[0] == Start(FTProto.RES_SPARSE, header)
+        assert b''.join(event.data for event in events[1:-1]) == b'abc'
+        assert events[-1] == Message(FTProto.RES_SPARSE, header, len(data))
+
+    def test_empty_body(self):
+        p = FTParser()
+        p.feed(FTProto.RES_FILES + struct.pack('!i', 0) + FTProto.PONG + struct.pack('!d', 2.0))
+        assert list(p) == [Start(FTProto.RES_FILES, 0), Message(FTProto.RES_FILES, 0, 5),
+                           Message(FTProto.PONG, 2.0, 9)]
+
+    def test_framed(self):
+        # Frames parse the same however they are split, and unknown ones vanish
+        p = FTParser(framed=True)
+        data = (FRAME_HEADER.pack(b'?', 0, 2) + b'??'
+                + FRAME_HEADER.pack(FTProto.RES_FILES, 0, 7) + pr(b'abc')
+                + FRAME_HEADER.pack(FTProto.REQ_LIST, 0, 0))
+        events = feed_bytewise(p, data)
+        assert events[0] == Start(FTProto.RES_FILES, 3)
+        assert b''.join(event.data for event in events[1:-2]) == b'abc'
+        assert events[-2:] == [Message(FTProto.RES_FILES, 3, 17),
+                               Message(FTProto.REQ_LIST, None, 10)]
+        assert p.skipped == 1
+
+        # A message that overruns its frame is an error, raised once: the
+        # rest of the frame is skipped, and the next frame parses as usual
+        p.feed(FRAME_HEADER.pack(FTProto.REQ_FILE, 0, 6) + pr(b'a.txt')[:6]
+               + FRAME_HEADER.pack(FTProto.REQ_FILE, 0, 5) + pr(b'b'))
+        with pytest.raises(UnexpectedValueError):
+            p.next_event()
+        assert list(p) == [Message(FTProto.REQ_FILE, b'b', 15)]
+        assert p.skipped == 2 and not p.in_message
+
+    def test_subscribe(self):
+        p = FTParser()
+        data = FTProto.SUBSCRIBE + struct.pack('!?', True) \
+            + FTProto.CHANGED + struct.pack('!i', 1) + pr(b'a.txt')
+        assert feed_bytewise(p, data) == [Message(FTProto.SUBSCRIBE, True, 2),
+                                          Message(FTProto.CHANGED, [b'a.txt'], 14)]
+
+    def test_chunks(self):
+        # RES_HASH carries the hashes of the chunks if caps['chunks'] was agreed on
+        entry = pr(b'big') + pr(b'rrrr') + struct.pack('!B?Q', 4, False, 1) \
+            + struct.pack('!i', 2) + b'1111' + b'2222'
+        data = FTProto.RES_HASH + struct.pack('!i', 1) + entry
+        (message,) = feed_bytewise(FTParser({'hashes': 1 << 4, 'chunks': 1}), data)
+        (file_info,) = message.data
+        assert file_info.chunks == [b'1111', b'2222']
+
+    def test_negative_lengths(self):
+        # A negative length or count is rejected, rather than waited on forever
+        for data in (FTProto.REQ_FILE + struct.pack('!i', -1),
+                     FTProto.REQ_FILES + struct.pack('!i', -2),
+                     FTProto.RES_LIST + struct.pack('!i', -1),
+                     FTProto.RES_FILE + pr(b'f') + struct.pack('!i', -5) + b'abc',
+                     FTProto.RES_FILES + struct.pack('!i', -1) + b'abc'):
+            p = FTParser()
+            p.feed(data)
+            with pytest.raises(UnexpectedValueError):
+                list(p)
+            assert not p.in_message
+
+        entry = pr(b'big') + pr(b'rrrr') + struct.pack('!B?Q', 4, False, 1) + struct.pack('!i', -1)
+        p = FTParser({'hashes': 1 << 4, 'chunks': 1})
+        p.feed(FTProto.RES_HASH + struct.pack('!i', 1) + entry)
+        with pytest.raises(UnexpectedValueError):
+            list(p)
@@ -0,0 +1,53 @@
+# pylint: disable = missing-docstring, missing-return-doc, missing-return-type-doc
+# pylint: disable = invalid-name
+# pylint: disable = no-self-use
+# pylint: disable = protected-access
+
+import pytest
+from ft_conn.ft_rate import TokenBucket, rate_limiters
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.slept = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, secs):
+        self.slept.append(secs)
+        self.now += secs
+
+class TestTokenBucket:
+    def test_burst(self):
+        clk = FakeClock()
+        b = TokenBucket(100, 50, clock=clk, sleep=clk.sleep)
+
+        # A full burst goes out immediately, after which we wait for refills
+        assert b.reserve(50) == 0
+        assert b.reserve(25) == pytest.approx(0.25)
+
+    def test_consume_waits(self):
+        clk = FakeClock()
+        b = TokenBucket(100, clock=clk, sleep=clk.sleep)
+
+        b.consume(100)
+        b.consume(50)
+        assert clk.slept == [pytest.approx(0.5)]
+
+    def test_refill_capped(self):
+        clk = FakeClock()
+        b = TokenBucket(100, 10, clock=clk, sleep=clk.sleep)
+
+        clk.now += 60
+        assert b.reserve(10) == 0
+        assert b.reserve(10) == pytest.approx(0.1)
+
+    def test_bad_rate(self):
+        with pytest.raises(ValueError):
+            TokenBucket(0)
+
+    def test_rate_limiters(self):
+        assert rate_limiters(None) == []
+        (b,) = rate_limiters(1000, 200)
+        assert (b.rate, b.burst) == (1000, 200)
@@ -0,0 +1,48 @@
+# pylint: disable = missing-docstring, missing-return-doc, missing-return-type-doc
+# pylint: disable = invalid-name
+# pylint: disable = no-self-use
+# pylint: disable = protected-access
+
+import threading
+
+from ft_conn.ft_sched import FTScheduler, Priority
+
+class TestFTScheduler:
+    def test_order(self):
+        s = FTScheduler()
+        ran = []
+        s.submit(ran.append, 'sync', priority=Priority.BACKGROUND, size=10)
+        s.submit(ran.append, 'big', priority=Priority.USER, size=1000)
+        s.submit(ran.append, 'small', priority=Priority.USER, size=1)
+        s.submit(ran.append, 'list', priority=Priority.CONTROL)
+        s.submit(ran.append, 'small again', priority=Priority.USER, size=1)
+
+        while s.run_next():
+            pass
+        # Control first, then smallest first, with ties in submission order
+        assert ran == ['list', 'small', 'small again', 'big', 'sync']
+
+    def test_cancel(self):
+        s = FTScheduler()
+        ran = []
+        job = s.submit(ran.append, 'a')
+        s.submit(ran.append, 'b', priority=Priority.BACKGROUND)
+        s.submit(ran.append, 'c')
+        job.cancel()
+        assert len(s) == 2
+
+        s.cancel_all(Priority.BACKGROUND)
+        while s.run_next():
+            pass
+        assert ran == ['c']
+
+    def test_wait(self):
+        s = FTScheduler()
+        assert s.pop(0) is None
+        assert s.pop(0.01) is None
+
+        # A job submitted from another thread wakes up a waiting pop()
+        timer = threading.Timer(0.01, s.submit, (print,))
+        timer.start()
+        assert s.pop(5).func is print
+        timer.join()
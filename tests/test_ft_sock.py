@@ -3,10 +3,13 @@
 # pylint: disable = no-self-use
 # pylint: disable = protected-access
 
+import socket
 import pytest
 from ft_conn.ft_sock import FTSock
 from ft_conn.ft_error import BrokenSocketError
+from ft_conn.ft_rate import TokenBucket
 from .ft_mock import MockSock
+from .test_ft_rate import FakeClock
 
 class TestFTSock:
     def test_recv_b(self):
@@ -27,3 +30,48 @@ class TestFTSock:
         s = FTSock(MockSock(True))
         s.timeout_set(10)
         assert s.sock.gettimeout() == 10
+
+    def test_send_limited(self):
+        clk = FakeClock()
+        b = TokenBucket(10, 4, clock=clk, sleep=clk.sleep)
+        s = FTSock(MockSock(True), rate_limiters=[b])
+
+        # Control data is not limited at all
+        s.send_bytes(b'0123456789')
+        assert b.reserve(0) == 0
+
+        # Bulk data goes out in burst-sized pieces, with the right total wait
+        s.send_rstring(b'0123456789', bulk=True)
+        assert s.sock.check_bytes(b'0123456789')
+        assert s.sock.check_bytes(b'\x00\x00\x00\x0a0123456789')
+        assert clk.slept == [pytest.approx(0.4), pytest.approx(0.2)]
+
+    def test_recv_stream(self):
+        s = FTSock(MockSock(True))
+        s.sock.append_bytes(b'0123456789')
+
+        pieces = [bytes(p) for p in s.recv_stream(9, bufsize=4)]
+        assert pieces == [b'0123', b'4567', b'8']
+        assert s.sock.rbuf == b'9'
+
+    def test_recv_stream_b(self):
+        s = FTSock(MockSock(True))
+        s.sock.pshutdown = True
+
+        with pytest.raises(BrokenSocketError):
+            list(s.recv_stream(1))
+
+    def test_buffer_size(self):
+        s = FTSock()
+        s.set_buffer_size(1 << 20)
+        s.set_socket(socket.socket(socket.AF_INET, socket.SOCK_STREAM))
+        try:
+            # Set before connecting, and the OS may round it up
+            assert s.sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) >= 1 << 20
+            assert s.sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF) >= 1 << 20
+
+            # Buffers never shrink
+            s.set_buffer_size(4096)
+            assert s.sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) >= 1 << 20
+        finally:
+            s.sock.close()
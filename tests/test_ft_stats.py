@@ -0,0 +1,46 @@
+# pylint: disable = missing-docstring, missing-return-doc, missing-return-type-doc
+# pylint: disable = invalid-name
+# pylint: disable = no-self-use
+# pylint: disable = protected-access
+
+import io
+import json
+from ft_conn.ft_stats import FTStats, Histogram, StatsDumper
+
+class TestFTStats:
+    def test_histogram(self):
+        h = Histogram()
+        for v in (1, 2, 3, 0.25):
+            h.observe(v)
+
+        snap = h.snapshot()
+        assert snap['count'] == 4
+        assert snap['sum'] == 6.25
+        assert snap['min'] == 0.25 and snap['max'] == 3
+        assert snap['buckets'] == {'0.25': 1, '1.0': 1, '2.0': 1, '4.0': 1}
+
+    def test_counters(self):
+        s = FTStats()
+        s.add('a')
+        s.add('a', 4)
+        s.observe('h', 1)
+
+        assert s.counter('a') == 5
+        assert s.counter('missing') == 0
+
+        snap = s.snapshot()
+        assert snap['counters'] == {'a': 5}
+        assert snap['histograms']['h']['count'] == 1
+
+    def test_dump(self):
+        s = FTStats()
+        s.add('bytes_sent', 10)
+        out = io.StringIO()
+
+        d = StatsDumper(s, out, interval=3600)
+        d.start()
+        d.stop()
+
+        lines = out.getvalue().splitlines()
+        assert len(lines) == 1
+        assert json.loads(lines[0])['counters'] == {'bytes_sent': 10}